@@ -0,0 +1,113 @@
+# =========================
+# Conversation memory
+# =========================
+# What NutriBot remembers of a chat, stored in user["chat_history"]:
+#
+#   {"turns":      [{"role": "user" | "assistant", "content", "tokens"}, ...],
+#    "summary":    ["User asked: ...", "NutriBot said: ...", ...],
+#    "folded":     <turns folded into the summary so far>,
+#    "updated_at": <time of the last exchange>}
+#
+# The most recent turns are kept verbatim as long as they, plus the summary,
+# fit in a token budget (and there are at most max_turns of them). Older
+# turns are folded into the summary as one short line each; the summary has
+# its own budget and drops its oldest lines. Folding is local (no extra GPT
+# call), so the context sent with a question and the stored record stay
+# bounded however long a user chats. A conversation left idle for longer
+# than `max_idle` seconds is over: the next question starts a fresh one.
+import time
+
+SUMMARY_LINE_WORDS = 24
+CHARS_PER_TOKEN = 4  # rough size of a GPT token in English text
+
+
+def count_tokens(text):
+    return max(1, -(-len(text) // CHARS_PER_TOKEN))
+
+
+def empty_memory():
+    return {"turns": [], "summary": [], "folded": 0, "updated_at": 0}
+
+
+def as_memory(value):
+    """Return `value` as a memory; a legacy list of messages becomes turns."""
+    if isinstance(value, dict):
+        return value
+    memory = empty_memory()
+    for message in value or []:
+        if isinstance(message, dict) and message.get("content"):
+            content = message["content"]
+            memory["turns"].append({
+                "role": message.get("role", "user"),
+                "content": content,
+                "tokens": count_tokens(content),
+            })
+    return memory
+
+
+def memory_tokens(memory):
+    return (sum(turn["tokens"] for turn in memory["turns"])
+            + sum(count_tokens(line) for line in memory["summary"]))
+
+
+def current_memory(memory, max_idle=1800, now=None):
+    """`memory` if its conversation is still going, else an empty one.
+    Legacy records carry no time and count as over."""
+    now = time.time() if now is None else now
+    if now - memory.get("updated_at", 0) > max_idle:
+        return empty_memory()
+    return memory
+
+
+def add_exchange(memory, question, answer, budget=600, max_turns=12, summary_budget=150):
+    """New memory with one question/answer pair added, folded to fit `budget`."""
+    # Copy: the stored memory may still sit in a change record to be saved
+    memory = {
+        "turns": list(memory["turns"]),
+        "summary": list(memory["summary"]),
+        "folded": memory["folded"],
+        "updated_at": time.time(),
+    }
+    turn_limit = budget // 2  # one long answer must not push out everything else
+    for role, content in (("user", question), ("assistant", answer)):
+        content = _clip(content.strip(), turn_limit)
+        memory["turns"].append({"role": role, "content": content, "tokens": count_tokens(content)})
+
+    turns = memory["turns"]
+    while turns and (len(turns) > max_turns or memory_tokens(memory) > budget):
+        memory["summary"].append(_summary_line(turns.pop(0)))
+        memory["folded"] += 1
+        summary = memory["summary"]
+        while summary and sum(count_tokens(line) for line in summary) > summary_budget:
+            summary.pop(0)
+    return memory
+
+
+def context_messages(memory):
+    """Chat API messages that carry the conversation so far."""
+    messages = []
+    if memory["summary"]:
+        messages.append({
+            "role": "system",
+            "content": "Earlier in this conversation:\n" + "\n".join(memory["summary"]),
+        })
+    messages.extend({"role": turn["role"], "content": turn["content"]} for turn in memory["turns"])
+    return messages
+
+
+def has_context(memory):
+    return bool(memory["turns"] or memory["summary"])
+
+
+def _clip(text, tokens):
+    limit = tokens * CHARS_PER_TOKEN
+    return text if len(text) <= limit else text[:limit].rstrip() + "…"
+
+
+def _summary_line(turn):
+    words = turn["content"].split()
+    gist = " ".join(words[:SUMMARY_LINE_WORDS])
+    if len(words) > SUMMARY_LINE_WORDS:
+        gist += "…"
+    speaker = "User asked" if turn["role"] == "user" else "NutriBot said"
+    return f"{speaker}: {gist}"
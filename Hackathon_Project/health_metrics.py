@@ -0,0 +1,138 @@
+# =========================
+# Derived health metrics
+# =========================
+# BMI, BMI category and daily calories (Mifflin-St Jeor) are stored in the
+# profile but derived from weight, height, age and gender. The formulas are
+# written once with NumPy so the same code serves a single profile form and
+# the fleet-wide recompute (flask recompute-metrics): scalars go in as 0-d
+# values, a whole user base as columns.
+import time
+
+import numpy as np
+
+BMI_BOUNDS = np.array([18.5, 25.0, 30.0])
+BMI_CATEGORIES = ("Underweight", "Normal", "Overweight", "Obese")
+DERIVED_FIELDS = ("bmi", "bmi_category", "daily_calories")
+
+
+def bmi(weight, height):
+    """kg / m^2 rounded to 2 decimals; height in cm."""
+    height_m = np.asarray(height, dtype=np.float64) / 100
+    return np.round(np.asarray(weight, dtype=np.float64) / (height_m * height_m), 2)
+
+
+def bmi_category_codes(bmi_values):
+    """Index into BMI_CATEGORIES (WHO cut-offs, lower bound inclusive)."""
+    return np.searchsorted(BMI_BOUNDS, bmi_values, side="right")
+
+
+def daily_calories(weight, height, age, male):
+    """Mifflin-St Jeor resting energy in kcal."""
+    weight = np.asarray(weight, dtype=np.float64)
+    height = np.asarray(height, dtype=np.float64)
+    age = np.asarray(age, dtype=np.float64)
+    return 10 * weight + 6.25 * height - 5 * age + np.where(male, 5.0, -161.0)
+
+
+def is_male(gender):
+    return str(gender).lower() == "male"
+
+
+def profile_metrics(weight, height, age=None, gender=None):
+    """Derived fields for one profile; what cannot be computed is None."""
+    values = {"bmi": None, "bmi_category": None, "daily_calories": None}
+    try:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            value = float(bmi(float(weight), float(height)))
+    except (TypeError, ValueError):
+        return values
+    if not np.isfinite(value) or float(height) <= 0:
+        return values
+    values["bmi"] = value
+    values["bmi_category"] = BMI_CATEGORIES[int(bmi_category_codes(value))]
+    if age is not None and gender:
+        values["daily_calories"] = float(daily_calories(float(weight), float(height), int(age), is_male(gender)))
+    return values
+
+
+# =========================
+# Fleet-wide recompute
+# =========================
+def _column(profiles, field):
+    column = np.full(len(profiles), np.nan)
+    for i, profile in enumerate(profiles):
+        try:
+            column[i] = float(profile.get(field))
+        except (TypeError, ValueError):
+            pass
+    return column
+
+
+def recompute_profiles(profiles):
+    """Recompute the derived fields of every profile at once.
+
+    `profiles` maps user name -> profile. Returns {user name: changed values}
+    for the profiles whose stored values differ from the formulas.
+    """
+    names = list(profiles)
+    rows = [profiles[name] for name in names]
+    weight = _column(rows, "weight")
+    height = _column(rows, "height")
+    age = _column(rows, "age")
+    male = np.array([is_male(row.get("gender")) for row in rows], dtype=bool)
+    has_gender = np.array([bool(row.get("gender")) for row in rows], dtype=bool)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        bmi_values = bmi(weight, height)
+        calories = daily_calories(weight, height, age, male)
+    has_bmi = np.isfinite(bmi_values) & (height > 0)
+    has_calories = has_bmi & np.isfinite(calories) & has_gender
+    codes = bmi_category_codes(np.where(has_bmi, bmi_values, 0.0))
+
+    stored_bmi = _column(rows, "bmi")
+    stored_calories = _column(rows, "daily_calories")
+    # round() and np.round() can disagree by one step on ties (16.575)
+    bmi_stale = has_bmi & ~(np.abs(stored_bmi - bmi_values) <= 0.01 + 1e-9)
+    calories_stale = has_calories & ~(np.abs(stored_calories - calories) < 1e-6)
+
+    updates = {}
+    for i in np.flatnonzero(has_bmi):
+        values = {}
+        if bmi_stale[i]:
+            values["bmi"] = float(bmi_values[i])
+        category = BMI_CATEGORIES[codes[i]]
+        if rows[i].get("bmi_category") != category:
+            values["bmi_category"] = category
+        if calories_stale[i]:
+            values["daily_calories"] = float(calories[i])
+        if values:
+            updates[names[i]] = values
+    return updates
+
+
+def recompute_store(store):
+    """Recompute every stored profile and write the changes in one commit."""
+    started = time.perf_counter()
+    profiles = dict(store.iter_profiles())
+    loaded = time.perf_counter()
+    updates = recompute_profiles(profiles)
+    computed = time.perf_counter()
+    if updates:
+        store.commit_many({
+            name: [{"op": "profile", "values": values}]
+            for name, values in updates.items()
+        })
+    written = time.perf_counter()
+
+    changed_fields = dict.fromkeys(DERIVED_FIELDS, 0)
+    for values in updates.values():
+        for field in values:
+            changed_fields[field] += 1
+    return {
+        "users": len(profiles),
+        "updated_users": len(updates),
+        "changed_fields": changed_fields,
+        "load_s": round(loaded - started, 3),
+        "compute_s": round(computed - loaded, 3),
+        "write_s": round(written - computed, 3),
+    }
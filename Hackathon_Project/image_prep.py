@@ -0,0 +1,127 @@
+# =========================
+# Image preprocessing for the vision API
+# =========================
+# Phone photos are several MB; the vision model does not need that. Before
+# upload we decode, apply the EXIF rotation, shrink the longest edge to
+# `max_edge`, drop all metadata and re-encode as JPEG at `quality`.
+# A small, upright original can come out bigger after re-encoding; then
+# the original bytes are sent instead. Whichever is chosen is written next
+# to the original so the work is only done once.
+import io
+import os
+import threading
+import time
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Without Pillow the original bytes are sent as-is
+    Image = None
+
+MIME_TYPES = {"jpg": "image/jpeg", "jpeg": "image/jpeg", "png": "image/png"}
+
+
+def guess_mime(path):
+    ext = path.rsplit(".", 1)[-1].lower()
+    return MIME_TYPES.get(ext, "application/octet-stream")
+
+
+def sniff_mime(data):
+    return "image/png" if data.startswith(b"\x89PNG") else "image/jpeg"
+
+
+def prepared_path(path, max_edge, quality):
+    stem = path.rsplit(".", 1)[0]
+    return f"{stem}.vision-{max_edge}-{quality}.jpg"
+
+
+class ImagePreparer:
+    def __init__(self, max_edge=1024, quality=80):
+        self.max_edge = max_edge
+        self.quality = quality
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.prep_ms = 0.0
+        self.api_calls = 0
+        self.api_ms = 0.0
+
+    def cached_path(self, path):
+        return prepared_path(path, self.max_edge, self.quality)
+
+    def prepare(self, path):
+        """Return (bytes, mime type, stats dict) ready for the vision API."""
+        started = time.perf_counter()
+        original_size = os.path.getsize(path)
+        cached = self.cached_path(path)
+        if os.path.exists(cached):
+            with open(cached, "rb") as f:
+                data = f.read()
+            mime = sniff_mime(data)  # the original when it was the smaller
+        else:
+            data, mime, rotated = self._convert(path)
+            if data is None or (not rotated and original_size <= len(data)):
+                with open(path, "rb") as f:
+                    data, mime = f.read(), guess_mime(path)
+            # An image that could not be converted is not remembered
+            if rotated is not None:
+                tmp_path = f"{cached}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, cached)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        stats = {
+            "original_bytes": original_size,
+            "sent_bytes": len(data),
+            "saved_bytes": original_size - len(data),
+            "prep_ms": round(elapsed_ms, 1),
+        }
+        with self.lock:
+            self.calls += 1
+            self.bytes_in += original_size
+            self.bytes_out += len(data)
+            self.prep_ms += elapsed_ms
+        return data, mime, stats
+
+    def _convert(self, path):
+        """(JPEG bytes, mime, whether EXIF said to rotate); (None, None, None)
+        if the image can't be converted."""
+        if Image is None:
+            return None, None, None
+        try:
+            with Image.open(path) as img:
+                img.draft("RGB", (self.max_edge, self.max_edge))  # fast JPEG downscale
+                rotated = img.getexif().get(0x0112, 1) != 1  # Orientation tag
+                img = ImageOps.exif_transpose(img)
+                if img.mode in ("RGBA", "LA", "P"):
+                    # Flatten transparency onto white; JPEG has no alpha
+                    img = img.convert("RGBA")
+                    background = Image.new("RGB", img.size, (255, 255, 255))
+                    background.paste(img, mask=img.getchannel("A"))
+                    img = background
+                elif img.mode != "RGB":
+                    img = img.convert("RGB")
+                img.thumbnail((self.max_edge, self.max_edge), Image.LANCZOS)
+                out = io.BytesIO()
+                # No exif/icc arguments: the re-encoded file carries no metadata
+                img.save(out, "JPEG", quality=self.quality, optimize=True)
+        except Exception as e:
+            print("Image preprocessing failed, sending original:", e)
+            return None, None, None
+        return out.getvalue(), "image/jpeg", rotated
+
+    def record_api_call(self, elapsed_ms):
+        with self.lock:
+            self.api_calls += 1
+            self.api_ms += elapsed_ms
+
+    def stats(self):
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "bytes_saved": self.bytes_in - self.bytes_out,
+                "avg_prep_ms": round(self.prep_ms / self.calls, 1) if self.calls else 0.0,
+                "avg_api_ms": round(self.api_ms / self.api_calls, 1) if self.api_calls else 0.0,
+            }
@@ -0,0 +1,82 @@
+# =========================
+# Cold start profiling
+# =========================
+# Imports a module in a fresh interpreter with `python -X importtime` and
+# reports where the time goes:
+#
+#   python import_profile.py                      # server, top 15 imports
+#   python import_profile.py --top 30 --target-ms 500
+#
+# With --target-ms the exit status is 1 when the cumulative import time of
+# the module is over the target, so it can guard cold start in CI.
+import argparse
+import os
+import subprocess
+import sys
+
+
+def profile_imports(module="server", python=sys.executable, cwd=None):
+    """[(self_us, cumulative_us, depth, name)] in the order Python reports them."""
+    result = subprocess.run(
+        [python, "-X", "importtime", "-c", f"import {module}"],
+        cwd=cwd, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        if not self_us.strip().isdigit():
+            continue  # header line
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((int(self_us), int(cumulative_us), depth, name.strip()))
+    return rows
+
+
+def summarize(rows, module, top=15):
+    """Cumulative time of `module`, its own body and its slowest imports."""
+    # Children are reported before their parent, one level deeper
+    for end, (self_us, cumulative_us, depth, name) in enumerate(rows):
+        if name == module and depth == 0:
+            break
+    else:
+        raise ValueError(f"{module} not found in the import trace")
+    start = end
+    while start > 0 and rows[start - 1][2] > 0:
+        start -= 1
+    direct = [row for row in rows[start:end] if row[2] == 1]
+    return {
+        "module": module,
+        "total_ms": cumulative_us / 1000,
+        "body_ms": self_us / 1000,
+        "slowest": [
+            (name, cumulative / 1000)
+            for _, cumulative, _, name in sorted(direct, key=lambda row: -row[1])[:top]
+        ],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import-time breakdown of a module")
+    parser.add_argument("module", nargs="?", default="server")
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--target-ms", type=float, default=None)
+    args = parser.parse_args(argv)
+
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    summary = summarize(profile_imports(args.module, cwd=cwd), args.module, args.top)
+    print(f"import {summary['module']}: {summary['total_ms']:.0f} ms "
+          f"(module body {summary['body_ms']:.0f} ms)")
+    for name, ms in summary["slowest"]:
+        print(f"  {ms:8.1f} ms  {name}")
+    if args.target_ms is not None:
+        ok = summary["total_ms"] <= args.target_ms
+        print(f"target {args.target_ms:.0f} ms: {'ok' if ok else 'over'}")
+        return 0 if ok else 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,213 @@
+# =========================
+# Chat intent routing
+# =========================
+# Two stages, both local:
+#   1. One compiled regex finds every known phrase (question words, weight
+#      goal phrases, yes/no ...) with word boundaries in a single pass, so
+#      "can" no longer matches "cancel" and "no" no longer matches "know".
+#   2. A small logistic regression trained on the examples below labels
+#      whatever the phrases don't decide, with a confidence score.
+# Labels in LOCAL_LABELS are answered with a canned reply or start the
+# weight-goal flow instead of going to GPT, so a model guess needs a much
+# higher confidence, and a message that mentions food or diet never gets
+# one of them. Only the lose/gain phrases start a goal flow outright.
+import math
+import re
+
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+
+PHRASES = {
+    "question": ["should", "could", "would", "what", "how", "when", "where",
+                 "why", "can", "which"],
+    "lose": ["lose weight", "weight loss", "slim down", "get thinner"],
+    "gain": ["gain weight", "weight gain", "bulk up", "get bigger", "put on weight"],
+    "intent": ["i want to", "i need to", "i would like to", "i'm trying to",
+               "help me", "i want", "i need", "i'd like to"],
+    "affirm": ["yes", "yeah", "yep", "sure", "ok", "okay", "of course", "please do"],
+    "deny": ["no", "nope", "not now", "no thanks", "nah"],
+    "food": ["food", "foods", "eat", "eating", "meal", "meals", "meal plan",
+             "diet", "diets", "snack", "snacks", "recipe", "recipes", "cook",
+             "cooking", "breakfast", "lunch", "dinner", "calorie", "calories",
+             "protein", "carbs", "fat", "fats", "sugar", "salt", "fiber",
+             "vitamin", "vitamins", "nutrition", "nutrient", "nutrients",
+             "healthy", "milk", "dairy", "drink", "coffee", "water",
+             "dessert", "fruit", "vegetables", "keto",
+             "vegan", "fasting", "supplement", "supplements"],
+}
+GREETINGS = {"hello", "hi", "hey"}
+FAREWELLS = {"bye", "goodbye", "quit"}
+LOCAL_LABELS = {"thanks", "capabilities", "off_topic", "affirm", "deny", "goal_lose", "goal_gain"}
+
+# Seed examples for the classifier; "nutrition" means "ask GPT"
+TRAINING_EXAMPLES = {
+    "greeting": [
+        "hello", "hi", "hey", "hello there", "hi nutribot", "hey there",
+        "good morning", "good evening", "hiya", "greetings",
+    ],
+    "farewell": [
+        "bye", "goodbye", "see you later", "see you", "quit", "that's all",
+        "talk to you later", "i'm done", "good night", "catch you later",
+    ],
+    "thanks": [
+        "thanks", "thank you", "thanks a lot", "thank you so much", "cheers",
+        "much appreciated", "great thanks", "awesome thank you", "ty", "thx",
+    ],
+    "capabilities": [
+        "what can you do", "help", "what do you do", "how can you help me",
+        "what are you", "who are you", "what can i ask you",
+        "what features do you have", "how does this work", "what is nutribot",
+    ],
+    "goal_lose": [
+        "i want to lose weight", "i need to lose some weight", "help me slim down",
+        "i'm trying to get thinner", "i want to drop a few kilos",
+        "i need to shed some pounds", "i would like to lose fat",
+        "i want to cut weight", "i'd like to get leaner", "lose weight",
+    ],
+    "goal_gain": [
+        "i want to gain weight", "i need to put on weight", "help me bulk up",
+        "i'm trying to get bigger", "i want to build muscle mass",
+        "i need to gain some kilos", "i would like to gain muscle",
+        "i want to bulk", "i'd like to put on some size", "gain weight",
+    ],
+    "affirm": [
+        "yes", "yeah", "yep", "sure", "ok", "okay", "of course", "sounds good",
+        "yes please", "let's do it",
+    ],
+    "deny": [
+        "no", "nope", "not now", "no thanks", "nah", "maybe later",
+        "no thank you", "not really", "i don't think so", "skip",
+    ],
+    "off_topic": [
+        "who won the football game", "what's the weather today",
+        "tell me a joke", "what is the capital of france",
+        "can you write my essay", "what's the latest iphone",
+        "recommend a movie", "how do i fix my car", "what time is it",
+        "help me with my math homework",
+    ],
+    "nutrition": [
+        "is rice healthy", "what should i eat for breakfast",
+        "how much protein do i need", "are eggs good for you",
+        "what foods are high in iron", "how many calories should i eat",
+        "is intermittent fasting healthy", "what is a balanced diet",
+        "what should i eat to lose weight", "how can i gain weight healthily",
+        "are carbs bad", "what are good snacks", "is coffee bad for you",
+        "how much water should i drink", "what vitamins do i need",
+        "is sugar bad", "what foods help build muscle", "is keto safe",
+        "what should i eat after a workout", "is bread fattening",
+        "i don't know what to eat", "tell me about vitamin d",
+        # Near-misses of the canned labels that are still nutrition questions
+        "can you write me a meal plan", "write me a diet plan",
+        "recommend a healthy snack", "recommend a good breakfast",
+        "tell me a healthy recipe", "tell me a quick dinner idea",
+        "how do i fix my diet", "how do i fix my eating habits",
+        "what do you think about oat milk", "what do you think about tofu",
+        "no sugar diet tips", "no carb breakfast ideas",
+        "help me plan my meals", "can you help me eat better",
+        "what can i cook with chicken", "what can i eat instead of rice",
+        "ok what about fruit", "yes but is honey better than sugar",
+    ],
+}
+
+
+def intent_tokenize(text):
+    # Same word split as the server's question_tokenize but keeps every
+    # stopword: "i", "to" and "you" carry intent too
+    return re.findall(r"\b\w+\b", text.lower())
+
+
+def compile_phrase_matcher(phrases):
+    groups = []
+    for category, words in phrases.items():
+        # Longest phrases first so "i want to" wins over "i want"
+        alternatives = "|".join(
+            re.escape(w) for w in sorted(words, key=len, reverse=True)
+        )
+        groups.append(f"(?P<{category}>\\b(?:{alternatives})\\b)")
+    return re.compile("|".join(groups))
+
+
+class Route:
+    def __init__(self, label, confidence, source, flags):
+        self.label = label
+        self.confidence = confidence
+        self.source = source  # "rule" or "model"
+        self.flags = flags    # phrase categories found in the message
+
+    def __repr__(self):
+        return (f"Route(label={self.label!r}, confidence={self.confidence:.2f}, "
+                f"source={self.source!r}, flags={sorted(self.flags)})")
+
+
+class IntentRouter:
+    def __init__(self, min_confidence=0.5, local_confidence=0.85):
+        self.min_confidence = min_confidence
+        self.local_confidence = local_confidence  # for LOCAL_LABELS
+        self.matcher = compile_phrase_matcher(PHRASES)
+        texts, labels = [], []
+        for label, examples in TRAINING_EXAMPLES.items():
+            texts.extend(examples)
+            labels.extend([label] * len(examples))
+        self.vectorizer = TfidfVectorizer(
+            tokenizer=intent_tokenize, token_pattern=None,
+            lowercase=False, ngram_range=(1, 2), sublinear_tf=True,
+        )
+        self.model = LogisticRegression(C=20, max_iter=1000)
+        self.model.fit(self.vectorizer.fit_transform(texts), labels)
+        # Keep the fitted weights as plain lookups: scoring one short message
+        # directly is ~50x faster than going through transform/predict_proba
+        self.vocabulary = self.vectorizer.vocabulary_
+        self.idf = self.vectorizer.idf_
+        self.coef = self.model.coef_.T
+        self.intercept = self.model.intercept_
+        self.classes = self.model.classes_
+
+    def match_phrases(self, text):
+        return {m.lastgroup for m in self.matcher.finditer(text.lower())}
+
+    def classify(self, text):
+        # Same features as the vectorizer: unigrams + bigrams, sublinear tf,
+        # idf weighting, L2 norm; then the multinomial softmax
+        tokens = intent_tokenize(text)
+        grams = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+        counts = {}
+        for gram in grams:
+            index = self.vocabulary.get(gram)
+            if index is not None:
+                counts[index] = counts.get(index, 0) + 1
+        scores = self.intercept.copy()
+        if counts:
+            indices = list(counts)
+            weights = np.array([(1 + math.log(counts[i])) * self.idf[i] for i in indices])
+            weights /= np.sqrt(weights @ weights)
+            scores += weights @ self.coef[indices]
+        probabilities = np.exp(scores - scores.max())
+        probabilities /= probabilities.sum()
+        best = probabilities.argmax()
+        return self.classes[best], float(probabilities[best])
+
+    def route(self, text):
+        lowered = text.lower().strip()
+        flags = self.match_phrases(lowered)
+        if lowered in GREETINGS:
+            return Route("greeting", 1.0, "rule", flags)
+        if lowered in FAREWELLS:
+            return Route("farewell", 1.0, "rule", flags)
+
+        # Weight goals: a question goes to GPT, a statement starts a program
+        is_question = "question" in flags
+        for goal in ("lose", "gain"):
+            if goal in flags:
+                if is_question:
+                    return Route("weight_question", 1.0, "rule", flags)
+                return Route(f"goal_{goal}", 1.0, "rule", flags)
+
+        label, confidence = self.classify(lowered)
+        if label.startswith("goal_") and is_question:
+            return Route("weight_question", confidence, "model", flags)
+        if confidence < self.min_confidence:
+            return Route("nutrition", confidence, "model", flags)
+        if label in LOCAL_LABELS and (confidence < self.local_confidence or "food" in flags):
+            return Route("nutrition", confidence, "model", flags)
+        return Route(label, confidence, "model", flags)
@@ -0,0 +1,171 @@
+# =========================
+# Background job queue
+# =========================
+# Jobs are rows in a small SQLite table so queued work survives a restart:
+# on start every job still "queued" is submitted again.
+# A fixed-size thread pool runs them; the handler for a job's kind gets the
+# job dict and returns a JSON-serialisable result. Several server processes
+# can share the table: a job is claimed with one UPDATE, so only one of
+# them runs it. Each process touches the jobs it is running every
+# `stale_after / 3` seconds; a "running" job left untouched for
+# `stale_after` seconds lost its process and is run again by another one,
+# so handlers must tolerate running twice. A process never submits a job it
+# already has waiting in its own pool.
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id         TEXT PRIMARY KEY,
+    kind       TEXT NOT NULL,
+    user_name  TEXT NOT NULL,
+    payload    TEXT NOT NULL,
+    status     TEXT NOT NULL,
+    result     TEXT,
+    error      TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status);
+"""
+
+
+class JobQueue:
+    def __init__(self, path, handlers, workers=2, stale_after=60.0):
+        self.path = path
+        self.handlers = handlers  # kind -> function(job) -> result
+        self.stale_after = stale_after
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self.running = set()  # ids of jobs this process is running
+        self.pending = set()  # ids submitted to this process's pool, not yet run
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        with self.connect() as conn:
+            conn.executescript(SCHEMA)
+        self.recover()
+        self.heartbeat = threading.Thread(target=self._heartbeat_loop, daemon=True)
+        self.heartbeat.start()
+
+    def connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            self.local.conn = conn
+        return conn
+
+    def submit(self, kind, user_name, payload):
+        job_id = str(uuid4())
+        now = time.time()
+        with self.connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, user_name, payload, status, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                (job_id, kind, user_name, json.dumps(payload), now, now),
+            )
+        self._enqueue(job_id)
+        return job_id
+
+    def _enqueue(self, job_id):
+        with self.lock:
+            if job_id in self.pending:
+                return False
+            self.pending.add(job_id)
+        self.executor.submit(self.run, job_id)
+        return True
+
+    def recover(self, stale_only=False):
+        """Submit queued jobs and jobs whose process stopped heartbeating.
+        stale_only skips jobs queued in the last `stale_after` seconds,
+        which their own process is about to run."""
+        now = time.time()
+        cutoff = now - self.stale_after
+        with self.connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'queued' WHERE status = 'running' AND updated_at <= ?",
+                (cutoff,),
+            )
+        rows = self.connect().execute(
+            "SELECT id FROM jobs WHERE status = 'queued' AND updated_at <= ? ORDER BY created_at",
+            (cutoff if stale_only else now,),
+        ).fetchall()
+        return sum(self._enqueue(row["id"]) for row in rows)
+
+    def _heartbeat_loop(self):
+        while not self.stopped.wait(self.stale_after / 3):
+            try:
+                with self.lock:
+                    running = list(self.running)
+                if running:
+                    with self.connect() as conn:
+                        conn.executemany(
+                            "UPDATE jobs SET updated_at = ? WHERE id = ? AND status = 'running'",
+                            [(time.time(), job_id) for job_id in running],
+                        )
+                self.recover(stale_only=True)
+            except sqlite3.Error as e:
+                print("Job heartbeat failed:", e)
+
+    def get(self, job_id):
+        row = self.connect().execute(
+            "SELECT * FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def _claim(self, job_id):
+        with self.connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'running', updated_at = ? WHERE id = ? AND status = 'queued'",
+                (time.time(), job_id),
+            )
+        return cursor.rowcount == 1
+
+    def _set_status(self, job_id, status, result=None, error=None):
+        with self.connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ? WHERE id = ?",
+                (status, json.dumps(result) if result is not None else None,
+                 error, time.time(), job_id),
+            )
+
+    def run(self, job_id):
+        claimed = self._claim(job_id)
+        with self.lock:
+            self.pending.discard(job_id)
+            if claimed:
+                self.running.add(job_id)
+        if not claimed:
+            return  # finished, or taken by another worker
+        try:
+            job = self.get(job_id)
+            try:
+                result = self.handlers[job["kind"]](job)
+            except Exception as e:
+                print(f"Job {job_id} ({job['kind']}) failed:", e)
+                self._set_status(job_id, "failed", error=str(e))
+                return
+            self._set_status(job_id, "done", result=result)
+        finally:
+            with self.lock:
+                self.running.discard(job_id)
+
+    def stats(self):
+        rows = self.connect().execute(
+            "SELECT status, COUNT(*) AS n FROM jobs GROUP BY status"
+        ).fetchall()
+        return {row["status"]: row["n"] for row in rows}
+
+    def close(self):
+        self.stopped.set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
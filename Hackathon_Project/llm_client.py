@@ -0,0 +1,260 @@
+# =========================
+# Resilient LLM calls
+# =========================
+# Every OpenAI call goes through one LLMClient:
+#   - deadline: each call has an overall time budget; every attempt gets what
+#     is left of it as its timeout, so a slow provider cannot hold a worker
+#     for longer than that. A stream is closed once the deadline passes,
+#     even while chunks keep arriving
+#   - retries: timeouts, connection errors, 408/409/429 and 5xx are retried
+#     with exponential backoff and full jitter, within the deadline
+#   - circuit breaker: after `failure_threshold` calls in a row failed that
+#     way, calls fail at once with LLMUnavailable for `reset_timeout`
+#     seconds; then one trial call decides whether it closes again. Errors
+#     that are the request's fault (400, 401 ...) count neither way
+#   - concurrency: at most `max_in_flight` calls (streams included) are open
+#     at a time; a call that cannot get a slot within `queue_timeout` fails
+#     fast. Background callers pass a longer one to wait their turn instead
+# Callers catch the exception and use their local fallback reply.
+import random
+import threading
+import time
+from collections import deque
+
+RETRYABLE_STATUS = {408, 409, 429}
+RETRYABLE_NAMES = {"APITimeoutError", "APIConnectionError"}
+
+
+class LLMUnavailable(Exception):
+    """The call was not attempted: circuit open or too many calls in flight."""
+
+
+def is_retryable(exc):
+    status = getattr(exc, "status_code", None)
+    if status is not None:
+        return status in RETRYABLE_STATUS or status >= 500
+    return isinstance(exc, (TimeoutError, ConnectionError)) or type(exc).__name__ in RETRYABLE_NAMES
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.opened = 0
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_timeout or self.trial_running:
+                return False
+            self.trial_running = True  # half-open: let one call through
+            return True
+
+    def cancel(self):
+        # The call let through was not made; a later one may be the trial
+        with self.lock:
+            self.trial_running = False
+
+    def record(self, ok):
+        with self.lock:
+            self.trial_running = False
+            if ok:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    self.opened += 1
+                self.opened_at = time.monotonic()
+
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                return "half_open"
+            return "open"
+
+
+class LLMClient:
+    def __init__(self, client_factory, timeout=20.0, max_retries=2, backoff_base=0.5,
+                 backoff_max=4.0, failure_threshold=5, reset_timeout=30.0,
+                 max_in_flight=8, queue_timeout=2.0, latency_window=500):
+        self.client_factory = client_factory
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.queue_timeout = queue_timeout
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.max_in_flight = max_in_flight
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.latency_window = latency_window
+        self.endpoints = {}
+
+    def create(self, endpoint, deadline=None, queue_timeout=None, **kwargs):
+        """chat.completions.create() with a deadline (seconds), retries,
+        circuit breaker and a concurrency slot. With stream=True the slot is
+        held until the returned iterator is exhausted or closed."""
+        started = time.monotonic()
+        expires = started + (deadline or self.timeout)
+        if queue_timeout is None:
+            queue_timeout = self.queue_timeout
+        if not self.breaker.allow():
+            self._record(endpoint, "circuit_open", 0.0)
+            raise LLMUnavailable("LLM circuit open")
+        if not self.slots.acquire(timeout=max(0.0, min(queue_timeout, expires - started))):
+            self.breaker.cancel()
+            self._record(endpoint, "overloaded", time.monotonic() - started)
+            raise LLMUnavailable("Too many LLM calls in flight")
+        with self.lock:
+            self.in_flight += 1
+        retries = 0
+        try:
+            while True:
+                remaining = expires - time.monotonic()
+                try:
+                    if remaining <= 0:
+                        raise TimeoutError("LLM deadline exceeded")
+                    result = self.client_factory().chat.completions.create(timeout=remaining, **kwargs)
+                    break
+                except Exception as e:
+                    retryable = is_retryable(e)
+                    delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** retries))
+                    if retryable and retries < self.max_retries and time.monotonic() + delay < expires:
+                        retries += 1
+                        time.sleep(delay)
+                        continue
+                    # Only provider trouble counts against the breaker; a bad
+                    # request says nothing about it either way
+                    if retryable:
+                        self.breaker.record(False)
+                    else:
+                        self.breaker.cancel()
+                    self._record(endpoint, _outcome(e), time.monotonic() - started, retries)
+                    raise
+        except BaseException:
+            self._release()
+            raise
+        if kwargs.get("stream"):
+            return GuardedStream(self, endpoint, result, started, retries, expires)
+        self.breaker.record(True)
+        self._release()
+        self._record(endpoint, "ok", time.monotonic() - started, retries)
+        return result
+
+    def _release(self):
+        with self.lock:
+            self.in_flight -= 1
+        self.slots.release()
+
+    def _record(self, endpoint, outcome, seconds, retries=0):
+        with self.lock:
+            counters = self.endpoints.get(endpoint)
+            if counters is None:
+                counters = self.endpoints[endpoint] = {
+                    "outcomes": {}, "retries": 0,
+                    "latencies": deque(maxlen=self.latency_window),
+                }
+            counters["outcomes"][outcome] = counters["outcomes"].get(outcome, 0) + 1
+            counters["retries"] += retries
+            if outcome not in ("circuit_open", "overloaded"):
+                counters["latencies"].append(seconds * 1000)
+
+    def stats(self):
+        with self.lock:
+            endpoints = {}
+            for endpoint, counters in self.endpoints.items():
+                latencies = sorted(counters["latencies"])
+                endpoints[endpoint] = {
+                    "outcomes": dict(counters["outcomes"]),
+                    "retries": counters["retries"],
+                    "p50_ms": _percentile(latencies, 0.50),
+                    "p95_ms": _percentile(latencies, 0.95),
+                    "p99_ms": _percentile(latencies, 0.99),
+                }
+            in_flight = self.in_flight
+        return {
+            "circuit": self.breaker.state(),
+            "circuit_opened": self.breaker.opened,
+            "in_flight": in_flight,
+            "max_in_flight": self.max_in_flight,
+            "endpoints": endpoints,
+        }
+
+
+class GuardedStream:
+    """Iterator over a streamed response that holds the concurrency slot
+    until the stream ends, fails, runs past `expires` or is closed (also
+    when never iterated). The HTTP response is closed with it."""
+
+    def __init__(self, llm, endpoint, stream, started, retries, expires):
+        self.llm = llm
+        self.endpoint = endpoint
+        self.stream = stream
+        self.chunks = iter(stream)
+        self.started = started
+        self.retries = retries
+        self.expires = expires
+        self.finished = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.finished:
+            raise StopIteration
+        if time.monotonic() >= self.expires:
+            self._finish("timeout", False)
+            raise TimeoutError("LLM deadline exceeded")
+        try:
+            return next(self.chunks)
+        except StopIteration:
+            self._finish("ok", True)
+            raise
+        except Exception as e:
+            self._finish(_outcome(e), False if is_retryable(e) else None)
+            raise
+
+    def close(self):
+        # Consumer stopped early (e.g. the browser went away)
+        self._finish("closed")
+
+    def __del__(self):
+        self._finish("closed")
+
+    def _finish(self, outcome, provider_ok=None):
+        # provider_ok None: the call says nothing about the provider
+        if self.finished:
+            return
+        self.finished = True
+        close = getattr(self.stream, "close", None)
+        if close is not None:
+            try:
+                close()
+            except Exception as e:
+                print(f"Could not close LLM stream: {e}")
+        if provider_ok is None:
+            self.llm.breaker.cancel()
+        else:
+            self.llm.breaker.record(provider_ok)
+        self.llm._release()
+        self.llm._record(self.endpoint, outcome, time.monotonic() - self.started, self.retries)
+
+
+def _outcome(exc):
+    return "timeout" if "timeout" in type(exc).__name__.lower() else "error"
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return round(sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))], 1)
@@ -0,0 +1,133 @@
+# =========================
+# Milestone engine
+# =========================
+# Per-user state kept with the user (user["milestone_state"]):
+#
+#   {"count", "first_weight", "last_weight", "min_weight", "max_weight",
+#    "last_day",        # local calendar day (ordinal) of the newest weigh-in
+#    "streak",          # consecutive days with a weigh-in, ending at last_day
+#    "longest_streak",
+#    "unlocked": {"<milestone id>": epoch seconds}}
+#
+# log_weight() folds each weigh-in into it in O(1) with update_milestones()
+# and the rules below are checked against the stats it derives, so nothing
+# rescans the history. Adding a milestone is adding an entry to MILESTONES.
+from datetime import date
+
+# "stat" names a value from milestone_stats(); a rule unlocks once that value
+# is >= "at_least" or <= "at_most". Titles and descriptions may use the stats
+# as format fields.
+MILESTONES = [
+    {"id": "first_log", "stat": "count", "at_least": 1,
+     "title": "First Step", "description": "Logged your first weight", "icon": "flag"},
+    {"id": "week_streak", "stat": "streak", "at_least": 7,
+     "title": "Weekly Warrior", "description": "7 consecutive days of logging", "icon": "calendar-check"},
+    {"id": "month_streak", "stat": "streak", "at_least": 30,
+     "title": "Habit Formed", "description": "30 consecutive days of logging", "icon": "calendar-days"},
+    {"id": "goal_reached", "stat": "goal_distance", "at_most": 0.5,
+     "title": "Goal Achieved!", "description": "Reached target weight", "icon": "trophy"},
+    {"id": "5kg_change", "stat": "total_change", "at_least": 5,
+     "title": "5kg {direction}!", "description": "Successfully {direction} 5 kilograms", "icon": "weight-scale"},
+    {"id": "10kg_change", "stat": "total_change", "at_least": 10,
+     "title": "10kg {direction}!", "description": "Successfully {direction} 10 kilograms", "icon": "medal"},
+]
+
+
+def empty_state():
+    return {
+        "count": 0,
+        "first_weight": None,
+        "last_weight": None,
+        "min_weight": None,
+        "max_weight": None,
+        "last_day": None,
+        "streak": 0,
+        "longest_streak": 0,
+        "unlocked": {},
+    }
+
+
+def build_state(history, milestones=()):
+    """State for a whole history; milestones already awarded stay unlocked."""
+    state = empty_state()
+    for ts, weight in zip(history["ts"], history["weight"]):
+        _add_weigh_in(state, ts, weight)
+    for milestone in milestones:
+        state["unlocked"].setdefault(milestone["id"], None)
+    return state
+
+
+def update_milestones(state, history, milestones=()):
+    """Fold the newest entry of `history` into `state` (O(1))."""
+    count = len(history["ts"])
+    if not state or state.get("count") != count - 1:
+        return build_state(history, milestones)
+    # Work on a copy; the stored state may still be waiting to be flushed
+    state = dict(state, unlocked=dict(state["unlocked"]))
+    _add_weigh_in(state, history["ts"][-1], history["weight"][-1])
+    return state
+
+
+def _add_weigh_in(state, ts, weight):
+    day = date.fromtimestamp(ts).toordinal()
+    if state["last_day"] is None or day > state["last_day"] + 1:
+        state["streak"] = 1
+    elif day == state["last_day"] + 1:
+        state["streak"] += 1
+    # Several weigh-ins on one day leave the streak as it is
+    state["last_day"] = day
+    state["longest_streak"] = max(state["longest_streak"], state["streak"])
+
+    if state["count"] == 0:
+        state["first_weight"] = state["min_weight"] = state["max_weight"] = weight
+    else:
+        state["min_weight"] = min(state["min_weight"], weight)
+        state["max_weight"] = max(state["max_weight"], weight)
+    state["last_weight"] = weight
+    state["count"] += 1
+
+
+def current_streak(state, today=None):
+    """The streak as of today: it is still alive if the last weigh-in was
+    today or yesterday."""
+    if not state or state["last_day"] is None:
+        return 0
+    today = (today or date.today()).toordinal()
+    return state["streak"] if today - state["last_day"] <= 1 else 0
+
+
+def milestone_stats(state, target_weight=None):
+    change = state["last_weight"] - state["first_weight"] if state["count"] else 0.0
+    return {
+        "count": state["count"],
+        "streak": state["streak"],
+        "longest_streak": state["longest_streak"],
+        "total_change": abs(change),
+        "direction": "lost" if change < 0 else "gained",
+        "goal_distance": abs(state["last_weight"] - target_weight)
+                         if target_weight and state["count"] else None,
+    }
+
+
+def check_rules(state, target_weight=None, now=None, rules=MILESTONES):
+    """Unlock the rules `state` now satisfies; returns the new milestones."""
+    stats = milestone_stats(state, target_weight)
+    unlocked = []
+    for rule in rules:
+        if rule["id"] in state["unlocked"]:
+            continue
+        value = stats[rule["stat"]]
+        if value is None:
+            continue
+        if "at_least" in rule and value < rule["at_least"]:
+            continue
+        if "at_most" in rule and value > rule["at_most"]:
+            continue
+        state["unlocked"][rule["id"]] = now
+        unlocked.append({
+            "id": rule["id"],
+            "title": rule["title"].format(**stats),
+            "description": rule["description"].format(**stats),
+            "icon": rule["icon"],
+        })
+    return unlocked
@@ -0,0 +1,85 @@
+# =========================
+# Pantry structure
+# =========================
+# A user's groceries are stored as plain JSON-friendly data:
+#
+#   {"items":   {"<id>": {"id", "name", "quantity", "unit", "added_at", ...}},
+#    "by_name": {"<name>": "<id>"},
+#    "names":   ["<name>", ...],        # kept sorted
+#    "version": <int>}                  # changes whenever "names" does
+#
+# "items" keeps insertion order, "by_name" makes lookups and merges O(1)
+# and "names" is the sorted view used for prompts and matching. "version"
+# is the XOR of a stable hash of every name: adding or removing a name
+# updates it in O(1), and the same names always give the same version, also
+# for a pantry rebuilt from rows, so it can key per-pantry caches. Detecting an
+# ingredient that is already there adds to its quantity instead of adding a
+# second entry, so the pantry holds one entry per ingredient.
+import hashlib
+from bisect import bisect_left, insort
+
+
+def empty_pantry():
+    return {"items": {}, "by_name": {}, "names": [], "version": 0}
+
+
+def name_hash(name):
+    return int.from_bytes(hashlib.blake2b(name.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def pantry_version(pantry):
+    """Version of the pantry's names; filled in for pantries saved before it existed."""
+    if "version" not in pantry:
+        version = 0
+        for name in pantry["names"]:
+            version ^= name_hash(name)
+        pantry["version"] = version
+    return pantry["version"]
+
+
+def as_pantry(value):
+    """Return `value` as a pantry; legacy lists are merged by name."""
+    if isinstance(value, dict):
+        return value
+    pantry = empty_pantry()
+    for item in value or []:
+        pantry_add(pantry, item, updated_at=item.get("added_at"))
+    return pantry
+
+
+def pantry_add(pantry, item, updated_at=None):
+    """Insert `item`, or add its quantity to the entry with the same name."""
+    item_id = pantry["by_name"].get(item["name"])
+    if item_id is not None:
+        existing = pantry["items"][item_id]
+        existing["quantity"] = (existing.get("quantity") or 1) + (item.get("quantity") or 1)
+        existing["updated_at"] = updated_at or item.get("added_at")
+        return existing
+    # Copy: the caller's item may also sit in a change record still to be saved
+    item = dict(item, quantity=item.get("quantity") or 1)
+    pantry["version"] = pantry_version(pantry) ^ name_hash(item["name"])
+    pantry["items"][item["id"]] = item
+    pantry["by_name"][item["name"]] = item["id"]
+    insort(pantry["names"], item["name"])
+    return item
+
+
+def pantry_remove(pantry, item_id):
+    item = pantry["items"].pop(item_id, None)
+    if item is None:
+        return None
+    pantry["version"] = pantry_version(pantry) ^ name_hash(item["name"])
+    del pantry["by_name"][item["name"]]
+    names = pantry["names"]
+    del names[bisect_left(names, item["name"])]
+    return item
+
+
+def pantry_lookup(pantry, name):
+    item_id = pantry["by_name"].get(name)
+    return pantry["items"][item_id] if item_id is not None else None
+
+
+def pantry_items(pantry):
+    """Entries in the order they were first added."""
+    return list(pantry["items"].values())
@@ -0,0 +1,105 @@
+# =========================
+# Prompt templates
+# =========================
+# A PromptTemplate is compiled once at import:
+#   - the static instructions become the system message, sent first and
+#     byte-for-byte the same on every call, so the provider can reuse its
+#     cached prefix
+#   - the per-call part is split into literal text and {fields} once, so
+#     rendering is a join
+#   - indentation, trailing spaces and runs of blank lines are stripped
+#     from both, since each of them costs tokens
+# render() counts the tokens of the result and clips the fields listed in
+# `clip` (longest first) when the per-call part is over its budget.
+# PromptMetrics records estimated, billed and cached prompt tokens per
+# endpoint, from the `usage` the API returns.
+import re
+import string
+import textwrap
+import threading
+
+from conversation import CHARS_PER_TOKEN, count_tokens
+
+BLANK_LINES_RE = re.compile(r"\n{3,}")
+
+
+def compact(text):
+    lines = [line.strip() for line in textwrap.dedent(text).splitlines()]
+    return BLANK_LINES_RE.sub("\n\n", "\n".join(lines)).strip()
+
+
+class PromptTemplate:
+    def __init__(self, name, system, user, budget=None, clip=()):
+        self.name = name
+        self.system = compact(system)
+        self.system_tokens = count_tokens(self.system)
+        self.pieces = [
+            (literal, field)
+            for literal, field, _, _ in string.Formatter().parse(compact(user))
+        ]
+        self.budget = budget  # tokens for the per-call part, None = unlimited
+        self.clip = clip
+
+    def _join(self, values):
+        parts = []
+        for literal, field in self.pieces:
+            parts.append(literal)
+            if field is not None:
+                parts.append(values[field])
+        return "".join(parts)
+
+    def render(self, **values):
+        """(messages, estimated prompt tokens, clipped) for one call."""
+        values = {key: str(value) for key, value in values.items()}
+        user = self._join(values)
+        clipped = False
+        if self.budget is not None and count_tokens(user) > self.budget:
+            over = (count_tokens(user) - self.budget) * CHARS_PER_TOKEN
+            for field in sorted(self.clip, key=lambda f: -len(values[f])):
+                cut = min(over, len(values[field]))
+                values[field] = values[field][:len(values[field]) - cut].rstrip() + "…"
+                over -= cut
+                if over <= 0:
+                    break
+            user = self._join(values)
+            clipped = True
+        messages = [
+            {"role": "system", "content": self.system},
+            {"role": "user", "content": user},
+        ]
+        return messages, self.system_tokens + count_tokens(user), clipped
+
+
+class PromptMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def record(self, endpoint, estimated_tokens, usage=None, clipped=False):
+        prompt_tokens = getattr(usage, "prompt_tokens", None) or 0
+        completion_tokens = getattr(usage, "completion_tokens", None) or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", None) or 0
+        with self.lock:
+            counters = self.endpoints.setdefault(endpoint, {
+                "calls": 0, "estimated_tokens": 0, "prompt_tokens": 0,
+                "cached_tokens": 0, "completion_tokens": 0, "clipped": 0,
+            })
+            counters["calls"] += 1
+            counters["estimated_tokens"] += estimated_tokens
+            counters["prompt_tokens"] += prompt_tokens
+            counters["cached_tokens"] += cached_tokens
+            counters["completion_tokens"] += completion_tokens
+            counters["clipped"] += int(clipped)
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            for endpoint, counters in self.endpoints.items():
+                billed = counters["prompt_tokens"]
+                stats[endpoint] = dict(
+                    counters,
+                    avg_prompt_tokens=round((billed or counters["estimated_tokens"]) / counters["calls"], 1),
+                    cached_ratio=round(counters["cached_tokens"] / billed, 4) if billed else 0.0,
+                )
+            return stats
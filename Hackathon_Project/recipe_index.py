@@ -0,0 +1,149 @@
+# =========================
+# Local recipe index
+# =========================
+# The bundled corpus (recipes.json) is indexed by ingredient: each normalized
+# ingredient name maps to the ids of the recipes that use it. A search counts,
+# for every pantry item, the recipes in its posting list; hits divided by the
+# recipe's ingredient count is the share of the recipe the user can make.
+# The built index is pickled so a restart does not have to rebuild it; the
+# pickle records a fingerprint of the normalizer it was built with, so
+# changing normalize_ingredient rebuilds it too.
+import hashlib
+import heapq
+import json
+import os
+import pickle
+import threading
+import time
+from collections import Counter
+
+# Assumed to be in every kitchen, so they never count as missing
+STAPLES = frozenset({"salt", "oil", "water"})
+INDEX_VERSION = 2  # bump when the pickled layout changes
+
+
+class RecipeIndex:
+    def __init__(self, recipes, normalize, staples=STAPLES):
+        self.recipes = recipes
+        self.required = []  # recipe id -> frozenset of non-staple ingredients
+        self.tags = []      # recipe id -> frozenset of dietary tags
+        postings = {}
+        for recipe_id, recipe in enumerate(recipes):
+            names = frozenset(normalize(i["name"]) for i in recipe["ingredients"]) - staples
+            self.required.append(names)
+            self.tags.append(frozenset(recipe.get("tags", [])))
+            for name in names:
+                postings.setdefault(name, []).append(recipe_id)
+        self.postings = {name: tuple(ids) for name, ids in postings.items()}
+        self.lock = threading.Lock()
+        self.searches = 0
+        self.search_us = 0.0
+
+    def search(self, pantry, requested=(), constraints=(), k=3, min_coverage=0.0):
+        """Top-k recipes by coverage of `pantry` (normalized names).
+
+        Every recipe returned uses all `requested` ingredients and carries all
+        `constraints` as tags. Each result is the corpus entry plus
+        "coverage" (0..1) and "missing" (ingredients not in the pantry).
+        """
+        started = time.perf_counter()
+        pantry = set(pantry)
+        hits = Counter()
+        for name in pantry:
+            for recipe_id in self.postings.get(name, ()):
+                hits[recipe_id] += 1
+
+        candidates = hits.keys()
+        for name in requested:
+            candidates = candidates & set(self.postings.get(name, ()))
+
+        scored = []
+        for recipe_id in candidates:
+            if constraints and not self.tags[recipe_id].issuperset(constraints):
+                continue
+            coverage = hits[recipe_id] / len(self.required[recipe_id])
+            if coverage >= min_coverage:
+                # Full coverage first, then the recipes using the most pantry items
+                scored.append((coverage, hits[recipe_id], -recipe_id))
+        best = heapq.nlargest(k, scored)
+
+        results = []
+        for coverage, _, neg_id in best:
+            recipe_id = -neg_id
+            missing = sorted(self.required[recipe_id] - pantry)
+            results.append(dict(self.recipes[recipe_id], coverage=round(coverage, 3), missing=missing))
+        elapsed_us = (time.perf_counter() - started) * 1e6
+        with self.lock:
+            self.searches += 1
+            self.search_us += elapsed_us
+        return results
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "recipes": len(self.recipes),
+                "ingredients": len(self.postings),
+                "searches": self.searches,
+                "avg_search_us": round(self.search_us / self.searches, 1) if self.searches else 0.0,
+            }
+
+
+def normalizer_fingerprint(normalize):
+    """Hash of the normalizer's code and of the module functions it calls."""
+    digest = hashlib.sha1()
+    seen = set()
+
+    def feed(code, scope):
+        digest.update(code.co_code)
+        digest.update(repr(code.co_names).encode())
+        for const in code.co_consts:
+            if hasattr(const, "co_code"):
+                feed(const, scope)
+            else:
+                digest.update(repr(const).encode())
+        for name in code.co_names:
+            helper = getattr(scope.get(name), "__code__", None)
+            if helper is not None and name not in seen:
+                seen.add(name)
+                feed(helper, scope)
+
+    code = getattr(normalize, "__code__", None)
+    if code is None:
+        digest.update(getattr(normalize, "__qualname__", type(normalize).__name__).encode())
+    else:
+        feed(code, getattr(normalize, "__globals__", {}))
+    return digest.hexdigest()[:16]
+
+
+def load_recipe_index(corpus_path, cache_path, normalize):
+    """Unpickle the index when it is newer than the corpus and was built with
+    the same normalizer, else rebuild it."""
+    fingerprint = normalizer_fingerprint(normalize)
+    if cache_path and os.path.exists(cache_path) \
+            and os.path.getmtime(cache_path) >= os.path.getmtime(corpus_path):
+        try:
+            with open(cache_path, "rb") as f:
+                version, built_with, index = pickle.load(f)
+            if version == INDEX_VERSION and built_with == fingerprint:
+                index.searches, index.search_us = 0, 0.0
+                return index
+        except Exception as e:
+            print("Recipe index cache ignored:", e)
+
+    with open(corpus_path, encoding="utf-8") as f:
+        index = RecipeIndex(json.load(f), normalize)
+    if cache_path:
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump((INDEX_VERSION, fingerprint, index), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    return index
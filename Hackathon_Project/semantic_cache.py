@@ -0,0 +1,174 @@
+# =========================
+# Near-duplicate answer reuse
+# =========================
+# Previously answered questions are kept as TF-IDF vectors so a paraphrase of
+# an earlier question ("is rice healthy" / "is white rice healthy to eat")
+# can reuse the stored answer instead of a new GPT call.
+#
+# Term counts come from a HashingVectorizer, which has no fitted vocabulary,
+# so new questions are added without refitting; document frequencies are
+# kept alongside and IDF weights are applied at query time.
+#
+# Words in `keep_apart` (negations, question words) carry little TF-IDF
+# weight once they are common, so a question only matches stored ones that
+# use exactly the same of them: "is sugar bad" never reuses the answer to
+# "is sugar not bad". A saved index built with another analyzer (a
+# different `signature`) is not loaded.
+import atexit
+import os
+import pickle
+import threading
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.preprocessing import normalize
+
+
+class AnswerIndex:
+    def __init__(self, analyzer, path=None, threshold=0.85, max_entries=5000,
+                 n_features=2 ** 18, save_every=20, keep_apart=(), signature=None):
+        self.analyzer = analyzer
+        self.keep_apart = frozenset(keep_apart)
+        self.signature = signature
+        self.path = path
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.save_every = save_every
+        self.vectorizer = HashingVectorizer(
+            analyzer=analyzer, n_features=n_features,
+            alternate_sign=False, norm=None,
+        )
+        self.lock = threading.Lock()
+        self.counts = sp.csr_matrix((0, n_features), dtype=np.float64)
+        self.pending_rows = []  # rows added since the matrix was last stacked
+        self.doc_freq = np.zeros(n_features, dtype=np.int64)
+        self.questions = []
+        self.answers = []
+        self.buckets = []
+        self.markers = []  # keep_apart words of each question
+        self.weighted = None  # cached L2-normalized TF-IDF matrix
+        self.unsaved = 0
+        self.hits = 0
+        self.misses = 0
+        if path and os.path.exists(path):
+            self.load()
+        atexit.register(self.save)
+
+    # ---- lookups ----
+    def lookup(self, question, bucket):
+        """Return (answer, similarity) of the closest match above threshold."""
+        query = self.vectorizer.transform([question])
+        marker = self._marker(question)
+        with self.lock:
+            if query.nnz == 0 or not self.questions:
+                self.misses += 1
+                return None, 0.0
+            matrix = self._weighted_matrix()
+            query = normalize(query.multiply(self._idf()).tocsr())
+            scores = (matrix @ query.T).toarray().ravel()
+            # Answers are personalised, only reuse them within the same bucket
+            scores[np.asarray(self.buckets) != bucket] = 0.0
+            scores[[m != marker for m in self.markers]] = 0.0
+            best = int(scores.argmax())
+            if scores[best] < self.threshold:
+                self.misses += 1
+                return None, float(scores[best])
+            self.hits += 1
+            return self.answers[best], float(scores[best])
+
+    def _marker(self, question):
+        return self.keep_apart.intersection(self.analyzer(question))
+
+    def _idf(self):
+        n_docs = len(self.questions)
+        return np.log((1 + n_docs) / (1 + self.doc_freq)) + 1.0
+
+    def _stack_pending(self):
+        if self.pending_rows:
+            self.counts = sp.vstack([self.counts] + self.pending_rows, format="csr")
+            self.pending_rows = []
+
+    def _weighted_matrix(self):
+        if self.weighted is None:
+            self._stack_pending()
+            self.weighted = normalize(self.counts.multiply(self._idf()).tocsr())
+        return self.weighted
+
+    # ---- updates ----
+    def add(self, question, bucket, answer):
+        row = self.vectorizer.transform([question]).tocsr()
+        if row.nnz == 0:
+            return
+        with self.lock:
+            self.pending_rows.append(row)
+            self.doc_freq[row.indices] += 1
+            self.questions.append(question)
+            self.answers.append(answer)
+            self.buckets.append(bucket)
+            self.markers.append(self._marker(question))
+            if len(self.questions) > self.max_entries:
+                self._evict_oldest(len(self.questions) - self.max_entries)
+            self.weighted = None
+            self.unsaved += 1
+            save_now = self.unsaved >= self.save_every
+        if save_now:
+            self.save()
+
+    def _evict_oldest(self, count):
+        self._stack_pending()
+        dropped = self.counts[:count]
+        self.doc_freq[dropped.indices] -= 1
+        self.counts = self.counts[count:]
+        del self.questions[:count]
+        del self.answers[:count]
+        del self.buckets[:count]
+        del self.markers[:count]
+
+    # ---- persistence ----
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            if not self.unsaved:
+                return
+            self._stack_pending()
+            state = {
+                "counts": self.counts,
+                "doc_freq": self.doc_freq,
+                "questions": self.questions,
+                "answers": self.answers,
+                "buckets": self.buckets,
+                "signature": self.signature,
+            }
+            tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.path)
+            self.unsaved = 0
+
+    def load(self):
+        with open(self.path, "rb") as f:
+            state = pickle.load(f)
+        if state["counts"].shape[1] != self.counts.shape[1]:
+            print("Answer index ignored: feature size changed")
+            return
+        if state.get("signature") != self.signature:
+            print("Answer index ignored: built with another analyzer")
+            return
+        self.counts = state["counts"]
+        self.doc_freq = state["doc_freq"]
+        self.questions = state["questions"]
+        self.answers = state["answers"]
+        self.buckets = state["buckets"]
+        self.markers = [self._marker(q) for q in self.questions]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.questions),
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
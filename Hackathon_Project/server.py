@@ -5,60 +5,139 @@
 
 # Import Libraries
 import random
-from flask import Flask, request, jsonify, render_template, redirect, url_for, flash, session
+from flask import Flask, Response, current_app, request, jsonify, render_template, redirect, url_for, flash, session, stream_with_context
 import re
 import os
 import json
 import base64
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from uuid import uuid4
 from datetime import datetime
-import nltk
-from nltk.corpus import stopwords
 from dotenv import load_dotenv
-from openai import OpenAI
+from text_match import Tokenizer, IngredientMatcher
+from stop_words import QUESTION_STOPWORDS, QUESTION_WORDS
+from conversation import empty_memory, current_memory, add_exchange, context_messages, has_context, memory_tokens, count_tokens
+from prompts import PromptTemplate, PromptMetrics
+from llm_client import LLMClient
+from single_flight import SingleFlight, request_key
+from caching import LRUCache
+from jobs import JobQueue
+from vision_cache import VisionCache, sha256_bytes, perceptual_hash
+from image_prep import ImagePreparer
+from recipe_index import load_recipe_index
+from pantry import empty_pantry, pantry_items, pantry_version
+from weight_series import empty_history, history_entries, chart_points
+from weight_trends import compute_trends, update_trends, trend_summary
+from milestones import build_state, update_milestones, check_rules, current_streak
+from health_metrics import profile_metrics, recompute_store
+from storage import open_store, migrate, apply_change, JsonStore, SqliteStore, CachedStore, JournalStore
 
 # =========================
 # Setup
 # =========================
+# Routes, request hooks and CLI commands are collected here and registered
+# on the app by create_app() at the bottom of this file
+routes = []
+before_request_hooks = []
+cli_commands = []
 
-nltk.download("stopwords")
+def route(rule, **options):
+    def register(view):
+        routes.append((rule, options, view))
+        return view
+    return register
 
-app = Flask(__name__)
-app.secret_key = "super-secret-key"
+def before_request(hook):
+    before_request_hooks.append(hook)
+    return hook
+
+def cli_command(name):
+    def register(command):
+        cli_commands.append((name, command))
+        return command
+    return register
 
 
 # =========================
-# JSON DB config
+# DB config
 # =========================
-DB_FILE = "db_groceries.json"
+DB_FILE = "db_groceries.json"  # Legacy JSON database
+SQLITE_FILE = os.getenv("NUTRIBOT_SQLITE_FILE", "db_nutribot.sqlite3")
+STORE_BACKEND = os.getenv("NUTRIBOT_STORE", "sqlite")  # "sqlite", "json" or "journal"
+JOURNAL_FILE = os.getenv("NUTRIBOT_JOURNAL_FILE", "db_groceries.journal")  # Used with "journal"
+# Write-behind cache: flush dirty users every N seconds or after N mutations;
+# keeps at most CACHE_MAX_USERS users, least recently used go first
+CACHE_ENABLED = os.getenv("NUTRIBOT_CACHE", "1") == "1"
+FLUSH_INTERVAL = float(os.getenv("NUTRIBOT_FLUSH_INTERVAL", "5"))
+FLUSH_EVERY = int(os.getenv("NUTRIBOT_FLUSH_EVERY", "100"))
+CACHE_MAX_USERS = int(os.getenv("NUTRIBOT_CACHE_MAX_USERS", "10000"))
+# Set only when exactly one server process uses the data files: it allows
+# the write-behind cache and the journal backend, which keep users in
+# process memory. Without it several workers (gunicorn -w N) are assumed.
+SINGLE_PROCESS = os.getenv("NUTRIBOT_SINGLE_PROCESS", "0") == "1"
+# Session cookies are signed, so all workers need the same key: set
+# NUTRIBOT_SECRET_KEY, or one is generated on first start and kept here
+SECRET_KEY_FILE = os.getenv("NUTRIBOT_SECRET_KEY_FILE", "secret_key")
 UPLOAD_FOLDER = "static/uploads"
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg"}
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 # =========================
-# JSON DB functions
+# DB functions
 # =========================
-# Loading Database
-def load_db():
-    if not os.path.exists(DB_FILE):
-        return {"users": {}}
-    with open(DB_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
-# Save Database to Json
-def save_db(db):
-    with open(DB_FILE, "w", encoding="utf-8") as f:
-        json.dump(db, f, indent=2)
+# Settings create_app(config) can override; defaults from the environment
+def load_config():
+    return {
+        "SECRET_KEY": os.getenv("NUTRIBOT_SECRET_KEY"),  # None: shared_secret_key()
+        "DEBUG": os.getenv("NUTRIBOT_DEBUG", "0") == "1",
+        "SINGLE_PROCESS": SINGLE_PROCESS,
+        "STORE_BACKEND": STORE_BACKEND,
+        "DB_FILE": DB_FILE,
+        "SQLITE_FILE": SQLITE_FILE,
+        "JOURNAL_FILE": JOURNAL_FILE,
+        "CACHE_ENABLED": CACHE_ENABLED,
+    }
+
+store = None
+store_config = load_config()  # replaced by create_app()
+# Shared clients are created once per process even when the first requests
+# arrive together
+setup_lock = threading.RLock()
+# Open the configured storage backend once
+def get_store():
+    global store
+    if store is None:
+        with setup_lock:
+            if store is None:
+                config = store_config
+                opened = open_store(config["STORE_BACKEND"], config["DB_FILE"],
+                                    config["SQLITE_FILE"], config["JOURNAL_FILE"])
+                # Another process's cache would not see this one's writes
+                if config["CACHE_ENABLED"] and config["SINGLE_PROCESS"]:
+                    opened = CachedStore(opened, FLUSH_INTERVAL, FLUSH_EVERY, CACHE_MAX_USERS)
+                store = opened
+    return store
 # Return user if exist
-def get_user(db, user_name):
-    return db.get("users", {}).get(user_name)
+def get_user(user_name):
+    return get_store().get_user(user_name)
+# Save one user record
+def save_user(user_name, user):
+    get_store().put_user(user_name, user)
+# Apply small changes to the user in memory only
+def apply_changes(user, changes):
+    for change in changes:
+        apply_change(user, change)
+# Apply small changes to the user and persist only those changes
+def save_changes(user_name, user, changes):
+    apply_changes(user, changes)
+    get_store().commit_changes(user_name, changes)
 # Create new user
-def create_user(db, user_name, password):
-    if "users" not in db:
-        db["users"] = {}
-    if user_name in db["users"]:
-        return False
+def create_user(user_name, password):
     # User database 
-    db["users"][user_name] = {
+    user = {
         "password": password,
         "profile": {
             "age": None,
@@ -77,20 +156,22 @@ def create_user(db, user_name, password):
             "target_weight": None,   
             "goal": None,            # "lose", "maintain", or "gain"
         },
-        "groceries": [],
+        "groceries": empty_pantry(),  # see pantry.py
         "images": [],
         # NEW: Weight Journey Tracking
-        "weight_history": [],  # Array of weight entries
+        "weight_history": empty_history(),  # Columnar weigh-ins, see weight_series.py
         "goals": {
             "active_goal": None,
             "goal_start_date": None,
             "target_date": None,
             "weekly_target": None  # kg per week
         },
+        "trends": None,  # Weight trend aggregates, see weight_trends.py
         "milestones": [],  # Achievements unlocked
-        "chat_history": []  # Store motivational conversations
+        "milestone_state": None,  # Streaks and weight extremes, see milestones.py
+        "chat_history": empty_memory()  # Recent turns + rolling summary, see conversation.py
     }
-    return True
+    return get_store().create_user(user_name, user)
 # Login helper
 def require_login():
     user_name = session.get("user_name")
@@ -103,57 +184,201 @@ def format_time(dt=None):
     if dt is None:
         dt = datetime.now()
     return dt.strftime("%d/%m %H:%M")
-# Image Adding
-def add_image_record(user, image_path, ingredients):
-    user["images"].append({
-        "id": str(uuid4()),
+# Image Adding (returns the change to save); jobs pass their own record id
+def add_image_record(image_path, ingredients, sha256=None, phash=None, record_id=None):
+    return {"op": "append", "field": "images", "item": {
+        "id": record_id or str(uuid4()),
         "image_path": image_path,
         "detected_items": ingredients,
-        "uploaded_at": format_time()
-    })
-# Grocery Item Adding
-def add_grocery_items(user, ingredients):
+        "uploaded_at": format_time(),
+        "sha256": sha256,
+        "phash": phash
+    }}
+# Grocery Item Adding (returns the changes to save); ingredients already in
+# the pantry only get their quantity increased
+def add_grocery_items(ingredients):
     now = format_time()
-    for name in ingredients:
-        user["groceries"].append({
-            "id": str(uuid4()),
-            "name": name,
-            "quantity": None,
-            "unit": None,
-            "added_at": now
-        })
+    return [{"op": "pantry_add", "item": {
+        "id": str(uuid4()),
+        "name": name,
+        "quantity": 1,
+        "unit": None,
+        "added_at": now
+    }} for name in ingredients]
 # Validate Uploaded file
 def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
-# User info collection
-userInputHistory = []
-userInformationDatabase = {"age": None, "height": None, "weight": None, "gender": None}
+# Preprocessing with tokenize: stopwords go, negations and question words stay
+question_tokenizer = Tokenizer(QUESTION_STOPWORDS)
+def question_tokenize(text):
+    return question_tokenizer.tokenize(text)
 
-# Preprocessing with tokenize
-def simple_tokenize(text):
-    tokens = re.findall(r"\b\w+\b", text.lower())
-    filtered = [t for t in tokens if t not in set(stopwords.words("english"))]
-    return filtered
-
-# Initialize the client once load env 
+# Load env; the OpenAI client is created on first use because importing
+# the openai package takes about half a second
 load_dotenv()
-print("Loaded key:", os.getenv("OPENAI_API_KEY"))
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+client = None
+def get_client():
+    global client
+    if client is None:
+        from openai import OpenAI
+        if not os.getenv("OPENAI_API_KEY"):
+            print("OPENAI_API_KEY is not set; OpenAI calls will fail")
+        # Retries are done by the LLM layer below, within each call's deadline
+        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+    return client
+
+# Deadlines, retries, circuit breaker and a cap on concurrent calls for
+# every OpenAI call, see llm_client.py
+LLM_TIMEOUT = float(os.getenv("NUTRIBOT_LLM_TIMEOUT", "20"))  # seconds per call, retries included
+LLM_MAX_RETRIES = int(os.getenv("NUTRIBOT_LLM_RETRIES", "2"))
+LLM_MAX_IN_FLIGHT = int(os.getenv("NUTRIBOT_LLM_MAX_IN_FLIGHT", "8"))
+LLM_BREAKER_FAILURES = int(os.getenv("NUTRIBOT_LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET = float(os.getenv("NUTRIBOT_LLM_BREAKER_RESET", "30"))  # seconds
+llm = None
+def get_llm():
+    global llm
+    if llm is None:
+        with setup_lock:
+            if llm is None:
+                llm = LLMClient(
+                    get_client,
+                    timeout=LLM_TIMEOUT,
+                    max_retries=LLM_MAX_RETRIES,
+                    failure_threshold=LLM_BREAKER_FAILURES,
+                    reset_timeout=LLM_BREAKER_RESET,
+                    max_in_flight=LLM_MAX_IN_FLIGHT,
+                )
+    return llm
+
+# Identical requests in flight at the same time share one API call, see
+# single_flight.py; with a file, worker processes share them too
+SINGLE_FLIGHT_FILE = os.getenv("NUTRIBOT_SINGLE_FLIGHT_FILE")  # e.g. "db_flights.sqlite3"; unset = per process
+SINGLE_FLIGHT_LEASE = float(os.getenv("NUTRIBOT_SINGLE_FLIGHT_LEASE", "60"))  # seconds
+flights = SingleFlight(SINGLE_FLIGHT_FILE, lease=SINGLE_FLIGHT_LEASE)
 
-def generate_gpt_reply(user_message):
-    """Enhanced GPT prompt with user profile data"""
-    
-    print(f"\n=== GPT FUNCTION DEBUG ===")
-    print(f"Input: '{user_message}'")
-    print(f"Session user_name: {session.get('user_name')}")
-    
-    # Get user profile data
+# =========================
+# GPT response cache
+# =========================
+RESPONSE_CACHE_SIZE = int(os.getenv("NUTRIBOT_RESPONSE_CACHE_SIZE", "1024"))
+RESPONSE_CACHE_TTL = float(os.getenv("NUTRIBOT_RESPONSE_CACHE_TTL", "21600"))  # 6 hours
+response_cache = LRUCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
+# Coarse profile bucket so similar users share cached answers
+def profile_bucket(user_profile):
+    if not user_profile:
+        return "anonymous"
+    age = user_profile.get("age")
+    if age is None:
+        age_band = "unknown"
+    elif age < 18:
+        age_band = "under18"
+    elif age >= 60:
+        age_band = "60plus"
+    else:
+        decade = int(age) // 10 * 10
+        age_band = f"{decade}s"
+    bmi_category = user_profile.get("bmi_category") or "unknown"
+    gender = (user_profile.get("gender") or "unknown").lower()
+    return f"{age_band}|{bmi_category}|{gender}"
+
+# Cache key: normalized question + profile bucket (None = don't cache)
+def response_cache_key(user_message, user_profile):
+    tokens = question_tokenize(user_message)
+    if not tokens:
+        return None
+    return f"{' '.join(tokens)}#{profile_bucket(user_profile)}"
+
+# Paraphrases of earlier questions reuse their answer (TF-IDF cosine similarity)
+SEMANTIC_INDEX_FILE = os.getenv("NUTRIBOT_SEMANTIC_INDEX", "semantic_index.pkl")
+SEMANTIC_THRESHOLD = float(os.getenv("NUTRIBOT_SEMANTIC_THRESHOLD", "0.85"))
+answer_index = None
+def get_answer_index():
+    global answer_index
+    if answer_index is None:
+        from semantic_cache import AnswerIndex  # pulls in scikit-learn
+        answer_index = AnswerIndex(
+            question_tokenize, SEMANTIC_INDEX_FILE, SEMANTIC_THRESHOLD,
+            keep_apart=QUESTION_WORDS, signature=question_tokenizer.signature,
+        )
+    return answer_index
+
+# Exact cache first, then a near-duplicate question; returns (cache_key, reply or None).
+# Cached answers were given without earlier turns, so a follow-up in a
+# conversation (which may lean on them) is never answered from the caches.
+def find_cached_reply(user_message, user_profile, memory):
+    if has_context(memory):
+        return None, None
+    cache_key = response_cache_key(user_message, user_profile)
+    if cache_key:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            print("Response cache hit")
+            return cache_key, cached
+    answer, score = get_answer_index().lookup(user_message, profile_bucket(user_profile))
+    if answer is not None:
+        print(f"Similar question answered before (similarity {score:.2f})")
+        if cache_key:
+            response_cache.set(cache_key, answer)
+    return cache_key, answer
+
+# Store a fresh GPT answer in both caches
+def remember_reply(user_message, user_profile, cache_key, reply):
+    if cache_key:
+        response_cache.set(cache_key, reply)
+    get_answer_index().add(user_message, profile_bucket(user_profile), reply)
+
+# Conversation memory: recent turns are sent with each GPT question and
+# folded into a short summary once they no longer fit the budget
+CHAT_CONTEXT_TOKENS = int(os.getenv("NUTRIBOT_CHAT_CONTEXT_TOKENS", "600"))
+CHAT_MAX_TURNS = int(os.getenv("NUTRIBOT_CHAT_MAX_TURNS", "12"))
+CHAT_SUMMARY_TOKENS = int(os.getenv("NUTRIBOT_CHAT_SUMMARY_TOKENS", "150"))
+CHAT_IDLE_RESET = float(os.getenv("NUTRIBOT_CHAT_IDLE_RESET", "1800"))  # seconds
+
+# Conversation so far of the logged-in user (empty when logged out or idle)
+def get_chat_memory(user_name):
+    user = get_user(user_name) if user_name else None
+    if not user:
+        return empty_memory()
+    return current_memory(user["chat_history"], CHAT_IDLE_RESET)
+
+def remember_turn(user_name, user_message, reply):
+    user = get_user(user_name) if user_name else None
+    if not user:
+        return
+    memory = add_exchange(current_memory(user["chat_history"], CHAT_IDLE_RESET), user_message, reply,
+                          CHAT_CONTEXT_TOKENS, CHAT_MAX_TURNS, CHAT_SUMMARY_TOKENS)
+    save_changes(user_name, user, [{"op": "set", "field": "chat_history", "value": memory}])
+
+# Saying bye or logging out ends the conversation
+def forget_conversation(user_name):
+    user = get_user(user_name) if user_name else None
+    if user and has_context(user["chat_history"]):
+        save_changes(user_name, user, [{"op": "set", "field": "chat_history", "value": empty_memory()}])
+
+# Static instructions, earlier turns, then the question
+def chat_messages(prompt, memory):
+    context = context_messages(memory)
+    print(f"Conversation context: {len(context)} messages, ~{memory_tokens(memory)} tokens")
+    return prompt[:1] + context + prompt[1:]
+
+# Chat completion arguments; also the single-flight key of the question
+def chat_request(prompt, memory):
+    return {
+        "model": "gpt-3.5-turbo",
+        "messages": chat_messages(prompt, memory),
+        "max_tokens": 200,
+        "temperature": 0.7,
+    }
+
+GPT_FALLBACK_REPLY = "I'd love to help with your nutrition question! For personalized advice, please make sure your profile is complete. In the meantime, here's a general tip: focus on whole foods like fruits, vegetables, lean proteins, and whole grains for a balanced diet! 🍎"
+
+# Completed profile of the logged-in user, or None
+def get_session_profile():
     user_profile = None
     user_name = session.get("user_name")
     if user_name:
-        db = load_db()
-        user = get_user(db, user_name)
+        user = get_user(user_name)
         if user and user["profile"]["completed"]:
             user_profile = user["profile"]
             print(f"User profile found: {user_profile}")
@@ -161,81 +386,213 @@ def generate_gpt_reply(user_message):
             print("User profile not found or not completed")
     else:
         print("No user_name in session")
+    return user_profile
+
+# Prompt sizes and provider cache hits per endpoint, see prompts.py
+prompt_metrics = PromptMetrics()
+
+CHAT_PROMPT_TOKENS = int(os.getenv("NUTRIBOT_CHAT_PROMPT_TOKENS", "400"))  # question + profile
+CHAT_PROMPT = PromptTemplate(
+    "chat",
+    system="""
+        You are NutriBot, a friendly nutrition and health expert chatbot.
+
+        IMPORTANT:
+        - Only answer if this question is related to nutrition, diet, food, health, fitness, or healthy living
+        - If user profile is available, use it to provide personalized advice
+        - If the question is NOT related to these topics, politely decline and redirect back to nutrition/health topics
+        - Otherwise, provide a helpful, evidence-based response about nutrition and health
+    """,
+    user="""
+        {profile_info}
+
+        USER QUESTION: "{message}"
+
+        Your response:
+    """,
+    budget=CHAT_PROMPT_TOKENS,
+    clip=("message",),
+)
+
+# Returns (messages, estimated tokens, clipped)
+def build_gpt_prompt(user_message, user_profile):
+    """Enhanced GPT prompt with user profile data"""
+    
+    print(f"\n=== GPT FUNCTION DEBUG ===")
+    print(f"Input: '{user_message}'")
     
     # Build prompt with user data
     if user_profile:
-        profile_info = f"""
-USER PROFILE:
-- Age: {user_profile['age']}
-- Height: {user_profile['height']} cm
-- Weight: {user_profile['weight']} kg  
-- Gender: {user_profile['gender']}
-"""
+        profile_info = (
+            "USER PROFILE:\n"
+            f"- Age: {user_profile['age']}\n"
+            f"- Height: {user_profile['height']} cm\n"
+            f"- Weight: {user_profile['weight']} kg\n"
+            f"- Gender: {user_profile['gender']}"
+        )
     else:
         profile_info = "USER PROFILE: No profile data available."
         print("Using default profile info")
     
-    prompt = f"""You are NutriBot, a friendly nutrition and health expert chatbot.
-
-{profile_info}
+    messages, tokens, clipped = CHAT_PROMPT.render(profile_info=profile_info, message=user_message)
+    print(f"Prompt: ~{tokens} tokens, {CHAT_PROMPT.system_tokens} of them in the static prefix"
+          + (" (question clipped)" if clipped else ""))
+    return messages, tokens, clipped
 
-USER QUESTION: "{user_message}"
+def generate_gpt_reply(user_message):
+    user_profile = get_session_profile()
+    user_name = session.get("user_name")
+    memory = get_chat_memory(user_name)
+    cache_key, cached = find_cached_reply(user_message, user_profile, memory)
+    if cached is not None:
+        remember_turn(user_name, user_message, cached)
+        return cached
 
-IMPORTANT: 
-- Only answer if this question is related to nutrition, diet, food, health, fitness, or healthy living
-- If user profile is available, use it to provide personalized advice
-- If the question is NOT related to these topics, politely decline and redirect back to nutrition/health topics
-- Otherwise, provide a helpful, evidence-based response about nutrition and health
+    prompt, prompt_tokens, clipped = build_gpt_prompt(user_message, user_profile)
+    request_body = chat_request(prompt, memory)
 
-Your response:"""
-    
-    print(f"Prompt length: {len(prompt)} characters")
-    
-    try:
+    def ask():
         print("Calling OpenAI API...")
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=200,
-            temperature=0.7
-        )
+        response = get_llm().create("chat", **request_body)
+        prompt_metrics.record("chat", prompt_tokens + memory_tokens(memory), response.usage, clipped)
         result = response.choices[0].message.content.strip()
+        # An answer that used earlier turns may not make sense on its own
+        if not has_context(memory):
+            remember_reply(user_message, user_profile, cache_key, result)
+        return result
+
+    try:
+        # Same question, profile and context asked elsewhere right now: wait for that answer
+        result = flights.do(request_key("chat", request_body), ask)
         print(f"OpenAI API success! Response: '{result}'")
+        remember_turn(user_name, user_message, result)
         return result
     except Exception as e:
         print(f"OpenAI API error: {e}")
         print(f"Error type: {type(e)}")
         # Return a fallback response instead of None
-        return "I'd love to help with your nutrition question! For personalized advice, please make sure your profile is complete. In the meantime, here's a general tip: focus on whole foods like fruits, vegetables, lean proteins, and whole grains for a balanced diet! 🍎"
+        return GPT_FALLBACK_REPLY
 
-def ensure_user_profile(user):
-    """Make sure user has the complete profile structure"""
-    if "profile" not in user:
-        user["profile"] = {}
-    
-    # Ensure all profile fields exist
-    profile_fields = [
-        "age", "height", "weight", "gender", "completed",
-        "email", "phone", "country", "bmi", "bmi_category", 
-        "daily_calories", "current_weight", "target_weight", "goal"
-    ]
-    
-    for field in profile_fields:
-        if field not in user["profile"]:
+def generate_gpt_reply_stream(user_message):
+    """Same as generate_gpt_reply but yields the reply token by token"""
+    # Look up the profile now, while the request context (session) is available
+    user_profile = get_session_profile()
+    user_name = session.get("user_name")
+    memory = get_chat_memory(user_name)
+    cache_key, cached = find_cached_reply(user_message, user_profile, memory)
+    if cached is not None:
+        remember_turn(user_name, user_message, cached)
+        return iter([cached])
+    prompt, prompt_tokens, clipped = build_gpt_prompt(user_message, user_profile)
+    request_body = chat_request(prompt, memory)
+
+    def tokens():
+        # Shares answers with generate_gpt_reply: the key leaves out streaming
+        flight = flights.join(request_key("chat", request_body))
+        if not flight.leader:
+            try:
+                result = flight.result()
+            except Exception as e:
+                print(f"OpenAI streaming error: {e}")
+                yield GPT_FALLBACK_REPLY
+                return
+            remember_turn(user_name, user_message, result)
+            yield result
+            return
+        sent_any = False
+        parts = []
+        usage = None
+        try:
+            stream = get_llm().create(
+                "chat_stream",
+                stream=True,
+                stream_options={"include_usage": True},
+                **request_body
+            )
+            for chunk in stream:
+                # Token usage arrives in a last chunk without choices
+                if getattr(chunk, "usage", None):
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                text = chunk.choices[0].delta.content
+                if text:
+                    sent_any = True
+                    parts.append(text)
+                    yield text
+            prompt_metrics.record("chat_stream", prompt_tokens + memory_tokens(memory), usage, clipped)
+            if parts:
+                result = "".join(parts).strip()
+                if not has_context(memory):
+                    remember_reply(user_message, user_profile, cache_key, result)
+                flight.finish(result)
+                remember_turn(user_name, user_message, result)
+        except Exception as e:
+            print(f"OpenAI streaming error: {e}")
+            flight.fail(e)
+            # Only fall back if the user has not seen a partial answer yet
+            if not sent_any:
+                yield GPT_FALLBACK_REPLY
+        finally:
+            # Browser went away mid-answer (or no text came): waiters ask again
+            flight.abandon()
+
+    return tokens()
+
+PROFILE_FIELDS = [
+    "age", "height", "weight", "gender", "completed",
+    "email", "phone", "country", "bmi", "bmi_category", 
+    "daily_calories", "current_weight", "target_weight", "goal"
+]
+
+def missing_profile_fields(user):
+    """Default values of the profile fields an older record lacks"""
+    profile = user.get("profile") or {}
+    values = {}
+    for field in PROFILE_FIELDS:
+        if field not in profile:
             if field == "completed":
-                user["profile"][field] = False
+                values[field] = False
             elif field in ["bmi", "daily_calories"]:
-                user["profile"][field] = None
+                values[field] = None
             elif field in ["age", "height", "weight", "current_weight", "target_weight"]:
-                user["profile"][field] = None
+                values[field] = None
             else:
-                user["profile"][field] = ""
-    
+                values[field] = ""
+    return values
+
+def ensure_user_profile(user_name, user):
+    """Make sure user has the complete profile structure"""
+    # Only write when older records are missing profile fields
+    values = missing_profile_fields(user)
+    if values:
+        save_changes(user_name, user, [{"op": "profile", "values": values}])
     return user
 
-bot_started = False
+# Local intent router (compiled phrase matcher + small classifier); a canned
+# reply needs the higher confidence, anything less unsure goes to GPT
+INTENT_MIN_CONFIDENCE = float(os.getenv("NUTRIBOT_INTENT_CONFIDENCE", "0.5"))
+INTENT_LOCAL_CONFIDENCE = float(os.getenv("NUTRIBOT_INTENT_LOCAL_CONFIDENCE", "0.85"))
+intent_router = None
+def get_intent_router():
+    global intent_router
+    if intent_router is None:
+        from intents import IntentRouter  # pulls in scikit-learn
+        intent_router = IntentRouter(INTENT_MIN_CONFIDENCE, INTENT_LOCAL_CONFIDENCE)
+    return intent_router
+
+# Replies for intents that never need GPT; a yes/no is only answered
+# locally when the bot asked a yes/no question (awaiting_response)
+LOCAL_REPLIES = {
+    "thanks": "You're welcome! Anything else about food or nutrition I can help with? 🥗",
+    "capabilities": "I can answer nutrition and diet questions, suggest recipes from your pantry, and help you set and track a weight goal. Try asking \"what should I eat for breakfast?\" 🍎",
+    "off_topic": "I'm NutriBot, so I stick to nutrition, diet, fitness and healthy living. Ask me anything about those! 🥦",
+}
+
 # Chatbot Responses
-def chatbot_reply(user_message):
+# gpt_reply is called for anything the rules don't answer; the streaming
+# route passes generate_gpt_reply_stream so it gets a token generator back
+def chatbot_reply(user_message, gpt_reply=generate_gpt_reply):
     print(f"\n=== CHATBOT DEBUG ===")
     print(f"Message: '{user_message}'")
     
@@ -246,11 +603,9 @@ def chatbot_reply(user_message):
     # Check if user has completed profile
     user_name = session.get("user_name")
     if user_name:
-        db = load_db()
-        user = get_user(db, user_name)
+        user = get_user(user_name)
         if user:
-            user = ensure_user_profile(user)
-            save_db(db)
+            user = ensure_user_profile(user_name, user)
             if not user["profile"]["completed"]:
                 return "Please complete your profile setup first from the main menu! 🎯"
     
@@ -259,79 +614,63 @@ def chatbot_reply(user_message):
         session['bot_started'] = True
         return "👋 Welcome to NutriBot! I can see your profile is set up. Ask me anything about nutrition, diet, or healthy living! 🍎"
     
-    user_message_lower = user_message.lower()
+    # ====== INTENT ROUTING ======
+    # Word-boundary phrase matching + local classifier, see intents.py
+    intent = get_intent_router().route(user_message)
+    print(f"DEBUG: {intent}")
     
     # Quick responses for common queries
-    if user_message_lower in ["hello", "hi", "hey"]:
+    if intent.label == "greeting":
         return "Hello! I'm NutriBot, your nutrition assistant! Ask me about food, diet, exercise, or healthy living. 🍎"
     
-    if user_message_lower in ["bye", "goodbye", "quit"]:
+    if intent.label == "farewell":
         session['bot_started'] = False  # Reset for next time
+        forget_conversation(user_name)
         return "Bye! Stay healthy! 🥦"
     
-    # ====== SMARTER WEIGHT GOAL DETECTION ======
-    # Check for QUESTION words that indicate asking for advice, not stating a goal
-    question_words = ["should", "could", "would", "what", "how", "when", "where", "why", "can", "which"]
-    
-    # Check if message is a QUESTION about weight loss/gain (should go to GPT)
-    is_question = any(word in user_message_lower for word in question_words)
-    
-    # Check for weight-related keywords
-    has_weight_loss_keywords = any(phrase in user_message_lower for phrase in 
-                                  ["lose weight", "weight loss", "slim down", "get thinner"])
-    
-    has_weight_gain_keywords = any(phrase in user_message_lower for phrase in 
-                                  ["gain weight", "weight gain", "bulk up", "get bigger", "put on weight"])
-    
-    # Check for INTENT phrases (user stating their goal)
-    intent_phrases = ["i want to", "i need to", "i would like to", "i'm trying to", 
-                      "help me", "i want", "i need", "i'd like to"]
-    has_intent = any(phrase in user_message_lower for phrase in intent_phrases)
-    
     # ====== LOGIC DECISION ======
     # If it's a QUESTION about weight (e.g., "what food should I eat to lose weight")
-    if is_question and (has_weight_loss_keywords or has_weight_gain_keywords):
+    if intent.label == "weight_question":
         print("DEBUG: Question about weight - sending to GPT")
         # Send to GPT for nutrition advice
-        return generate_gpt_reply(user_message)
+        return gpt_reply(user_message)
     
     # If user is stating INTENT to lose/gain weight (e.g., "I want to lose weight")
-    elif has_intent and has_weight_loss_keywords:
+    elif intent.label == "goal_lose" and "intent" in intent.flags:
         session['setting_weight_goal'] = 'lose'
         session['awaiting_response'] = True
         return "I see you want to lose weight! Would you like me to start a weight loss program to track your progress? (yes/no)"
     
-    elif has_intent and has_weight_gain_keywords:
+    elif intent.label == "goal_gain" and "intent" in intent.flags:
         session['setting_weight_goal'] = 'gain'
         session['awaiting_response'] = True
         return "I see you want to gain weight! Would you like me to start a weight gain program to track your progress? (yes/no)"
     
     # Simple statements without question words (e.g., "lose weight")
-    elif has_weight_loss_keywords and not is_question:
+    elif intent.label == "goal_lose":
         session['setting_weight_goal'] = 'lose'
         session['awaiting_response'] = True
         return "I see you're interested in losing weight! Would you like me to start a weight loss program? (yes/no)"
     
-    elif has_weight_gain_keywords and not is_question:
+    elif intent.label == "goal_gain":
         session['setting_weight_goal'] = 'gain'
         session['awaiting_response'] = True
         return "I see you're interested in gaining weight! Would you like me to start a weight gain program? (yes/no)"
     
-    # Handle yes/no responses for weight program
-    if 'awaiting_response' in session and session['awaiting_response']:
-        if "yes" in user_message_lower:
+    # Handle yes/no responses for weight program; "no sugar diet tips" is a question
+    if session.get('awaiting_response') and "food" not in intent.flags:
+        if "affirm" in intent.flags:
             goal = session.get('setting_weight_goal', 'maintain')
             session['awaiting_response'] = False
             session['awaiting_target'] = True
             
             user_name = session.get("user_name")
             if user_name:
-                db = load_db()
-                user = get_user(db, user_name)
+                user = get_user(user_name)
                 current_weight = user["profile"]["weight"]
                 return f"Great! Let's set up your weight {goal} program. Your current weight is {current_weight} kg. What's your target weight (in kg)?"
         
-        elif "no" in user_message_lower:
+        elif "deny" in intent.flags:
             session.pop('awaiting_response', None)
             session.pop('setting_weight_goal', None)
             return "No problem! What else can I help you with?"
@@ -346,8 +685,7 @@ def chatbot_reply(user_message):
             
             user_name = session.get("user_name")
             if user_name:
-                db = load_db()
-                user = get_user(db, user_name)
+                user = get_user(user_name)
                 current_weight = user["profile"]["weight"]
                 
                 # Validate target weight
@@ -356,19 +694,23 @@ def chatbot_reply(user_message):
                 elif goal == 'gain' and target_weight <= current_weight:
                     return f"For weight gain, your target should be higher than your current weight ({current_weight} kg). Please enter a higher target."
                 
-                user["profile"]["target_weight"] = target_weight
-                user["profile"]["goal"] = goal
-                save_db(db)
+                save_changes(user_name, user, [
+                    {"op": "profile", "values": {"target_weight": target_weight, "goal": goal}}
+                ])
                 
                 session.pop('awaiting_target', None)
                 session.pop('setting_weight_goal', None)
                 
                 return f"🎯 Perfect! Target weight set to {target_weight} kg. Check your Weight Journey page to track your progress weekly!"
     
+    # Small talk the classifier is confident about is answered locally
+    if intent.label in LOCAL_REPLIES:
+        return LOCAL_REPLIES[intent.label]
+    
     # Fallback to GPT for everything else
     print("DEBUG: No specific match - falling back to GPT")
     try:
-        response = generate_gpt_reply(user_message)
+        response = gpt_reply(user_message)
         if response is None:
             return "I'm here to help with nutrition questions! What would you like to know?"
         return response
@@ -378,66 +720,87 @@ def chatbot_reply(user_message):
 # Calculate User Bmi    
 def calculate_bmi(weight, height):
     """Calculate BMI safely. Height in cm, weight in kg."""
-    try:
-        h_m = float(height) / 100  # convert to meters
-        bmi = float(weight) / (h_m * h_m)
-        return round(bmi, 2)
-    except:
-        return None
+    return profile_metrics(weight, height)["bmi"]
+
 
+VISION_MAX_EDGE = int(os.getenv("NUTRIBOT_VISION_MAX_EDGE", "1024"))  # pixels
+VISION_JPEG_QUALITY = int(os.getenv("NUTRIBOT_VISION_JPEG_QUALITY", "80"))
 
+image_preparer = ImagePreparer(VISION_MAX_EDGE, VISION_JPEG_QUALITY)
+
+VISION_PROMPT = (
+    "Look at this image and list the FOOD INGREDIENTS you see. "
+    "Reply as a simple comma-separated list, e.g.: "
+    "banana, milk, oats"
+)
+# Vision calls run in background jobs: they wait for a free LLM slot (up to
+# the whole deadline) rather than fail because chat traffic is busy
+VISION_JOB_DEADLINE = float(os.getenv("NUTRIBOT_VISION_JOB_DEADLINE", "120"))  # seconds
+
+# Raises when the image could not be analysed; callers then record nothing,
+# so a busy or failing API never leaves "unknown ingredient" in a pantry
 def detect_food_items(image_path: str):
-    try:
-        with open(image_path, "rb") as f:
-            img_bytes = f.read()
-
-        b64 = base64.b64encode(img_bytes).decode("utf-8")
-
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": (
-                                "Look at this image and list the FOOD INGREDIENTS you see. "
-                                "Reply as a simple comma-separated list, e.g.: "
-                                "banana, milk, oats"
-                            ),
+    # Downscaled, metadata-free copy instead of the full-size original
+    img_bytes, mime, prep = image_preparer.prepare(image_path)
+    # The same photo uploaded by several users at once is sent only once
+    flight_key = request_key("vision", {"model": "gpt-4o-mini", "image": sha256_bytes(img_bytes), "prompt": VISION_PROMPT})
+    return flights.do(flight_key, lambda: ask_vision(img_bytes, mime, prep))
+
+# One vision call; raises on API errors so waiting callers see them too
+def ask_vision(img_bytes, mime, prep):
+    b64 = base64.b64encode(img_bytes).decode("utf-8")
+
+    started = time.perf_counter()
+    response = get_llm().create(
+        "vision",
+        deadline=VISION_JOB_DEADLINE,
+        queue_timeout=VISION_JOB_DEADLINE,
+        model="gpt-4o-mini",
+        messages=[
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": VISION_PROMPT,
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:{mime};base64,{b64}"
                         },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{b64}"
-                            },
-                        },
-                    ],
-                }
-            ],
-            max_tokens=50,
-            temperature=0,
-        )
+                    },
+                ],
+            }
+        ],
+        max_tokens=50,
+        temperature=0,
+    )
+    api_ms = (time.perf_counter() - started) * 1000
+    image_preparer.record_api_call(api_ms)
+    prompt_metrics.record("vision", count_tokens(VISION_PROMPT), response.usage)
+    print(
+        f"Vision call: sent {prep['sent_bytes']} of {prep['original_bytes']} bytes "
+        f"(saved {prep['saved_bytes']}), prep {prep['prep_ms']} ms, api {api_ms:.0f} ms"
+    )
 
-        raw = response.choices[0].message.content.strip().lower()
-        raw = raw.replace(" and ", ", ")
-        parts = [p.strip() for p in raw.split(",")]
-        ingredients = [p for p in parts if p]
+    raw = response.choices[0].message.content.strip().lower()
+    raw = raw.replace(" and ", ", ")
+    parts = [p.strip() for p in raw.split(",")]
+    ingredients = [p for p in parts if p]
 
-        cleaned = [normalize_ingredient(i) for i in ingredients]
-        deduped = dedupe_keep_order(cleaned)
-        return deduped or ["unknown ingredient"]
-    except Exception as e:
-        print("Vision API error:", e)
-        return ["unknown ingredient"]
+    cleaned = [normalize_ingredient(i) for i in ingredients]
+    deduped = dedupe_keep_order(cleaned)
+    return deduped or ["unknown ingredient"]
 
 def normalize_ingredient(name: str) -> str:
     name = name.lower().strip()
     parts = name.split()
     core = parts[-1] if parts else name
 
-    if core.endswith("s") and not core.endswith("ss"):
+    if core.endswith("oes"):  # tomatoes, potatoes
+        core = core[:-2]
+    elif core.endswith("s") and not core.endswith("ss"):
         core = core[:-1]
         
     return core
@@ -451,10 +814,23 @@ def dedupe_keep_order(items):
             result.append(item)
     return result
 
-def extract_mentioned_ingredients(message, pantry_ingredients):
-    message = message.lower()
-    selected = [i for i in pantry_ingredients if i.lower() in message]
-    return selected
+# One matcher per user, kept with the pantry version it was built for; adding
+# or removing an item changes the version, so a matcher is only rebuilt
+# after the pantry changed
+PANTRY_MATCHER_CACHE_SIZE = int(os.getenv("NUTRIBOT_PANTRY_MATCHER_CACHE_SIZE", "1024"))
+pantry_matchers = LRUCache(PANTRY_MATCHER_CACHE_SIZE)
+
+def get_pantry_matcher(user_name, groceries):
+    version = pantry_version(groceries)
+    cached = pantry_matchers.get(user_name)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    matcher = IngredientMatcher(groceries["names"], normalize_ingredient)
+    pantry_matchers.set(user_name, (version, matcher))
+    return matcher
+
+def extract_mentioned_ingredients(message, user_name, groceries):
+    return get_pantry_matcher(user_name, groceries).find(message)
 
 def extract_recipe_count(message: str, default=3):
     message = message.lower()
@@ -463,190 +839,421 @@ def extract_recipe_count(message: str, default=3):
             return num
     return default
 
-def generate_recipes_for_user(user_message):
-    user_name = session.get("user_name")
-    if not user_name:
-        return "Please log in to request recipes."
+DIETARY_CONSTRAINTS = [
+    "high protein", "low carb", "low fat", "low calorie", "low sodium",
+    "vegetarian", "vegan", "gluten free", "dairy free", "keto", "paleo",
+]
+dietary_pattern = re.compile(
+    r"\b(" + "|".join(re.escape(c) for c in DIETARY_CONSTRAINTS) + r")\b"
+)
+
+def extract_dietary_constraints(message):
+    # "gluten-free" and "gluten free" are the same constraint
+    found = dietary_pattern.findall(message.lower().replace("-", " "))
+    return sorted(set(found))
+
+# Recipes depend only on the pantry and what was asked for, so identical
+# requests on an unchanged pantry are answered from here
+RECIPE_DELIMITER = "---- END OF RECIPE ----"
+RECIPE_CACHE_SIZE = int(os.getenv("NUTRIBOT_RECIPE_CACHE_SIZE", "256"))
+RECIPE_CACHE_TTL = float(os.getenv("NUTRIBOT_RECIPE_CACHE_TTL", "86400"))  # 1 day
+recipe_cache = LRUCache(RECIPE_CACHE_SIZE, RECIPE_CACHE_TTL)
+
+# Bundled recipes, indexed by normalized ingredient; GPT only writes the
+# recipes the corpus can't cover well enough
+RECIPE_CORPUS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "recipes.json")
+RECIPE_INDEX_FILE = os.getenv("NUTRIBOT_RECIPE_INDEX", "recipe_index.pkl")
+RECIPE_MIN_COVERAGE = float(os.getenv("NUTRIBOT_RECIPE_MIN_COVERAGE", "0.75"))
+
+recipe_index = None
+def get_recipe_index():
+    global recipe_index
+    if recipe_index is None:
+        recipe_index = load_recipe_index(RECIPE_CORPUS_FILE, RECIPE_INDEX_FILE, normalize_ingredient)
+    return recipe_index
+
+def local_recipes(plan):
+    return get_recipe_index().search(
+        {normalize_ingredient(name) for name in plan["pantry"]},
+        [normalize_ingredient(name) for name in plan["requested"]],
+        plan["constraints"],
+        k=plan["count"],
+        min_coverage=RECIPE_MIN_COVERAGE,
+    )
 
-    db = load_db()
-    user = get_user(db, user_name)
+# Plan for the recipes the local corpus didn't provide, or None if it covered all
+def remaining_plan(plan, local):
+    if len(local) >= plan["count"]:
+        return None
+    return dict(plan, count=plan["count"] - len(local))
 
-    pantry = sorted({item["name"] for item in user["groceries"]})
+# Same text layout GPT is asked for
+def format_recipe(recipe):
+    ingredients = "\n".join(
+        f"• {i['name']} — {i['amount']}" if i["amount"] else f"• {i['name']}"
+        for i in recipe["ingredients"]
+    )
+    steps = "\n".join(f"{n}. {step}" for n, step in enumerate(recipe["steps"], 1))
+    nutrition = recipe["nutrition"]
+    return (
+        f"TITLE: {recipe['title']}\n\n"
+        f"Ingredients:\n{ingredients}\n\n"
+        f"Steps:\n{steps}\n\n"
+        f"Nutrition (per serving):\n"
+        f"• Calories: {nutrition['calories']} kcal\n"
+        f"• Protein: {nutrition['protein']} g\n"
+        f"• Carbs: {nutrition['carbs']} g\n"
+        f"• Fat: {nutrition['fat']} g"
+    )
 
+# Work out what to ask GPT for; returns (plan, None) or (None, message for the user)
+def plan_recipes(user_message, user_name, groceries):
+    pantry = list(groceries["names"])
     if not pantry:
-        return "Your pantry is empty. Upload a food image first."
-
-    requested = extract_mentioned_ingredients(user_message, pantry)
+        return None, "Your pantry is empty. Upload a food image first."
 
-    ingredients_to_use = requested if requested else pantry
+    requested = extract_mentioned_ingredients(user_message, user_name, groceries)
 
-    if len(requested) > 0 and len(requested) == 1:
-        pass  # ok
-    elif len(requested) >= 2:
+    if len(requested) >= 2:
         forbidden = [
             ("apple", "cabbage"),
             ("banana", "broccoli")
         ]
         for combo in forbidden:
             if all(i in requested for i in combo):
-                return f"❌ No valid recipes can be formed using: {', '.join(requested)}."
-
-    count = extract_recipe_count(user_message, default=3)
-
-    prompt = f"""
-    You are NutriBot. ALWAYS follow the required format exactly. 
-    Every recipe MUST be separated clearly with blank lines. 
-    DO NOT merge any lines together. DO NOT output inline text blocks.
-
-    ==========================
-    FORMAT RULES (MANDATORY)
-    ==========================
-    For EACH recipe, output EXACTLY this structure with REQUIRED newlines:
-
-    TITLE: <recipe name>
-
-    Ingredients:
-    • ingredient — amount
-    • ingredient — amount
-
-    Steps:
-    1. step text (only add time if heat is used)
-    2. step text
-    3. step text
-
-    Nutrition (per serving):
-    • Calories: <number> kcal
-    • Protein: <number> g
-    • Carbs: <number> g
-    • Fat: <number> g
-
-    ---- END OF RECIPE ----
-
-    IMPORTANT:
-    • Ensure ALL sections appear on separate lines.
-    • Ensure bullets NEVER appear on the same line as a title.
-    • NEVER merge two recipes together.
-    • After each recipe, include EXACTLY the line: "---- END OF RECIPE ----"
-    • This STOP TOKEN forces clean separation.
-
-    ==========================
-    RECIPE GENERATION RULES
-    ==========================
-    1. Generate EXACTLY {count} recipes.
-    2. If the user requests dietary constraints (e.g., "high protein"):
-    → ALL recipes must follow it.
-    3. If the user specifies ingredients:
-    → ALL recipes must include those ingredients.
-    4. Use up to 3 pantry ingredients per recipe.
-    5. If ingredients cannot form valid recipes:
-    → Reply ONLY with this: "No valid recipes can be formed using the ingredients mentioned."
-    6. Do NOT use unrealistic combinations (e.g., apple + cabbage).
-    7. Include cook time ONLY for heat-based steps:
-    • baking, roasting, frying, sautéing
-    • boiling, simmering
-    • microwaving
-    • grilling, air frying
-
-    ==========================
-    PANTRY + REQUEST CONTEXT
-    ==========================
-    PANTRY INGREDIENTS: {", ".join(pantry)}
-    REQUESTED INGREDIENTS: {", ".join(requested) if requested else "None"}
-    USER MESSAGE: "{user_message}"
-
-    Now output {count} recipes in the strict format.
-    """
+                return None, f"❌ No valid recipes can be formed using: {', '.join(requested)}."
+
+    return {
+        "pantry": pantry,
+        "requested": requested,
+        "count": extract_recipe_count(user_message, default=3),
+        "constraints": extract_dietary_constraints(user_message),
+    }, None
+
+def recipe_cache_key(plan):
+    return "|".join([
+        ",".join(plan["pantry"]),
+        ",".join(sorted(plan["requested"])),
+        str(plan["count"]),
+        ",".join(plan["constraints"]),
+    ])
+
+RECIPE_PROMPT_TOKENS = int(os.getenv("NUTRIBOT_RECIPE_PROMPT_TOKENS", "400"))  # pantry + request
+RECIPE_PROMPT = PromptTemplate(
+    "recipes",
+    system="""
+        You are NutriBot. ALWAYS follow the required format exactly.
+        Every recipe MUST be separated clearly with blank lines.
+        DO NOT merge any lines together. DO NOT output inline text blocks.
+
+        FORMAT RULES (MANDATORY)
+        For EACH recipe, output EXACTLY this structure with REQUIRED newlines:
+
+        TITLE: <recipe name>
+
+        Ingredients:
+        • ingredient — amount
+        • ingredient — amount
+
+        Steps:
+        1. step text (only add time if heat is used)
+        2. step text
+        3. step text
+
+        Nutrition (per serving):
+        • Calories: <number> kcal
+        • Protein: <number> g
+        • Carbs: <number> g
+        • Fat: <number> g
+
+        ---- END OF RECIPE ----
+
+        IMPORTANT:
+        • Ensure ALL sections appear on separate lines.
+        • Ensure bullets NEVER appear on the same line as a title.
+        • NEVER merge two recipes together.
+        • After each recipe, include EXACTLY the line: "---- END OF RECIPE ----"
+        • This STOP TOKEN forces clean separation.
+
+        RECIPE GENERATION RULES
+        1. Generate EXACTLY the number of recipes asked for.
+        2. If the user requests dietary constraints (e.g., "high protein"):
+        → ALL recipes must follow it.
+        3. If the user specifies ingredients:
+        → ALL recipes must include those ingredients.
+        4. Use up to 3 pantry ingredients per recipe.
+        5. If ingredients cannot form valid recipes:
+        → Reply ONLY with this: "No valid recipes can be formed using the ingredients mentioned."
+        6. Do NOT use unrealistic combinations (e.g., apple + cabbage).
+        7. Include cook time ONLY for heat-based steps:
+        • baking, roasting, frying, sautéing
+        • boiling, simmering
+        • microwaving
+        • grilling, air frying
+    """,
+    user="""
+        PANTRY INGREDIENTS: {pantry}
+        REQUESTED INGREDIENTS: {requested}
+        DIETARY CONSTRAINTS: {constraints}
+        USER MESSAGE: "{message}"
+
+        Now output EXACTLY {count} recipes in the strict format.
+    """,
+    budget=RECIPE_PROMPT_TOKENS,
+    clip=("pantry", "message"),
+)
+
+# Returns (messages, estimated tokens, clipped)
+def build_recipe_prompt(user_message, plan):
+    constraints = plan["constraints"]
+    return RECIPE_PROMPT.render(
+        pantry=", ".join(plan["pantry"]),
+        requested=", ".join(plan["requested"]) if plan["requested"] else "None",
+        constraints=", ".join(constraints) if constraints else "None",
+        message=user_message,
+        count=plan["count"],
+    )
 
+def recipe_blocks(user_message, plan):
+    """Yield the raw text of each recipe as soon as its delimiter arrives"""
+    cache_key = recipe_cache_key(plan)
+    cached = recipe_cache.get(cache_key)
+    if cached is not None:
+        yield from cached
+        return
+
+    messages, prompt_tokens, clipped = build_recipe_prompt(user_message, plan)
+    request_body = {"model": "gpt-4o-mini", "messages": messages, "max_tokens": 600, "temperature": 0.7}
+    # The same recipes asked for elsewhere right now: wait for them
+    flight = flights.join(request_key("recipes", request_body))
+    if not flight.leader:
+        try:
+            yield from flight.result()
+        except Exception as e:
+            print("Recipe generation error:", e)
+            yield "Sorry, I couldn't generate recipes at this moment."
+        return
+
+    blocks = []
+    buffer = ""
+    usage = None
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=600,
-            temperature=0.7
+        stream = get_llm().create(
+            "recipes",
+            stream=True,
+            stream_options={"include_usage": True},
+            **request_body
         )
-
-        raw = response.choices[0].message.content.strip()
-        return raw
+        for chunk in stream:
+            if getattr(chunk, "usage", None):
+                usage = chunk.usage
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            buffer += chunk.choices[0].delta.content
+            while RECIPE_DELIMITER in buffer:
+                block, buffer = buffer.split(RECIPE_DELIMITER, 1)
+                if block.strip():
+                    blocks.append(block.strip())
+                    yield block.strip()
+        # Last recipe without a delimiter, or the "no valid recipes" reply
+        if buffer.strip():
+            blocks.append(buffer.strip())
+            yield buffer.strip()
+        prompt_metrics.record("recipes", prompt_tokens, usage, clipped)
     except Exception as e:
         print("Recipe generation error:", e)
-        return "Sorry, I couldn't generate recipes at this moment."
+        flight.fail(e)
+        if not blocks:
+            yield "Sorry, I couldn't generate recipes at this moment."
+        return
+    else:
+        recipe_cache.set(cache_key, blocks)
+        flight.finish(blocks)
+    finally:
+        # Client went away mid-stream: waiters ask again
+        flight.abandon()
+
+# Turn one recipe block into {"title", "ingredients", "steps", "nutrition"};
+# None when the block is not a recipe
+def parse_recipe(text):
+    recipe = {"title": None, "ingredients": [], "steps": [], "nutrition": {}}
+    section = None
+    for line in text.splitlines():
+        line = line.replace("**", "").strip().lstrip("#").strip()
+        lowered = line.lower()
+        if not line:
+            continue
+        if lowered.startswith("title:"):
+            recipe["title"] = line[len("title:"):].strip()
+            section = None
+        elif lowered.startswith("ingredients"):
+            section = "ingredients"
+        elif lowered.startswith("steps"):
+            section = "steps"
+        elif lowered.startswith("nutrition"):
+            section = "nutrition"
+        elif section == "ingredients":
+            item = line.lstrip("•*-").strip()
+            parts = re.split(r"\s+[—–-]\s+", item, maxsplit=1)
+            recipe["ingredients"].append({"name": parts[0], "amount": parts[1] if len(parts) > 1 else None})
+        elif section == "steps":
+            recipe["steps"].append(re.sub(r"^(\d+[.)]|[•*-])\s*", "", line))
+        elif section == "nutrition":
+            match = re.match(r"[•*-]?\s*([a-z ]+):\s*~?([\d.]+)", lowered)
+            if match:
+                value = float(match.group(2))
+                recipe["nutrition"][match.group(1).strip()] = int(value) if value.is_integer() else value
+    if not recipe["title"]:
+        return None
+    return recipe
 
-# Image Adding
-def add_image_record(user, image_path, ingredients):
-    user["images"].append({
-        "id": str(uuid4()),
-        "image_path": image_path,
-        "detected_items": ingredients,
-        "uploaded_at": format_time()
-    })
-# Grocery Item Adding
-def add_grocery_items(user, ingredients):
-    now = format_time()
-    for name in ingredients:
-        user["groceries"].append({
-            "id": str(uuid4()),
-            "name": name,
-            "quantity": None,
-            "unit": None,
-            "added_at": now
-        })
-# Validate Uploaded file
-def allowed_file(filename):
-    return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
+def generate_recipes_for_user(user_message):
+    user_name = session.get("user_name")
+    if not user_name:
+        return "Please log in to request recipes."
+
+    user = get_user(user_name)
+
+    plan, error = plan_recipes(user_message, user_name, user["groceries"])
+    if error:
+        return error
+
+    local = local_recipes(plan)
+    blocks = [format_recipe(recipe) for recipe in local]
+    gpt_plan = remaining_plan(plan, local)
+    if gpt_plan:
+        blocks.extend(recipe_blocks(user_message, gpt_plan))
+    return f"\n\n{RECIPE_DELIMITER}\n\n".join(blocks)
 
 # Calculate User Daily calories 
 def calculate_daily_calories(weight, height, age, gender):
-    weight = float(weight)
-    height = float(height)
-    age = int(age)
-    gender = gender.lower()
-
-    if gender == "male":
-        return 10 * weight + 6.25 * height - 5 * age + 5
-    else:
-        return 10 * weight + 6.25 * height - 5 * age - 161
+    return profile_metrics(weight, height, age, gender)["daily_calories"]
 
 
-@app.route("/chat", methods=["POST"])
+@route("/chat", methods=["POST"])
 def chat():
     data = request.json
     message = data.get("message", "")
     reply = chatbot_reply(message)
     return jsonify({"reply": reply})
 
-@app.route("/profile", methods=["GET", "POST"])
+# Cache counters for tuning sizes and TTLs
+@route("/metrics", methods=["GET"])
+def metrics():
+    stats = {
+        "response_cache": response_cache.stats(),
+        "answer_index": get_answer_index().stats(),
+        "jobs": get_job_queue().stats(),
+        "vision_cache": get_vision_cache().stats(),
+        "image_prep": image_preparer.stats(),
+        "recipe_cache": recipe_cache.stats(),
+        "pantry_matchers": pantry_matchers.stats(),
+        "prompts": prompt_metrics.stats(),
+        "llm": get_llm().stats(),
+        "single_flight": flights.stats(),
+        "recipe_index": get_recipe_index().stats(),
+    }
+    if hasattr(get_store(), "stats"):
+        stats["store"] = get_store().stats()
+    return jsonify(stats)
+
+# Format one Server-Sent Event
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# Streaming chat: rule-based answers arrive as one "reply" event, GPT answers
+# as "token" events while they are generated; "done" closes the stream
+@route("/chat/stream", methods=["POST"])
+def chat_stream():
+    data = request.json
+    message = data.get("message", "")
+    reply = chatbot_reply(message, gpt_reply=generate_gpt_reply_stream)
+
+    def events():
+        if isinstance(reply, str):
+            yield sse_event("reply", {"text": reply})
+        else:
+            for token in reply:
+                yield sse_event("token", {"text": token})
+        yield sse_event("done", {})
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# Recipes from the pantry as Server-Sent Events: one "recipe" event per
+# recipe as soon as it is complete, "error" for anything that isn't a recipe.
+# Matches from the bundled corpus come first ("source": "local")
+@route("/recipes", methods=["POST"])
+def recipes():
+    user_name = require_login()
+    if not user_name:
+        return jsonify({"error": "not_logged_in"}), 401
+
+    data = request.json or {}
+    message = data.get("message", "")
+    user = get_user(user_name)
+    plan, error = plan_recipes(message, user_name, user["groceries"])
+
+    def events():
+        if error:
+            yield sse_event("error", {"text": error})
+            yield sse_event("done", {})
+            return
+        local = local_recipes(plan)
+        for recipe in local:
+            yield sse_event("recipe", dict(recipe, source="local"))
+        gpt_plan = remaining_plan(plan, local)
+        if gpt_plan:
+            for block in recipe_blocks(message, gpt_plan):
+                recipe = parse_recipe(block)
+                if recipe is None:
+                    yield sse_event("error", {"text": block})
+                else:
+                    yield sse_event("recipe", dict(recipe, source="gpt"))
+        yield sse_event("done", {})
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@route("/profile", methods=["GET", "POST"])
 def profile():
     user_name = require_login()
     if not user_name:
         return redirect(url_for("login"))
 
-    db = load_db()
-    user = get_user(db, user_name)
-    user = ensure_user_profile(user)
+    user = get_user(user_name)
+    user = ensure_user_profile(user_name, user)
     
     if request.method == "POST":
         # Update only editable profile information
-        user["profile"]["email"] = request.form.get("email", "")
-        user["profile"]["phone"] = request.form.get("phone", "")
-        user["profile"]["country"] = request.form.get("country", "")
+        values = {
+            "email": request.form.get("email", ""),
+            "phone": request.form.get("phone", ""),
+            "country": request.form.get("country", ""),
+        }
         
         # BMI is NOT updated here - it stays as calculated
         
-        save_db(db)
+        save_changes(user_name, user, [{"op": "profile", "values": values}])
         flash("Profile updated successfully! ✅")
         return redirect(url_for("profile"))
     
     return render_template("profile.html", user=user, user_name=user_name)
 
-@app.route("/edit-health", methods=["GET", "POST"])
+@route("/edit-health", methods=["GET", "POST"])
 def edit_health():
     user_name = require_login()
     if not user_name:
         return redirect(url_for("login"))
 
-    db = load_db()
-    user = get_user(db, user_name)
-    user = ensure_user_profile(user)
+    user = get_user(user_name)
+    user = ensure_user_profile(user_name, user)
     
     if request.method == "POST":
         # Get form data
@@ -658,51 +1265,36 @@ def edit_health():
         # Validate and save
         if age and height and weight and gender:
             # Update basic info
-            user["profile"]["age"] = int(age)
-            user["profile"]["height"] = int(height)
-            user["profile"]["weight"] = float(weight)
-            user["profile"]["gender"] = gender
-            
-            # Recalculate BMI
-            bmi_value = calculate_bmi(weight, height)
-            user["profile"]["bmi"] = bmi_value
-            
-            # Update BMI category
-            if bmi_value:
-                if bmi_value < 18.5:
-                    user["profile"]["bmi_category"] = "Underweight"
-                elif bmi_value < 25:
-                    user["profile"]["bmi_category"] = "Normal"
-                elif bmi_value < 30:
-                    user["profile"]["bmi_category"] = "Overweight"
-                else:
-                    user["profile"]["bmi_category"] = "Obese"
-            else:
-                user["profile"]["bmi_category"] = None
+            values = {
+                "age": int(age),
+                "height": int(height),
+                "weight": float(weight),
+                "gender": gender,
+            }
             
-            # Recalculate daily calories
-            daily_calories = calculate_daily_calories(weight, height, age, gender)
-            user["profile"]["daily_calories"] = daily_calories
+            # Recalculate BMI, BMI category and daily calories
+            metrics = profile_metrics(weight, height, age, gender)
+            values.update(metrics)
             
-            save_db(db)
+            save_changes(user_name, user, [{"op": "profile", "values": values}])
             flash("Health information updated successfully! ✅")
-            flash(f"Your new BMI is {bmi_value} ({user['profile']['bmi_category']})")
-            flash(f"Daily calorie needs: {daily_calories:.0f} kcal")
+            flash(f"Your new BMI is {metrics['bmi']} ({metrics['bmi_category']})")
+            if metrics["daily_calories"] is not None:
+                flash(f"Daily calorie needs: {metrics['daily_calories']:.0f} kcal")
             return redirect(url_for("profile"))
         else:
             flash("Please fill in all fields.")
     
     return render_template("edit_health.html", user=user, user_name=user_name)
 
-@app.route("/profile-setup", methods=["GET", "POST"])
+@route("/profile-setup", methods=["GET", "POST"])
 def profile_setup():
     user_name = require_login()
     if not user_name:
         return redirect(url_for("login"))
     
-    db = load_db()
-    user = get_user(db, user_name)
-    user = ensure_user_profile(user)
+    user = get_user(user_name)
+    user = ensure_user_profile(user_name, user)
     
     if request.method == "POST":
         # Get form data
@@ -713,37 +1305,25 @@ def profile_setup():
         
         # Validate and save
         if age and height and weight and gender:
-            user["profile"]["age"] = int(age)
-            user["profile"]["height"] = int(height)
-            user["profile"]["weight"] = float(weight)
-            user["profile"]["current_weight"] = float(weight)  # Set both weight fields
-            user["profile"]["gender"] = gender
-            
-            # Calculate BMI
-            bmi_value = calculate_bmi(weight, height)
-            user["profile"]["bmi"] = bmi_value
+            values = {
+                "age": int(age),
+                "height": int(height),
+                "weight": float(weight),
+                "current_weight": float(weight),  # Set both weight fields
+                "gender": gender,
+            }
             
-            # Set BMI category
-            if bmi_value:
-                if bmi_value < 18.5:
-                    user["profile"]["bmi_category"] = "Underweight"
-                elif bmi_value < 25:
-                    user["profile"]["bmi_category"] = "Normal"
-                elif bmi_value < 30:
-                    user["profile"]["bmi_category"] = "Overweight"
-                else:
-                    user["profile"]["bmi_category"] = "Obese"
-            
-            # Calculate daily calories
-            daily_calories = calculate_daily_calories(weight, height, age, gender)
-            user["profile"]["daily_calories"] = daily_calories
+            # Calculate BMI, BMI category and daily calories
+            metrics = profile_metrics(weight, height, age, gender)
+            values.update(metrics)
             
-            user["profile"]["completed"] = True
+            values["completed"] = True
             
-            save_db(db)
+            save_changes(user_name, user, [{"op": "profile", "values": values}])
             flash("Profile setup complete! Welcome to NutriBot! 🎉")
-            flash(f"Your BMI is {bmi_value} ({user['profile']['bmi_category']})")
-            flash(f"Estimated daily calorie needs: {daily_calories:.0f} kcal")
+            flash(f"Your BMI is {metrics['bmi']} ({metrics['bmi_category']})")
+            if metrics["daily_calories"] is not None:
+                flash(f"Estimated daily calorie needs: {metrics['daily_calories']:.0f} kcal")
             return redirect(url_for("menu"))
         else:
             flash("Please fill in all fields.")
@@ -755,22 +1335,21 @@ def profile_setup():
     
     return render_template("profile_setup.html", user_name=user_name)
 
-@app.route("/menu", methods=["GET"])
+@route("/menu", methods=["GET"])
 def menu():
     user_name = session.get("user_name")
     if not user_name:
         flash("Please log in first.")
         return redirect(url_for("login"))
 
-    db = load_db()
-    user = get_user(db, user_name)
+    user = get_user(user_name)
     
     if not user:
         flash("User not found. Please log in again.")
         return redirect(url_for("login"))
     
     # Ensure user has the complete profile structure
-    user = ensure_user_profile(user)
+    user = ensure_user_profile(user_name, user)
     
     # Check if profile is completed
     if not user["profile"]["completed"]:
@@ -781,27 +1360,22 @@ def menu():
     session.pop('awaiting_response', None)
     session.pop('awaiting_target', None)
     
-    # Update the database with the ensured profile structure
-    db["users"][user_name] = user
-    save_db(db)
-    
     return render_template("menu.html", user_name=user_name)
 # ================================
 # GROCERIES
 # ================================
-@app.route("/groceries", methods=["GET"])
+@route("/groceries", methods=["GET"])
 def groceries_page():
     user_name = require_login()
     if not user_name:
         return redirect(url_for("login"))
 
-    db = load_db()
-    user = get_user(db, user_name)
+    user = get_user(user_name)
     if not user:
         flash("User not found in database. Please log in again.")
         return redirect(url_for("login"))
 
-    groceries = user["groceries"]
+    groceries = pantry_items(user["groceries"])
     images = user["images"]
     return render_template(
         "groceries.html",
@@ -810,51 +1384,46 @@ def groceries_page():
         user_name=user_name
     )
 
-@app.route("/delete_grocery/<item_id>", methods=["POST"])
+@route("/delete_grocery/<item_id>", methods=["POST"])
 def delete_grocery(item_id):
     user_name = require_login()
     if not user_name:
         return redirect(url_for("login"))
 
-    db = load_db()
-    user = get_user(db, user_name)
+    user = get_user(user_name)
 
-    # filter out the item by id
-    user["groceries"] = [g for g in user["groceries"] if g["id"] != item_id]
-    save_db(db)
+    save_changes(user_name, user, [{"op": "pantry_remove", "id": item_id}])
 
     flash("Ingredient removed.")
     return redirect(url_for("groceries_page"))
 
-@app.route("/delete_image/<image_id>", methods=["POST"])
+@route("/delete_image/<image_id>", methods=["POST"])
 def delete_image(image_id):
     user_name = require_login()
     if not user_name:
         return redirect(url_for("login"))
 
-    db = load_db()
-    user = get_user(db, user_name)
+    user = get_user(user_name)
+    removed = [img for img in user["images"] if img["id"] == image_id]
 
-    remaining_images = []
-    for img in user["images"]:
-        if img["id"] == image_id:
-            # Try to remove the actual file from disk
-            try:
-                if os.path.exists(img["image_path"]):
-                    os.remove(img["image_path"])
-            except Exception:
-                # Ignore file delete errors for now (hackathon life)
-                pass
-        else:
-            remaining_images.append(img)
+    save_changes(user_name, user, [{"op": "remove", "field": "images", "id": image_id}])
 
-    user["images"] = remaining_images
-    save_db(db)
+    for img in removed:
+        # Try to remove the actual file from disk, unless another
+        # upload (possibly another user's) shares the same bytes
+        try:
+            if get_store().count_image_refs(img["image_path"]) == 0:
+                for path in (img["image_path"], image_preparer.cached_path(img["image_path"])):
+                    if os.path.exists(path):
+                        os.remove(path)
+        except Exception:
+            # Ignore file delete errors for now (hackathon life)
+            pass
 
     flash("Image removed.")
     return redirect(url_for("groceries_page"))
 
-@app.route("/upload_grocery", methods=["POST"])
+@route("/upload_grocery", methods=["POST"])
 def upload_grocery():
     user_name = require_login()
     if not user_name:
@@ -871,27 +1440,241 @@ def upload_grocery():
         return jsonify({"error": "bad_type"}), 400
 
     # Save image to static/uploads
+    save_path, sha256, phash = store_upload(file)
+
+    # Seen this picture (or a near-identical one) before: reuse its ingredients
+    ingredients, match = get_vision_cache().lookup(sha256, phash, user_name)
+    if ingredients is not None:
+        print(f"Vision cache hit ({match})")
+        result = add_detected_items(user_name, save_path, ingredients, sha256, phash)
+        return jsonify(dict(result, status="done"))
+
+    # Ingredient detection runs in the background; the client polls for it
+    payload = {"image_path": save_path, "sha256": sha256, "phash": phash}
+    job_id = get_job_queue().submit("detect", user_name, payload)
+    return jsonify({
+        "job_id": job_id,
+        "status": "queued",
+        "status_url": url_for("upload_status", job_id=job_id),
+        "reply": "Image uploaded to pantry. Detecting ingredients...",
+    }), 202
+
+@route("/upload_status/<job_id>", methods=["GET"])
+def upload_status(job_id):
+    user_name = require_login()
+    if not user_name:
+        return jsonify({"error": "not_logged_in"}), 401
+
+    job = get_job_queue().get(job_id)
+    if job is None or job["user_name"] != user_name:
+        return jsonify({"error": "not_found"}), 404
+
+    body = {"job_id": job_id, "status": job["status"]}
+    if job["status"] == "done":
+        body.update(job["result"])
+    elif job["status"] == "failed":
+        # Nothing was added to the pantry, so the same upload can simply be retried
+        photos = "those images" if job["kind"] == "detect_batch" else "that image"
+        body["reply"] = f"Sorry, I couldn't detect the ingredients in {photos}. Please try uploading again."
+    return jsonify(body)
+
+# Several photos in one request; detection runs concurrently in one job and
+# everything lands in the pantry with a single store write
+@route("/upload_groceries", methods=["POST"])
+def upload_groceries():
+    user_name = require_login()
+    if not user_name:
+        return jsonify({"error": "not_logged_in"}), 401
+
+    files = [f for f in request.files.getlist("photos") if f.filename != ""]
+    if not files:
+        return jsonify({"error": "no_file"}), 400
+    if len(files) > BATCH_MAX_FILES:
+        return jsonify({"error": "too_many_files", "max_files": BATCH_MAX_FILES}), 400
+    for file in files:
+        if not allowed_file(file.filename):
+            return jsonify({"error": "bad_type", "filename": file.filename}), 400
+
+    uploads = []
+    for file in files:
+        save_path, sha256, phash = store_upload(file)
+        ingredients, match = get_vision_cache().lookup(sha256, phash, user_name)
+        uploads.append({
+            "filename": file.filename,
+            "image_path": save_path,
+            "sha256": sha256,
+            "phash": phash,
+            "ingredients": ingredients,
+            "match": match,
+        })
+
+    # Every photo already known: no vision calls needed
+    if all(up["ingredients"] is not None for up in uploads):
+        result = add_detected_batch(user_name, uploads)
+        return jsonify(dict(result, status="done"))
+
+    job_id = get_job_queue().submit("detect_batch", user_name, {"uploads": uploads})
+    return jsonify({
+        "job_id": job_id,
+        "status": "queued",
+        "status_url": url_for("upload_status", job_id=job_id),
+        "reply": f"{len(uploads)} images uploaded to pantry. Detecting ingredients...",
+    }), 202
+
+
+# =========================
+# Background ingredient detection
+# =========================
+DETECT_WORKERS = int(os.getenv("NUTRIBOT_DETECT_WORKERS", "2"))
+JOBS_FILE = os.getenv("NUTRIBOT_JOBS_FILE", "db_jobs.sqlite3")
+# A "running" job whose worker stopped heartbeating this long ago is run again
+JOB_STALE_AFTER = float(os.getenv("NUTRIBOT_JOB_STALE_AFTER", "60"))  # seconds
+
+BATCH_MAX_FILES = int(os.getenv("NUTRIBOT_BATCH_MAX_FILES", "20"))
+BATCH_CONCURRENCY = int(os.getenv("NUTRIBOT_BATCH_CONCURRENCY", "4"))  # vision calls in flight
+
+VISION_CACHE_SIZE = int(os.getenv("NUTRIBOT_VISION_CACHE_SIZE", "5000"))
+VISION_MAX_DISTANCE = int(os.getenv("NUTRIBOT_VISION_MAX_DISTANCE", "4"))  # dHash bits
+
+vision_cache = None
+# Built on first use from the fingerprints of every stored upload
+def get_vision_cache():
+    global vision_cache
+    if vision_cache is None:
+        with setup_lock:
+            if vision_cache is None:
+                cache = VisionCache(VISION_CACHE_SIZE, VISION_MAX_DISTANCE)
+                for user_name, user in get_store().iter_users():
+                    cache.seed(user.get("images", []), user_name)
+                vision_cache = cache
+    return vision_cache
+
+# Save an upload under the SHA-256 of its bytes so identical files are stored once
+def store_upload(file):
+    data = file.read()
+    sha256 = sha256_bytes(data)
     ext = file.filename.rsplit(".", 1)[1].lower()
-    filename = f"{uuid4()}.{ext}"
-    save_path = os.path.join(UPLOAD_FOLDER, filename)
-    file.save(save_path)
+    save_path = os.path.join(UPLOAD_FOLDER, f"{sha256}.{ext}")
+    if not os.path.exists(save_path):
+        with open(save_path, "wb") as f:
+            f.write(data)
+    return save_path, sha256, perceptual_hash(data)
+
+# A job can run twice (a stale one is run again by another worker); its
+# image records are keyed on the job id, so a re-run finds its earlier write
+def has_image_record(user, record_ids):
+    record_ids = set(record_ids)
+    return any(img.get("id") in record_ids for img in user.get("images", []))
+
+# Add an image record and its ingredients to the user's pantry, unless the
+# record `record_id` is already there
+def add_detected_items(user_name, image_path, ingredients, sha256=None, phash=None, record_id=None):
+    user = get_user(user_name)
+    if record_id is None or not has_image_record(user, [record_id]):
+        changes = [add_image_record(image_path, ingredients, sha256, phash, record_id)] + add_grocery_items(ingredients)
+        save_changes(user_name, user, changes)
+
+    detected_str = ", ".join(ingredients)
+    return {
+        "ingredients": ingredients,
+        "reply": f"Image uploaded to pantry. I detected: {detected_str}.",
+    }
 
-    # Use OpenAI Vision to detect one or more ingredients
-    ingredients = detect_food_items(save_path)
+# Use OpenAI Vision to detect one or more ingredients, then add them to the pantry;
+# if detection fails the job fails and the pantry is left alone
+def run_detection_job(job):
+    payload = job["payload"]
+    ingredients = detect_food_items(payload["image_path"])
+    # Failed detections are not worth remembering
+    if payload.get("sha256") and ingredients != ["unknown ingredient"]:
+        get_vision_cache().put(payload["sha256"], payload.get("phash"), ingredients, job["user_name"])
+    return add_detected_items(
+        job["user_name"], payload["image_path"], ingredients,
+        payload.get("sha256"), payload.get("phash"), record_id=job["id"],
+    )
 
-    db = load_db()
-    user = get_user(db, user_name)
-    add_image_record(user, save_path, ingredients)
-    add_grocery_items(user, ingredients)
-    save_db(db)
+detect_pool = None
+# Shared by all batches, so concurrent batches still respect BATCH_CONCURRENCY
+def get_detect_pool():
+    global detect_pool
+    if detect_pool is None:
+        detect_pool = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY, thread_name_prefix="detect")
+    return detect_pool
+
+# Fill in the ingredients of every upload the vision cache didn't know;
+# identical files in one batch are only sent once. Uploads whose detection
+# failed keep ingredients None
+def detect_many(uploads, user_name):
+    pending = {}
+    for up in uploads:
+        if up["ingredients"] is None and up["sha256"] not in pending:
+            pending[up["sha256"]] = get_detect_pool().submit(detect_food_items, up["image_path"])
+    for up in uploads:
+        if up["ingredients"] is None:
+            try:
+                up["ingredients"] = pending[up["sha256"]].result()
+            except Exception as e:
+                print(f"Vision API error for {up['filename']}:", e)
+            up["match"] = None
+    for up in uploads:
+        if up["sha256"] in pending and up["ingredients"] not in (None, ["unknown ingredient"]):
+            get_vision_cache().put(up["sha256"], up["phash"], up["ingredients"], user_name)
+    return uploads
+
+# Add all image records and the merged ingredient list in one store write,
+# skipped when the uploads' record ids show it already landed;
+# `failed` names the photos that could not be analysed
+def add_detected_batch(user_name, uploads, failed=()):
+    ingredients = dedupe_keep_order(name for up in uploads for name in up["ingredients"])
+    user = get_user(user_name)
+    record_ids = [up["record_id"] for up in uploads if up.get("record_id")]
+    if not has_image_record(user, record_ids):
+        changes = [
+            add_image_record(up["image_path"], up["ingredients"], up["sha256"], up["phash"], up.get("record_id"))
+            for up in uploads
+        ] + add_grocery_items(ingredients)
+        save_changes(user_name, user, changes)
 
     detected_str = ", ".join(ingredients)
-    return jsonify({"reply": f"Image uploaded to pantry. I detected: {detected_str}."})
+    return {
+        "results": [
+            {"filename": up["filename"], "ingredients": up["ingredients"], "cached": up["match"]}
+            for up in uploads
+        ],
+        "ingredients": ingredients,
+        "failed": list(failed),
+        "reply": f"{len(uploads)} images uploaded to pantry. I detected: {detected_str}."
+                 + (f" I couldn't analyse {', '.join(failed)}; please upload again." if failed else ""),
+    }
 
-    
+def run_batch_detection_job(job):
+    for position, up in enumerate(job["payload"]["uploads"]):
+        up["record_id"] = f"{job['id']}-{position}"
+    uploads = detect_many(job["payload"]["uploads"], job["user_name"])
+    detected = [up for up in uploads if up["ingredients"] is not None]
+    if not detected:
+        raise RuntimeError("No image in the batch could be analysed")
+    failed = [up["filename"] for up in uploads if up["ingredients"] is None]
+    return add_detected_batch(job["user_name"], detected, failed)
+
+job_queue = None
+# Created on first use; unfinished jobs from the last run are resumed then
+def get_job_queue():
+    global job_queue
+    if job_queue is None:
+        with setup_lock:
+            if job_queue is None:
+                handlers = {"detect": run_detection_job, "detect_batch": run_batch_detection_job}
+                job_queue = JobQueue(JOBS_FILE, handlers, DETECT_WORKERS, JOB_STALE_AFTER)
+    return job_queue
+
+# Start the workers with the first request so leftover jobs resume right away
+@before_request
+def start_job_queue():
+    get_job_queue()
 
 # User Sign up
-@app.route("/signup", methods=["GET", "POST"])
+@route("/signup", methods=["GET", "POST"])
 def signup():
     if request.method == "POST":
         user_name = request.form.get("user_name", "").strip()
@@ -901,27 +1684,24 @@ def signup():
             flash("Username and password are required.")
             return redirect(url_for("signup"))
 
-        db = load_db()
-        ok = create_user(db, user_name, password)
+        ok = create_user(user_name, password)
         if not ok:
             flash("Username already taken. Please choose another one.")
             return redirect(url_for("signup"))
 
-        save_db(db)
         session["user_name"] = user_name  # Log them in
         flash("Account created! Please complete your profile.")
         return redirect(url_for("profile_setup"))
 
     return render_template("signup.html")
 # User Login 
-@app.route("/login", methods=["GET", "POST"])
+@route("/login", methods=["GET", "POST"])
 def login():
     if request.method == "POST":
         user_name = request.form.get("user_name", "").strip()
         password = request.form.get("password", "").strip()
 
-        db = load_db()
-        user = get_user(db, user_name)
+        user = get_user(user_name)
 
         if not user or user.get("password") != password:
             flash("Invalid username or password.")
@@ -934,34 +1714,32 @@ def login():
     return render_template("login.html")
 
 # Log out user
-@app.route("/logout")
+@route("/logout")
 def logout():
-    session.pop("user_name", None)
+    forget_conversation(session.pop("user_name", None))
     flash("You have been logged out.")
     return redirect(url_for("index"))
 
 
 # Load Main Nutribot page
-@app.route("/", methods=["GET"])
+@route("/", methods=["GET"])
 def index():
     return render_template("login.html")
 
-@app.route("/weight-journey", methods=["GET"])
+@route("/weight-journey", methods=["GET"])
 def weight_journey():
     """Show weight tracking dashboard"""
     user_name = require_login()
     if not user_name:
         return redirect(url_for("login"))
     
-    db = load_db()
-    user = get_user(db, user_name)
-    user = ensure_user_profile(user)
-    
-    # Prepare data for chart
-    weight_history = user.get("weight_history", [])
+    user = get_user(user_name)
+    user = ensure_user_profile(user_name, user)
     
-    # Get last 10 entries for display
-    recent_entries = weight_history[-10:] if len(weight_history) > 10 else weight_history
+    # Last 10 entries for display; the chart loads from weight_chart_data
+    recent_entries = history_entries(user["weight_history"], -10)
+    for entry in recent_entries:
+        entry["date"] = format_time(datetime.fromtimestamp(entry["ts"]))
     
     # Get user's goal
     goal = user["profile"].get("goal", "maintain")
@@ -984,10 +1762,6 @@ def weight_journey():
             # For maintenance: small changes are good
             recent_entries[i]["change_is_good"] = abs(change) < 0.5
     
-    # Prepare chart data
-    chart_dates = [entry["date"] for entry in weight_history[-30:]]
-    chart_weights = [entry["weight"] for entry in weight_history[-30:]]
-    
     # Calculate progress - handle None values
     current_weight = user["profile"]["weight"]
     target_weight = user["profile"].get("target_weight")
@@ -1001,9 +1775,8 @@ def weight_journey():
     
     weight_to_go = round(target_weight - current_weight, 1)
     
-    # Convert to JSON strings
-    chart_dates_json = json.dumps(chart_dates)
-    chart_weights_json = json.dumps(chart_weights)
+    trends = trend_summary(get_trends(user), user["profile"].get("target_weight"))
+    milestone_state = get_milestone_state(user)
     
     return render_template("weight_log.html",
                          user_name=user_name,
@@ -1011,15 +1784,78 @@ def weight_journey():
                          target_weight=target_weight,
                          weight_to_go=weight_to_go,
                          recent_entries=recent_entries,
-                         chart_dates_json=chart_dates_json,
-                         chart_weights_json=chart_weights_json,
+                         trends=trends,
                          milestones=user.get("milestones", []),
+                         streak=current_streak(milestone_state),
+                         longest_streak=milestone_state["longest_streak"],
                          chat_response=session.pop('weight_chat_response', None),
                          user=user,
                          goal=goal,
                          abs=abs)  # Pass goal to template
-    
-@app.route("/log-weight", methods=["POST"])
+
+# Stored trend aggregates; histories logged before they existed get one
+# NumPy pass (not saved, the next log_weight stores them)
+def get_trends(user):
+    state = user.get("trends")
+    if state and state["count"] == len(user["weight_history"]["ts"]):
+        return state
+    return compute_trends(user["weight_history"])
+
+# Moving averages, weekly rate and projected goal date as JSON
+@route("/weight-journey/trends", methods=["GET"])
+def weight_trends_data():
+    user_name = require_login()
+    if not user_name:
+        return jsonify({"error": "not_logged_in"}), 401
+
+    user = get_user(user_name)
+    return jsonify(trend_summary(get_trends(user), user["profile"].get("target_weight")) or {})
+
+CHART_MIN_POINTS = 3  # LTTB keeps first and last plus one point per bucket
+CHART_MAX_POINTS = 2000
+
+# Parse a chart range bound: epoch seconds or an ISO date ("2025-01-31")
+def parse_time_param(value):
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+# Parse the chart's point count; ValueError unless a positive integer
+def parse_points_param(value):
+    points = int(value)
+    if points <= 0:
+        raise ValueError(f"points must be positive, got {points}")
+    return max(CHART_MIN_POINTS, min(points, CHART_MAX_POINTS))
+
+# Chart data for any time range, downsampled (LTTB) to at most `points`
+@route("/weight-journey/chart", methods=["GET"])
+def weight_chart_data():
+    user_name = require_login()
+    if not user_name:
+        return jsonify({"error": "not_logged_in"}), 401
+
+    try:
+        start = parse_time_param(request.args.get("start"))
+        end = parse_time_param(request.args.get("end"))
+    except ValueError:
+        return jsonify({"error": "bad_range"}), 400
+    try:
+        points = parse_points_param(request.args.get("points", 300))
+    except ValueError:
+        return jsonify({"error": "bad_points"}), 400
+
+    timestamps, weights, total = chart_points(get_user(user_name)["weight_history"], start, end, points)
+    return jsonify({
+        "timestamps": timestamps.tolist(),
+        "labels": [datetime.fromtimestamp(ts).strftime("%d/%m/%y") for ts in timestamps],
+        "weights": weights.tolist(),
+        "total": total,
+    })
+
+@route("/log-weight", methods=["POST"])
 def log_weight():
     """Log a new weight entry"""
     user_name = require_login()
@@ -1029,99 +1865,149 @@ def log_weight():
     weight = float(request.form.get("weight"))
     notes = request.form.get("notes", "")
     
-    db = load_db()
-    user = get_user(db, user_name)
+    user = get_user(user_name)
+    profile = user["profile"]
+    metrics = profile_metrics(weight, profile["height"], profile.get("age"), profile.get("gender"))
     
     # Create weight entry
     entry = {
-        "id": str(uuid4()),
-        "date": format_time(),
+        "ts": time.time(),
         "weight": weight,
         "notes": notes,
-        "bmi": calculate_bmi(weight, user["profile"]["height"])
+        "bmi": metrics["bmi"]
     }
     
     # Add to history
-    if "weight_history" not in user:
-        user["weight_history"] = []
-    user["weight_history"].append(entry)
+    changes = [{"op": "weight_add", "entry": entry}]
     
-    # Update BOTH weight fields in profile
-    user["profile"]["weight"] = weight
-    user["profile"]["current_weight"] = weight  # Update this too!
-    user["profile"]["bmi"] = entry["bmi"]
+    # Update BOTH weight fields in profile, plus BMI, category and calories
+    profile_values = {
+        "weight": weight,
+        "current_weight": weight,  # Update this too!
+    }
+    profile_values.update({k: v for k, v in metrics.items() if v is not None})
+    changes.append({"op": "profile", "values": profile_values})
+    # Trends and milestones below are computed from the new entry
+    apply_changes(user, changes)
     
-    # Recalculate BMI category
-    if entry["bmi"]:
-        if entry["bmi"] < 18.5:
-            user["profile"]["bmi_category"] = "Underweight"
-        elif entry["bmi"] < 25:
-            user["profile"]["bmi_category"] = "Normal"
-        elif entry["bmi"] < 30:
-            user["profile"]["bmi_category"] = "Overweight"
-        else:
-            user["profile"]["bmi_category"] = "Obese"
+    # Trend aggregates take the new entry in O(1)
+    trends = update_trends(user.get("trends"), user["weight_history"])
+    derived = [{"op": "set", "field": "trends", "value": trends}]
     
     # Check for milestones
-    check_milestones(user)
-    
-    save_db(db)
+    milestone_state, unlocked = check_milestones(user)
+    derived.append({"op": "set", "field": "milestone_state", "value": milestone_state})
+    if unlocked:
+        derived.append({"op": "set", "field": "milestones", "value": user.get("milestones", []) + unlocked})
+    apply_changes(user, derived)
+    # One store write for the weigh-in and everything derived from it
+    get_store().commit_changes(user_name, changes + derived)
+
     flash(f"Weight logged: {weight} kg ✅")
     return redirect(url_for("weight_journey"))
 
 def check_milestones(user):
-    """Check and unlock achievements"""
-    weight_history = user.get("weight_history", [])
-    milestones = user.get("milestones", [])
-    
-    # Milestone 1: First log
-    if len(weight_history) == 1 and not any(m["id"] == "first_log" for m in milestones):
-        milestones.append({
-            "id": "first_log",
-            "title": "First Step",
-            "description": "Logged your first weight",
-            "icon": "flag",
-            "date": format_time()
-        })
-    
-    # Milestone 2: 7-day streak
-    if len(weight_history) >= 7 and not any(m["id"] == "week_streak" for m in milestones):
-        milestones.append({
-            "id": "week_streak",
-            "title": "Weekly Warrior",
-            "description": "7 consecutive days of logging",
-            "icon": "calendar-check",
-            "date": format_time()
-        })
-    
-    # Milestone 3: Reached goal weight
-    current_weight = user["profile"]["weight"]
-    target_weight = user["profile"].get("target_weight")
-    if target_weight and abs(current_weight - target_weight) < 0.5:
-        if not any(m["id"] == "goal_reached" for m in milestones):
-            milestones.append({
-                "id": "goal_reached",
-                "title": "Goal Achieved!",
-                "description": "Reached target weight",
-                "icon": "trophy",
-                "date": format_time()
-            })
-    
-    # Milestone 4: 5kg milestone
-    if len(weight_history) > 1:
-        total_change = weight_history[-1]["weight"] - weight_history[0]["weight"]
-        if abs(total_change) >= 5 and not any(m["id"] == "5kg_change" for m in milestones):
-            direction = "lost" if total_change < 0 else "gained"
-            milestones.append({
-                "id": "5kg_change",
-                "title": f"5kg {direction}!",
-                "description": f"Successfully {direction} 5 kilograms",
-                "icon": "weight-scale",
-                "date": format_time()
-            })
-    
-    user["milestones"] = milestones
+    """Fold the newest weigh-in into the milestone state and unlock achievements"""
+    state = update_milestones(user.get("milestone_state"), user["weight_history"],
+                              user.get("milestones", []))
+    unlocked = check_rules(state, user["profile"].get("target_weight"), time.time())
+    for milestone in unlocked:
+        milestone["date"] = format_time()
+    return state, unlocked
+
+# Stored milestone state, rebuilt (not saved) for users who predate it
+def get_milestone_state(user):
+    state = user.get("milestone_state")
+    if state and state["count"] == len(user["weight_history"]["ts"]):
+        return state
+    return build_state(user["weight_history"], user.get("milestones", []))
+
+# =========================
+# CLI commands
+# =========================
+# Commands run in the app context, so they use the paths the app was
+# created with, not the module defaults
+# One-shot copy of the legacy JSON file into SQLite: flask migrate-db
+@cli_command("migrate-db")
+def migrate_db_command():
+    db_file, sqlite_file = current_app.config["DB_FILE"], current_app.config["SQLITE_FILE"]
+    count = migrate(JsonStore(db_file), SqliteStore(sqlite_file))
+    print(f"Migrated {count} users from {db_file} to {sqlite_file}")
+
+# Fold the change journal into a new snapshot: flask compact-db
+# (the server also compacts on its own every 10000 records)
+@cli_command("compact-db")
+def compact_db_command():
+    db_file = current_app.config["DB_FILE"]
+    journal_store = JournalStore(db_file, current_app.config["JOURNAL_FILE"])
+    folded = journal_store.compact()
+    journal_store.close()
+    print(f"Folded {folded} journal records into {db_file}")
+
+# Re-derive BMI, category and daily calories for every user after a formula
+# change, written back in one commit: flask recompute-metrics
+# (run it with the server stopped; a running server's user cache is not
+# refreshed)
+@cli_command("recompute-metrics")
+def recompute_metrics_command():
+    report = recompute_store(get_store())
+    get_store().close()
+    changed = ", ".join(f"{field}: {count}" for field, count in report["changed_fields"].items())
+    print(f"Checked {report['users']} users, updated {report['updated_users']} ({changed})")
+    print(f"load {report['load_s']}s, compute {report['compute_s']}s, write {report['write_s']}s")
+
+# =========================
+# App factory
+# =========================
+# Settings that are only right in a single process need SINGLE_PROCESS
+def check_processes(config):
+    if config["SINGLE_PROCESS"]:
+        return
+    if config["STORE_BACKEND"] == "journal":
+        raise RuntimeError(
+            "The journal store keeps users in process memory; set "
+            "NUTRIBOT_SINGLE_PROCESS=1 to run one server process on it, "
+            "or use NUTRIBOT_STORE=sqlite (or json)"
+        )
+    if config["CACHE_ENABLED"]:
+        print("Write-behind user cache off (it needs NUTRIBOT_SINGLE_PROCESS=1); users are read from the store")
+
+# Generated once and kept in `path`; the first worker to start writes it
+def shared_secret_key(path):
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        for _ in range(50):  # another worker may be writing it right now
+            with open(path, encoding="utf-8") as f:
+                key = f.read().strip()
+            if key:
+                return key
+            time.sleep(0.1)
+        raise RuntimeError(f"Secret key file {path} is empty")
+    key = secrets.token_hex(32)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(key)
+    return key
+
+# gunicorn -w 4 "server:create_app()"; flask run finds the factory itself.
+# The store is opened once per process, with the config of the first app
+def create_app(config=None):
+    global store_config
+    app = Flask(__name__)
+    app.config.update(load_config())
+    app.config.update(config or {})
+    check_processes(app.config)
+    app.secret_key = app.config["SECRET_KEY"] or shared_secret_key(SECRET_KEY_FILE)
+    store_config = app.config
+    for rule, options, view in routes:
+        app.add_url_rule(rule, view_func=view, **options)
+    for hook in before_request_hooks:
+        app.before_request(hook)
+    for name, command in cli_commands:
+        app.cli.command(name)(command)
+    return app
 
 # Run Main
 if __name__ == "__main__":
-    app.run(debug=True)
+    app = create_app()
+    app.run(debug=app.config["DEBUG"])
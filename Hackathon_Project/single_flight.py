@@ -0,0 +1,291 @@
+# =========================
+# Single-flight LLM requests
+# =========================
+# Identical requests that arrive while one is already in flight wait for it
+# and share its result instead of calling the API again:
+#   - within a process, the first caller for a key is the leader; callers
+#     that arrive while it runs block until it finishes or fails
+#   - with a shared SQLite file, the leader of each process first claims
+#     the key in a `flights` table. If another process holds it, it polls
+#     for that result and hands it to its own waiters. A claim is a lease:
+#     if its owner dies, the first waiter to notice takes the request over
+# Results are kept for `result_ttl` seconds, so a caller that arrives just
+# after the leader finished still gets them. To cross processes a result
+# must be JSON-serialisable.
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from uuid import uuid4
+
+from caching import LRUCache
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS flights (
+    key        TEXT PRIMARY KEY,
+    owner      TEXT NOT NULL,
+    status     TEXT NOT NULL,
+    result     TEXT,
+    error      TEXT,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_flights_expires ON flights(expires_at);
+"""
+
+POLL_MIN = 0.02  # seconds between looks at a flight owned by another process
+POLL_MAX = 0.25
+
+
+class FlightFailed(Exception):
+    """The leader in another process failed; carries its error message."""
+
+
+class FlightAbandoned(Exception):
+    """The leader stopped without a result (e.g. its client went away)."""
+
+
+def request_key(endpoint, payload):
+    """Stable key for a request payload; dict order and spacing don't matter."""
+    blob = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return f"{endpoint}:{hashlib.sha256(blob.encode('utf-8')).hexdigest()}"
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class Flight:
+    """One caller's part in a request. The leader makes the call and must
+    finish() or fail() it; everyone else reads the shared result()."""
+
+    def __init__(self, group, key, call, leader):
+        self.group = group
+        self.key = key
+        self.call = call
+        self.leader = leader
+        self.claimed = False  # holds the key in the shared table
+
+    def result(self, timeout=None):
+        if not self.call.event.wait(self.group.wait_timeout if timeout is None else timeout):
+            raise TimeoutError("Timed out waiting for an identical request")
+        if self.call.error is not None:
+            raise self.call.error
+        return self.call.value
+
+    def finish(self, value):
+        self.group._settle(self, value, None)
+
+    def fail(self, error):
+        self.group._settle(self, None, error)
+
+    def abandon(self):
+        # No-op once finished or failed; otherwise waiters retry on their own
+        if self.leader and not self.call.event.is_set():
+            self.group._settle(self, None, FlightAbandoned(self.key))
+
+
+class SingleFlight:
+    def __init__(self, path=None, lease=60.0, wait_timeout=None, result_ttl=5.0, maxsize=1024):
+        self.path = path
+        self.lease = lease  # how long a claim in the shared table holds
+        self.wait_timeout = wait_timeout or lease
+        self.result_ttl = result_ttl
+        self.owner = f"{os.getpid()}:{uuid4().hex[:8]}"
+        self.recent = LRUCache(maxsize, result_ttl)
+        self.calls = {}  # key -> _Call in flight in this process
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.counters = {
+            "leaders": 0, "followers": 0, "recent_hits": 0, "shared_waits": 0,
+            "shared_hits": 0, "takeovers": 0, "failures": 0, "abandoned": 0,
+        }
+
+    def connect(self):
+        # Opened on first use, so creating a SingleFlight touches no files
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            self.local.conn = conn
+        return conn
+
+    def do(self, key, fn):
+        """fn() once for all concurrent callers with the same key."""
+        flight = self.join(key)
+        if not flight.leader:
+            return flight.result()
+        try:
+            value = fn()
+        except Exception as e:
+            flight.fail(e)
+            raise
+        except BaseException:
+            flight.abandon()
+            raise
+        flight.finish(value)
+        return value
+
+    def join(self, key):
+        """Lead the request for `key`, or wait until its leader is done.
+        A follower's flight holds the result; if the leader gave up, the
+        request is joined again, usually as the new leader."""
+        while True:
+            flight = self._begin(key)
+            if flight.leader:
+                return flight
+            try:
+                flight.result()
+            except FlightAbandoned:
+                continue
+            except Exception:
+                pass  # the leader's error; result() raises it for the caller
+            return flight
+
+    def _begin(self, key):
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None:
+                self.counters["followers"] += 1
+                return Flight(self, key, call, leader=False)
+            call = _Call()
+            value = self.recent.get(key)
+            if value is not None:
+                self.counters["recent_hits"] += 1
+                call.value = value
+                call.event.set()
+                return Flight(self, key, call, leader=False)
+            self.calls[key] = call
+        flight = Flight(self, key, call, leader=True)
+        if self.path:
+            # This thread speaks for the whole process to the other ones
+            try:
+                self._join_shared(flight)
+            except sqlite3.Error as e:
+                print(f"Single-flight table unavailable, coalescing in this process only: {e}")
+        if flight.leader:
+            self._count("leaders")
+        return flight
+
+    def _join_shared(self, flight):
+        waited = False
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            row = self._claim(flight.key)
+            if row is None:
+                flight.claimed = True
+                if waited:
+                    self._count("takeovers")
+                return
+            status, result, error, expires_at = row
+            if status == "done":
+                self._count("shared_hits")
+                self._follow(flight, json.loads(result), None)
+                return
+            if status == "failed":
+                self._follow(flight, None, FlightFailed(error))
+                return
+            if not waited:
+                waited = True
+                self._count("shared_waits")
+            # Running in another process: poll until it is done or its lease runs out
+            delay = POLL_MIN
+            while True:
+                if time.monotonic() >= deadline:
+                    self._follow(flight, None, TimeoutError("Timed out waiting for an identical request"))
+                    return
+                time.sleep(delay)
+                delay = min(POLL_MAX, delay * 2)
+                row = self._read(flight.key)
+                if row is None or row[0] != "running" or row[3] < time.time():
+                    break
+            if row is not None and row[0] == "failed":
+                self._follow(flight, None, FlightFailed(row[2]))
+                return
+
+    def _claim(self, key):
+        """None when this process now owns `key`, else (status, result, error, expires_at)."""
+        now = time.time()
+        with self.connect() as conn:
+            cursor = conn.execute(
+                "INSERT INTO flights (key, owner, status, expires_at) VALUES (?, ?, 'running', ?) "
+                "ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, status = 'running', "
+                "result = NULL, error = NULL, expires_at = excluded.expires_at "
+                "WHERE flights.expires_at < ?",
+                (key, self.owner, now + self.lease, now),
+            )
+            if cursor.rowcount == 1:
+                return None
+            return conn.execute(
+                "SELECT status, result, error, expires_at FROM flights WHERE key = ?", (key,)
+            ).fetchone() or ("running", None, None, 0.0)
+
+    def _read(self, key):
+        return self.connect().execute(
+            "SELECT status, result, error, expires_at FROM flights WHERE key = ?", (key,)
+        ).fetchone()
+
+    def _publish(self, flight, value, error):
+        now = time.time()
+        with self.connect() as conn:
+            if isinstance(error, FlightAbandoned):
+                conn.execute("DELETE FROM flights WHERE key = ? AND owner = ?", (flight.key, self.owner))
+            elif error is not None:
+                # Waiters see the failure; new callers may claim the key at once
+                conn.execute(
+                    "UPDATE flights SET status = 'failed', error = ?, expires_at = ? WHERE key = ? AND owner = ?",
+                    (f"{type(error).__name__}: {error}", now, flight.key, self.owner),
+                )
+            else:
+                conn.execute(
+                    "UPDATE flights SET status = 'done', result = ?, expires_at = ? WHERE key = ? AND owner = ?",
+                    (json.dumps(value), now + self.result_ttl, flight.key, self.owner),
+                )
+            conn.execute("DELETE FROM flights WHERE expires_at < ?", (now - self.result_ttl,))
+
+    def _settle(self, flight, value, error):
+        if flight.call.event.is_set():
+            return
+        if flight.claimed:
+            try:
+                self._publish(flight, value, error)
+            except (sqlite3.Error, TypeError, ValueError) as e:
+                # Other processes take over when the lease runs out
+                print(f"Could not share single-flight result: {e}")
+        if error is None:
+            self.recent.set(flight.key, value)
+        else:
+            self._count("abandoned" if isinstance(error, FlightAbandoned) else "failures")
+        self._set(flight.call, flight.key, value, error)
+
+    def _follow(self, flight, value, error):
+        # Another process led this request; pass its result to our waiters
+        flight.leader = False
+        if error is None:
+            self.recent.set(flight.key, value)
+        self._set(flight.call, flight.key, value, error)
+
+    def _set(self, call, key, value, error):
+        with self.lock:
+            if self.calls.get(key) is call:
+                del self.calls[key]
+            call.value = value
+            call.error = error
+            call.event.set()
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["in_flight"] = len(self.calls)
+        stats["shared"] = bool(self.path)
+        stats["recent"] = len(self.recent)
+        return stats
@@ -24,6 +24,35 @@ function addMessage(sender, text) {
   msgDiv.innerHTML = `<b>${sender}:</b> ${text}`;
   chatbox.appendChild(msgDiv);
   chatbox.scrollTop = chatbox.scrollHeight;
+  return msgDiv;
+}
+
+// Read a text/event-stream response and call onEvent(event, data) per event
+async function readEventStream(res, onEvent) {
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    let boundary;
+    while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+      const raw = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+
+      let event = "message";
+      let data = "";
+      for (const line of raw.split("\n")) {
+        if (line.startsWith("event: ")) event = line.slice(7);
+        else if (line.startsWith("data: ")) data += line.slice(6);
+      }
+      if (event === "done") return;
+      onEvent(event, data ? JSON.parse(data) : {});
+    }
+  }
 }
 
 function showTypingIndicator() {
@@ -55,28 +84,48 @@ attachBtn.addEventListener("click", () => {
 imageInput.addEventListener("change", async () => {
   if (!imageInput.files.length) return;
 
-  const file = imageInput.files[0];
-  addMessage("You", "📎 Uploaded an image");
+  // Several photos go to the batch endpoint in one request
+  const files = Array.from(imageInput.files);
+  const isBatch = files.length > 1;
+  addMessage("You", isBatch ? `📎 Uploaded ${files.length} images` : "📎 Uploaded an image");
 
   const formData = new FormData();
-  formData.append("photo", file);
+  files.forEach((file) => formData.append(isBatch ? "photos" : "photo", file));
   try {
     showTypingIndicator();
-    const res = await fetch("/upload_grocery", {
+    const res = await fetch(isBatch ? "/upload_groceries" : "/upload_grocery", {
       method: "POST",
       body: formData,
     });
 
     const data = await res.json();
-    const replyText = data.reply || "Image uploaded to pantry.";
-    addMessage("Bot", replyText);
+    if (data.status_url) {
+      // Detection runs in the background; wait for its result
+      const job = await pollJob(data.status_url);
+      hideTypingIndicator();
+      addMessage("Bot", job.reply || "Image uploaded to pantry.");
+    } else {
+      hideTypingIndicator();
+      addMessage("Bot", data.reply || "Image uploaded to pantry.");
+    }
   } catch (err) {
     console.error(err);
+    hideTypingIndicator();
     addMessage("Bot", "Sorry, there was a problem uploading the image.");
   }
   imageInput.value = "";
 });
 
+// Poll a background job until it is done or failed
+async function pollJob(statusUrl, intervalMs = 1000) {
+  while (true) {
+    const res = await fetch(statusUrl);
+    const job = await res.json();
+    if (!res.ok || job.status === "done" || job.status === "failed") return job;
+    await new Promise((resolve) => setTimeout(resolve, intervalMs));
+  }
+}
+
 async function sendMessage() {
   const input = document.getElementById("input");
   const message = input.value.trim();
@@ -93,21 +142,37 @@ async function sendMessage() {
   }, 1000); // 1000ms = 1 second
 
   try {
-    const res = await fetch("/chat", {
+    const res = await fetch("/chat/stream", {
       method: "POST",
       headers: { "Content-Type": "application/json" },
       body: JSON.stringify({ message }),
     });
 
-    const data = await res.json();
+    let botDiv = null;
+    let botText = "";
 
-    // Cancel the timer if response came back fast
-    clearTimeout(typingTimeout);
+    // Render each token as soon as it arrives
+    await readEventStream(res, (event, data) => {
+      if (event !== "token" && event !== "reply") return;
 
-    // Hide dots if they already appeared
-    hideTypingIndicator();
+      // Cancel the timer if response came back fast
+      clearTimeout(typingTimeout);
 
-    addMessage("Bot", data.reply);
+      // Hide dots if they already appeared
+      hideTypingIndicator();
+
+      botText += data.text;
+      if (!botDiv) {
+        botDiv = addMessage("Bot", botText);
+      } else {
+        botDiv.innerHTML = `<b>Bot:</b> ${botText}`;
+        chatbox.scrollTop = chatbox.scrollHeight;
+      }
+    });
+
+    clearTimeout(typingTimeout);
+    hideTypingIndicator();
+    if (!botDiv) throw new Error("Empty reply stream");
   } catch (err) {
     console.error(err);
 
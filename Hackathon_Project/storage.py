@@ -0,0 +1,990 @@
+# =========================
+# Storage backends
+# =========================
+# Every backend exposes the same per-user interface so a request only
+# reads and writes the record of the user it is serving:
+#
+#   get_user(user_name)            -> dict or None
+#   put_user(user_name, user)      -> replace one user record
+#   create_user(user_name, user)   -> False if the name is taken
+#   iter_users()                   -> (user_name, user) pairs
+#   iter_profiles()                -> (user_name, profile) pairs, cheaper
+#   count_image_refs(image_path)   -> image records (any user) using a file
+#   commit_changes(user_name, changes)
+#                                  -> persist small changes (see apply_change)
+#
+# JsonStore keeps the legacy db_groceries.json layout, SqliteStore keeps
+# users, groceries, images and weight_history in indexed tables and
+# JournalStore appends change records to a log over a compacted snapshot.
+import atexit
+import copy
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from uuid import uuid4
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from pantry import as_pantry, pantry_add, pantry_items, pantry_remove
+from weight_series import as_history, entry_timestamps, history_add, history_entries, json_default
+from conversation import as_memory, empty_memory
+
+
+# =========================
+# Change records
+# =========================
+# A change describes one small mutation of a user record. Callers apply it
+# to the user they hold and hand it to commit_changes() so backends can
+# persist just the change instead of the whole record:
+#
+#   {"op": "append", "field": "images", "item": {...}}
+#   {"op": "remove", "field": "images", "id": "<item id>"}
+#   {"op": "set", "field": "milestones", "value": [...]}
+#   {"op": "profile", "values": {"weight": 80.0, ...}}
+#   {"op": "pantry_add", "item": {...}}   merges by name into the pantry
+#   {"op": "pantry_remove", "id": "<item id>"}
+#   {"op": "weight_add", "entry": {"ts", "weight", "bmi", "notes"}}
+def apply_change(user, change):
+    op = change["op"]
+    if op == "append":
+        user.setdefault(change["field"], []).append(change["item"])
+    elif op == "remove":
+        items = user.get(change["field"], [])
+        user[change["field"]] = [i for i in items if i["id"] != change["id"]]
+    elif op == "set":
+        user[change["field"]] = change["value"]
+    elif op == "profile":
+        user.setdefault("profile", {}).update(change["values"])
+    elif op == "pantry_add":
+        user["groceries"] = as_pantry(user.get("groceries"))
+        pantry_add(user["groceries"], change["item"])
+    elif op == "pantry_remove":
+        user["groceries"] = as_pantry(user.get("groceries"))
+        pantry_remove(user["groceries"], change["id"])
+    elif op == "weight_add":
+        user["weight_history"] = as_history(user.get("weight_history"))
+        entry = change["entry"]
+        history_add(user["weight_history"], entry["ts"], entry["weight"], entry.get("bmi"), entry.get("notes"))
+    else:
+        raise ValueError(f"Unknown change op: {op}")
+
+
+# Bring a record written by an older version up to the current layout
+def upgrade_user(user):
+    user["groceries"] = as_pantry(user.get("groceries"))
+    user["weight_history"] = as_history(user.get("weight_history"))
+    user["chat_history"] = as_memory(user.get("chat_history"))
+    return user
+
+
+class BaseStore:
+    def get_user(self, user_name):
+        raise NotImplementedError
+
+    def put_user(self, user_name, user):
+        raise NotImplementedError
+
+    def create_user(self, user_name, user):
+        raise NotImplementedError
+
+    def iter_users(self):
+        raise NotImplementedError
+
+    def iter_profiles(self):
+        for user_name, user in self.iter_users():
+            yield user_name, user.get("profile", {})
+
+    def put_users(self, users):
+        for user_name, user in users.items():
+            self.put_user(user_name, user)
+
+    def commit_changes(self, user_name, changes):
+        self.commit_many({user_name: changes})
+
+    def commit_many(self, changes_by_user):
+        # Fallback: read-modify-write of each user record
+        for user_name, changes in changes_by_user.items():
+            user = self.get_user(user_name)
+            if user is None:
+                continue
+            for change in changes:
+                apply_change(user, change)
+            self.put_user(user_name, user)
+
+    def count_users(self):
+        return sum(1 for _ in self.iter_users())
+
+    def count_image_refs(self, image_path):
+        return sum(
+            1
+            for _, user in self.iter_users()
+            for img in user.get("images", [])
+            if img["image_path"] == image_path
+        )
+
+    def close(self):
+        pass
+
+
+# =========================
+# Legacy JSON file backend
+# =========================
+class JsonStore(BaseStore):
+    """Whole-file JSON database (db_groceries.json).
+
+    Writes are read-modify-write of the whole file, done while holding a lock
+    file so several server processes can share it without losing updates.
+    Reads need no lock: the file is only ever replaced atomically.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = f"{path}.lock"
+        self.lock = threading.RLock()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {"users": {}}
+        with open(self.path, "r", encoding="utf-8") as f:
+            db = json.load(f)
+        for user in db.get("users", {}).values():
+            upgrade_user(user)
+        return db
+
+    def save(self, db):
+        write_json_atomic(self.path, db, indent=2)
+
+    def get_user(self, user_name):
+        with self.lock:
+            return self.load().get("users", {}).get(user_name)
+
+    def put_user(self, user_name, user):
+        self.put_users({user_name: user})
+
+    def put_users(self, users):
+        with self.lock, file_lock(self.lock_path):
+            db = self.load()
+            db.setdefault("users", {}).update(users)
+            self.save(db)
+
+    def create_user(self, user_name, user):
+        with self.lock, file_lock(self.lock_path):
+            db = self.load()
+            db.setdefault("users", {})
+            if user_name in db["users"]:
+                return False
+            db["users"][user_name] = user
+            self.save(db)
+            return True
+
+    def commit_many(self, changes_by_user):
+        with self.lock, file_lock(self.lock_path):
+            db = self.load()
+            users = db.setdefault("users", {})
+            for user_name, changes in changes_by_user.items():
+                if user_name in users:
+                    for change in changes:
+                        apply_change(users[user_name], change)
+            self.save(db)
+
+    def iter_users(self):
+        with self.lock:
+            users = self.load().get("users", {})
+        return iter(list(users.items()))
+
+
+# Write to a temp file, fsync, then atomically rename over the target so a
+# crash never leaves a truncated file behind (the temp name is unique, so
+# concurrent writers can't interleave in it)
+def write_json_atomic(path, data, **dump_kwargs):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, default=json_default, **dump_kwargs)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+# Exclusive lock on a file, across processes; held by one thread at a time,
+# and not re-entrant
+@contextmanager
+def file_lock(path):
+    with open(path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:  # LK_LOCK gives up after 10 seconds
+                    pass
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+# =========================
+# SQLite backend
+# =========================
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_name    TEXT PRIMARY KEY,
+    password     TEXT NOT NULL,
+    profile      TEXT NOT NULL,
+    goals        TEXT NOT NULL,
+    milestones   TEXT NOT NULL,
+    chat_history TEXT NOT NULL,
+    extra        TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS groceries (
+    id        TEXT PRIMARY KEY,
+    user_name TEXT NOT NULL REFERENCES users(user_name) ON DELETE CASCADE,
+    position  INTEGER NOT NULL,
+    name      TEXT NOT NULL,
+    quantity  REAL,
+    unit      TEXT,
+    added_at  TEXT,
+    extra     TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_groceries_user ON groceries(user_name, position);
+CREATE INDEX IF NOT EXISTS idx_groceries_name ON groceries(user_name, name);
+CREATE TABLE IF NOT EXISTS images (
+    id             TEXT PRIMARY KEY,
+    user_name      TEXT NOT NULL REFERENCES users(user_name) ON DELETE CASCADE,
+    position       INTEGER NOT NULL,
+    image_path     TEXT NOT NULL,
+    detected_items TEXT NOT NULL,
+    uploaded_at    TEXT,
+    extra          TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_images_user ON images(user_name, position);
+CREATE INDEX IF NOT EXISTS idx_images_path ON images(image_path);
+CREATE TABLE IF NOT EXISTS weight_history (
+    id        TEXT PRIMARY KEY,
+    user_name TEXT NOT NULL REFERENCES users(user_name) ON DELETE CASCADE,
+    position  INTEGER NOT NULL,
+    date      TEXT,
+    weight    REAL NOT NULL,
+    notes     TEXT,
+    bmi       REAL,
+    extra     TEXT NOT NULL,
+    ts        REAL
+);
+CREATE INDEX IF NOT EXISTS idx_weight_history_user ON weight_history(user_name, position);
+"""
+
+# Columns stored natively per child table; any other keys go to "extra"
+CHILD_TABLES = {
+    "groceries": ("name", "quantity", "unit", "added_at"),
+    "images": ("image_path", "detected_items", "uploaded_at"),
+    "weight_history": ("date", "weight", "notes", "bmi", "ts"),
+}
+JSON_COLUMNS = {"detected_items"}
+USER_JSON_FIELDS = ("profile", "goals", "milestones", "chat_history")
+
+
+class SqliteStore(BaseStore):
+    """Per-user rows in SQLite; one connection per thread."""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.connect().executescript(SCHEMA)
+        with self.transaction() as conn:
+            self._merge_duplicate_groceries(conn)
+            self._backfill_weight_timestamps(conn)
+
+    def _merge_duplicate_groceries(self, conn):
+        # Older versions added a row per detection; fold them into one row
+        # per ingredient the same way as_pantry() does
+        duplicates = conn.execute(
+            "SELECT user_name, name FROM groceries "
+            "GROUP BY user_name, name HAVING COUNT(*) > 1"
+        ).fetchall()
+        for dup in duplicates:
+            rows = conn.execute(
+                "SELECT id, quantity, added_at, extra FROM groceries "
+                "WHERE user_name = ? AND name = ? ORDER BY position",
+                (dup["user_name"], dup["name"]),
+            ).fetchall()
+            keep = rows[0]
+            extra = json.loads(keep["extra"])
+            extra["updated_at"] = rows[-1]["added_at"]
+            conn.execute(
+                "UPDATE groceries SET quantity = ?, extra = ? WHERE id = ?",
+                (sum(row["quantity"] or 1 for row in rows), json.dumps(extra), keep["id"]),
+            )
+            conn.executemany(
+                "DELETE FROM groceries WHERE id = ?", [(row["id"],) for row in rows[1:]]
+            )
+        conn.execute("UPDATE groceries SET quantity = 1 WHERE quantity IS NULL")
+
+    def _backfill_weight_timestamps(self, conn):
+        # Older databases have no ts column and only "DD/MM HH:MM" dates
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(weight_history)")}
+        if "ts" not in columns:
+            conn.execute("ALTER TABLE weight_history ADD COLUMN ts REAL")
+        users = [
+            row["user_name"] for row in conn.execute(
+                "SELECT DISTINCT user_name FROM weight_history WHERE ts IS NULL"
+            )
+        ]
+        for user_name in users:
+            rows = conn.execute(
+                "SELECT id, date, ts FROM weight_history WHERE user_name = ? ORDER BY position",
+                (user_name,),
+            ).fetchall()
+            stamps = entry_timestamps([dict(row) for row in rows])
+            conn.executemany(
+                "UPDATE weight_history SET ts = ? WHERE id = ?",
+                [(ts, row["id"]) for ts, row in zip(stamps, rows)],
+            )
+
+    def connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self.local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE takes the write lock before the first read, so the
+        # existence check in create_user and the read-modify-write of JSON
+        # columns and quantities cannot interleave with another worker's
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    def get_user(self, user_name):
+        conn = self.connect()
+        row = conn.execute(
+            "SELECT * FROM users WHERE user_name = ?", (user_name,)
+        ).fetchone()
+        if row is None:
+            return None
+        user = json.loads(row["extra"])
+        user["password"] = row["password"]
+        for field in USER_JSON_FIELDS:
+            user[field] = json.loads(row[field])
+        for table, columns in CHILD_TABLES.items():
+            user[table] = self._load_children(conn, table, columns, user_name)
+        user["groceries"] = as_pantry(user["groceries"])
+        user["weight_history"] = as_history(user["weight_history"])
+        user["chat_history"] = as_memory(user["chat_history"])
+        return user
+
+    def _load_children(self, conn, table, columns, user_name):
+        rows = conn.execute(
+            f"SELECT * FROM {table} WHERE user_name = ? ORDER BY position",
+            (user_name,),
+        ).fetchall()
+        items = []
+        for row in rows:
+            item = {"id": row["id"]}
+            for column in columns:
+                value = row[column]
+                item[column] = json.loads(value) if column in JSON_COLUMNS else value
+            item.update(json.loads(row["extra"]))
+            items.append(item)
+        return items
+
+    def put_user(self, user_name, user):
+        with self.transaction() as conn:
+            self._write_user(conn, user_name, user)
+
+    def put_users(self, users):
+        with self.transaction() as conn:
+            for user_name, user in users.items():
+                self._write_user(conn, user_name, user)
+
+    def create_user(self, user_name, user):
+        with self.transaction() as conn:
+            exists = conn.execute(
+                "SELECT 1 FROM users WHERE user_name = ?", (user_name,)
+            ).fetchone()
+            if exists:
+                return False
+            self._write_user(conn, user_name, user)
+            return True
+
+    def _write_user(self, conn, user_name, user):
+        known = ("password",) + USER_JSON_FIELDS + tuple(CHILD_TABLES)
+        extra = {k: v for k, v in user.items() if k not in known}
+        conn.execute(
+            "INSERT INTO users "
+            "(user_name, password, profile, goals, milestones, chat_history, extra) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(user_name) DO UPDATE SET "
+            "password = excluded.password, profile = excluded.profile, "
+            "goals = excluded.goals, milestones = excluded.milestones, "
+            "chat_history = excluded.chat_history, extra = excluded.extra",
+            (
+                user_name,
+                user.get("password", ""),
+                json.dumps(user.get("profile", {})),
+                json.dumps(user.get("goals", {})),
+                json.dumps(user.get("milestones", [])),
+                json.dumps(user.get("chat_history") or empty_memory()),
+                json.dumps(extra),
+            ),
+        )
+        for table, columns in CHILD_TABLES.items():
+            items = user.get(table, [])
+            if table == "groceries":
+                items = pantry_items(as_pantry(items))
+            elif table == "weight_history":
+                items = [self._weight_row(entry) for entry in history_entries(as_history(items))]
+            self._write_children(conn, table, columns, user_name, items)
+
+    def _write_children(self, conn, table, columns, user_name, items):
+        conn.execute(f"DELETE FROM {table} WHERE user_name = ?", (user_name,))
+        for position, item in enumerate(items):
+            self._insert_child(conn, table, columns, user_name, position, item)
+
+    def _insert_child(self, conn, table, columns, user_name, position, item):
+        placeholders = ", ".join("?" * (len(columns) + 4))
+        values = []
+        for column in columns:
+            value = item.get(column)
+            values.append(json.dumps(value) if column in JSON_COLUMNS else value)
+        extra = {k: v for k, v in item.items() if k != "id" and k not in columns}
+        conn.execute(
+            f"INSERT OR REPLACE INTO {table} "
+            f"(id, user_name, position, {', '.join(columns)}, extra) "
+            f"VALUES ({placeholders})",
+            (item["id"], user_name, position, *values, json.dumps(extra)),
+        )
+
+    def commit_many(self, changes_by_user):
+        with self.transaction() as conn:
+            for user_name, changes in changes_by_user.items():
+                for change in changes:
+                    self._write_change(conn, user_name, change)
+
+    def _write_change(self, conn, user_name, change):
+        op, field = change["op"], change.get("field")
+        if op == "append" and field in CHILD_TABLES:
+            position = self._next_position(conn, field, user_name)
+            self._insert_child(conn, field, CHILD_TABLES[field], user_name, position, change["item"])
+        elif op == "pantry_add":
+            item = change["item"]
+            row = conn.execute(
+                "SELECT id, quantity, extra FROM groceries WHERE user_name = ? AND name = ?",
+                (user_name, item["name"]),
+            ).fetchone()
+            if row is None:
+                position = self._next_position(conn, "groceries", user_name)
+                item = dict(item, quantity=item.get("quantity") or 1)
+                self._insert_child(conn, "groceries", CHILD_TABLES["groceries"], user_name, position, item)
+            else:
+                extra = json.loads(row["extra"])
+                extra["updated_at"] = item.get("added_at")
+                conn.execute(
+                    "UPDATE groceries SET quantity = ?, extra = ? WHERE id = ?",
+                    ((row["quantity"] or 1) + (item.get("quantity") or 1), json.dumps(extra), row["id"]),
+                )
+        elif op == "pantry_remove":
+            conn.execute(
+                "DELETE FROM groceries WHERE id = ? AND user_name = ?",
+                (change["id"], user_name),
+            )
+        elif op == "weight_add":
+            position = self._next_position(conn, "weight_history", user_name)
+            row = self._weight_row(change["entry"])
+            self._insert_child(conn, "weight_history", CHILD_TABLES["weight_history"], user_name, position, row)
+        elif op == "remove" and field in CHILD_TABLES:
+            conn.execute(
+                f"DELETE FROM {field} WHERE id = ? AND user_name = ?",
+                (change["id"], user_name),
+            )
+        elif op == "set" and field in USER_JSON_FIELDS:
+            conn.execute(
+                f"UPDATE users SET {field} = ? WHERE user_name = ?",
+                (json.dumps(change["value"]), user_name),
+            )
+        elif op == "set" and field not in CHILD_TABLES and field != "password":
+            row = conn.execute(
+                "SELECT extra FROM users WHERE user_name = ?", (user_name,)
+            ).fetchone()
+            if row is not None:
+                extra = json.loads(row["extra"])
+                extra[field] = change["value"]
+                conn.execute(
+                    "UPDATE users SET extra = ? WHERE user_name = ?",
+                    (json.dumps(extra), user_name),
+                )
+        elif op == "profile":
+            row = conn.execute(
+                "SELECT profile FROM users WHERE user_name = ?", (user_name,)
+            ).fetchone()
+            if row is not None:
+                profile = json.loads(row["profile"])
+                profile.update(change["values"])
+                conn.execute(
+                    "UPDATE users SET profile = ? WHERE user_name = ?",
+                    (json.dumps(profile), user_name),
+                )
+        else:
+            # Anything without a dedicated column rewrites the user record
+            user = self.get_user(user_name)
+            if user is not None:
+                apply_change(user, change)
+                self._write_user(conn, user_name, user)
+
+    # One weight_history row; "date" is only kept for people reading the table
+    def _weight_row(self, entry):
+        return {
+            "id": str(uuid4()),
+            "date": datetime.fromtimestamp(entry["ts"]).strftime("%Y-%m-%d %H:%M"),
+            "weight": entry["weight"],
+            "notes": entry.get("notes") or "",
+            "bmi": entry.get("bmi"),
+            "ts": entry["ts"],
+        }
+
+    def _next_position(self, conn, table, user_name):
+        return conn.execute(
+            f"SELECT COALESCE(MAX(position) + 1, 0) FROM {table} WHERE user_name = ?",
+            (user_name,),
+        ).fetchone()[0]
+
+    def iter_users(self):
+        names = [
+            row["user_name"]
+            for row in self.connect().execute("SELECT user_name FROM users")
+        ]
+        for user_name in names:
+            yield user_name, self.get_user(user_name)
+
+    # One query instead of loading every user's child tables
+    def iter_profiles(self):
+        rows = self.connect().execute("SELECT user_name, profile FROM users").fetchall()
+        for row in rows:
+            yield row["user_name"], json.loads(row["profile"])
+
+    def count_users(self):
+        return self.connect().execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def count_image_refs(self, image_path):
+        return self.connect().execute(
+            "SELECT COUNT(*) FROM images WHERE image_path = ?", (image_path,)
+        ).fetchone()[0]
+
+    def close(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+
+# =========================
+# Write-behind cache
+# =========================
+class CachedStore(BaseStore):
+    """In-memory user cache over another store.
+
+    Reads are dictionary lookups once a user is loaded. Writes only mark the
+    user dirty; dirty users are flushed to the backend in one batch every
+    ``flush_interval`` seconds, after ``flush_every`` mutations, and on exit.
+    Users changed only through commit_changes() are flushed as their change
+    records; a put_user() flushes the whole record.
+
+    At most ``max_users`` users stay cached; the least recently used clean
+    ones are dropped first, and dirty ones are flushed before they can go.
+    Callers hold a user only while serving one request, so a user dropped
+    that long after its last use is not still being changed elsewhere.
+    """
+
+    def __init__(self, backend, flush_interval=5.0, flush_every=100, max_users=10000):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.flush_every = flush_every
+        self.max_users = max_users
+        self.users = OrderedDict()  # least recently used first
+        self.dirty = {}  # user_name -> list of changes, or None for a full write
+        self.flushing = set()  # users whose writes are on their way to the backend
+        self.pending = 0
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.counters = {"hits": 0, "misses": 0, "flushes": 0, "users_written": 0, "evictions": 0}
+        self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flusher.start()
+        atexit.register(self.close)
+
+    def get_user(self, user_name):
+        with self.lock:
+            user = self.users.get(user_name)
+            if user is not None:
+                self.users.move_to_end(user_name)
+                self.counters["hits"] += 1
+                return user
+            self.counters["misses"] += 1
+        user = self.backend.get_user(user_name)
+        if user is None:
+            return None
+        with self.lock:
+            # Another thread may have loaded or written it meanwhile
+            user = self.users.setdefault(user_name, user)
+        self._shrink()
+        return user
+
+    def put_user(self, user_name, user):
+        self.put_users({user_name: user})
+
+    def put_users(self, users):
+        with self.lock:
+            for user_name, user in users.items():
+                self.users[user_name] = user
+                self.users.move_to_end(user_name)
+            self.dirty.update(dict.fromkeys(users))
+            self.pending += len(users)
+            flush_now = self.pending >= self.flush_every
+        if flush_now:
+            self.flush()
+        self._shrink()
+
+    def commit_many(self, changes_by_user):
+        # The caller already applied the changes to the cached user object
+        uncached = {}
+        with self.lock:
+            for user_name, changes in changes_by_user.items():
+                if user_name not in self.users:
+                    uncached[user_name] = changes
+                    continue
+                if user_name not in self.dirty:
+                    self.dirty[user_name] = []
+                if self.dirty[user_name] is not None:
+                    self.dirty[user_name].extend(changes)
+                self.pending += len(changes)
+            flush_now = self.pending >= self.flush_every
+        if uncached:
+            self.backend.commit_many(uncached)
+        if flush_now:
+            self.flush()
+
+    def create_user(self, user_name, user):
+        with self.lock:
+            if user_name in self.users:
+                return False
+        if self.backend.get_user(user_name) is not None:
+            return False
+        self.put_user(user_name, user)
+        return True
+
+    def iter_users(self):
+        self.flush()
+        return self.backend.iter_users()
+
+    def iter_profiles(self):
+        self.flush()
+        return self.backend.iter_profiles()
+
+    def count_users(self):
+        self.flush()
+        return self.backend.count_users()
+
+    def count_image_refs(self, image_path):
+        self.flush()
+        return self.backend.count_image_refs(image_path)
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                if not self.dirty:
+                    return 0
+                dirty = self.dirty
+                self.dirty = {}
+                self.flushing = set(dirty)
+                self.pending = 0
+                full = {
+                    name: copy.deepcopy(self.users[name])
+                    for name, changes in dirty.items() if changes is None
+                }
+                partial = {
+                    name: copy.deepcopy(changes)
+                    for name, changes in dirty.items() if changes is not None
+                }
+            try:
+                if full:
+                    self.backend.put_users(full)
+                if partial:
+                    self.backend.commit_many(partial)
+            except Exception:
+                # Keep the users dirty (as full writes) so the next flush retries
+                with self.lock:
+                    for name in dirty:
+                        self.dirty[name] = None
+                    self.flushing = set()
+                raise
+            with self.lock:
+                self.flushing = set()
+                self.counters["flushes"] += 1
+                self.counters["users_written"] += len(dirty)
+            return len(dirty)
+
+    def _evict(self):
+        """Drop least recently used clean users beyond max_users; True if
+        dirty users are in the way."""
+        excess = len(self.users) - self.max_users
+        if excess <= 0:
+            return False
+        victims = []
+        for name in self.users:
+            if len(victims) == excess:
+                break
+            if name not in self.dirty and name not in self.flushing:
+                victims.append(name)
+        for name in victims:
+            del self.users[name]
+        self.counters["evictions"] += len(victims)
+        return len(victims) < excess
+
+    def _shrink(self):
+        with self.lock:
+            blocked = self._evict()
+        if blocked:
+            # Write the dirty users out so they can be dropped too
+            self.flush()
+            with self.lock:
+                self._evict()
+
+    def _flush_loop(self):
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print("Store flush error:", e)
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                self.counters,
+                cached_users=len(self.users),
+                max_users=self.max_users,
+                dirty_users=len(self.dirty),
+            )
+
+    def close(self):
+        self.stopped.set()
+        self.flush()
+        self.backend.close()
+
+
+# =========================
+# Append-only journal backend
+# =========================
+class JournalStore(BaseStore):
+    """Snapshot file plus an append-only journal of change records.
+
+    The snapshot has the legacy JSON layout with an extra ``journal_seq``.
+    Every write appends one JSON line ``{"seq", "user", ...}`` to the journal
+    and is fsynced in batches: after ``fsync_every`` records or
+    ``fsync_interval`` seconds, whichever comes first. On open the journal is
+    replayed over the snapshot, skipping a torn last line and records the
+    snapshot already contains. compact() folds the journal into a new snapshot.
+    """
+
+    def __init__(self, snapshot_path, journal_path, fsync_interval=0.05,
+                 fsync_every=64, compact_every=10000):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.fsync_interval = fsync_interval
+        self.fsync_every = fsync_every
+        self.compact_every = compact_every
+        self.lock = threading.RLock()
+        self.users = {}
+        self.seq = 0
+        self.journal_records = 0
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        self._replay()
+        self.journal = open(self.journal_path, "a", encoding="utf-8")
+        self.stopped = threading.Event()
+        self.syncer = threading.Thread(target=self._sync_loop, daemon=True)
+        self.syncer.start()
+        atexit.register(self.close)
+
+    def _replay(self):
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+            self.users = snapshot.get("users", {})
+            self.seq = snapshot.get("journal_seq", 0)
+            for user in self.users.values():
+                upgrade_user(user)
+        if not os.path.exists(self.journal_path):
+            return
+        good_bytes = 0
+        with open(self.journal_path, "rb") as f:
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("incomplete record")
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                good_bytes += len(line)
+                if record["seq"] <= self.seq:
+                    continue
+                self._apply(record)
+                self.seq = record["seq"]
+                self.journal_records += 1
+        # Cut off a torn write from a crash so new records start on a clean line
+        if good_bytes != os.path.getsize(self.journal_path):
+            with open(self.journal_path, "r+b") as f:
+                f.truncate(good_bytes)
+
+    def _apply(self, record):
+        user_name = record["user"]
+        if "put" in record:
+            self.users[user_name] = upgrade_user(record["put"])
+        elif user_name in self.users:
+            for change in record["changes"]:
+                apply_change(self.users[user_name], change)
+
+    def _append(self, records):
+        # Called with the lock held
+        for record in records:
+            self.seq += 1
+            record["seq"] = self.seq
+            self._apply(record)
+            self.journal.write(json.dumps(record, default=json_default) + "\n")
+        self.journal.flush()
+        self.journal_records += len(records)
+        self.unsynced += len(records)
+        if self.unsynced >= self.fsync_every:
+            self._sync()
+        if self.journal_records >= self.compact_every:
+            self.compact()
+
+    def _sync(self):
+        if self.unsynced:
+            os.fsync(self.journal.fileno())
+            self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def _sync_loop(self):
+        while not self.stopped.wait(self.fsync_interval):
+            with self.lock:
+                if not self.journal.closed:
+                    self._sync()
+
+    def get_user(self, user_name):
+        with self.lock:
+            user = self.users.get(user_name)
+            return copy.deepcopy(user) if user is not None else None
+
+    def put_users(self, users):
+        with self.lock:
+            self._append([
+                {"user": name, "put": copy.deepcopy(user)}
+                for name, user in users.items()
+            ])
+
+    def put_user(self, user_name, user):
+        self.put_users({user_name: user})
+
+    def create_user(self, user_name, user):
+        with self.lock:
+            if user_name in self.users:
+                return False
+            self.put_user(user_name, user)
+            return True
+
+    def commit_many(self, changes_by_user):
+        with self.lock:
+            self._append([
+                {"user": name, "changes": changes}
+                for name, changes in changes_by_user.items()
+            ])
+
+    def iter_users(self):
+        with self.lock:
+            users = copy.deepcopy(self.users)
+        return iter(users.items())
+
+    def iter_profiles(self):
+        with self.lock:
+            profiles = {
+                name: copy.deepcopy(user.get("profile", {}))
+                for name, user in self.users.items()
+            }
+        return iter(profiles.items())
+
+    def count_users(self):
+        return len(self.users)
+
+    def compact(self):
+        """Fold the journal into a fresh snapshot, then start an empty journal."""
+        with self.lock:
+            self._sync()
+            snapshot = {"journal_seq": self.seq, "users": self.users}
+            write_json_atomic(self.snapshot_path, snapshot, indent=2)
+            # The snapshot already covers every record, so a crash before
+            # the journal swap just means those records are skipped on replay
+            self.journal.close()
+            tmp_path = f"{self.journal_path}.tmp"
+            open(tmp_path, "w").close()
+            os.replace(tmp_path, self.journal_path)
+            self.journal = open(self.journal_path, "a", encoding="utf-8")
+            folded, self.journal_records = self.journal_records, 0
+            return folded
+
+    def close(self):
+        self.stopped.set()
+        with self.lock:
+            if not self.journal.closed:
+                self._sync()
+                self.journal.close()
+
+
+# =========================
+# Factory + migration
+# =========================
+def open_store(backend, json_path, sqlite_path, journal_path=None):
+    if backend == "json":
+        return JsonStore(json_path)
+    if backend == "journal":
+        return JournalStore(json_path, journal_path or f"{json_path}.journal")
+    if backend == "sqlite":
+        is_new = not os.path.exists(sqlite_path)
+        store = SqliteStore(sqlite_path)
+        # First start on SQLite: import the legacy JSON file once
+        if is_new and os.path.exists(json_path):
+            migrate(JsonStore(json_path), store)
+        return store
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+def migrate(source, target):
+    """Copy every user from one store into another in a single batch."""
+    users = dict(source.iter_users())
+    target.put_users(users)
+    return len(users)
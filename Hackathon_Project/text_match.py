@@ -0,0 +1,81 @@
+# =========================
+# Text matching
+# =========================
+# Tokenizer: the word split used for cache keys and the semantic index, with
+# the stopword set built once; `signature` changes with the stopword set.
+#
+# IngredientMatcher: a token trie over a pantry's names. Names and messages
+# are split into words and each word is normalized (plural -> singular), so
+# "tomatoes" finds "tomato" and "peanut" no longer finds "pea". A message is
+# scanned once, trying at each word the longest pantry name that starts
+# there; a lookup is O(words in the message x words in the longest name)
+# whatever the size of the pantry.
+import hashlib
+import re
+
+from stop_words import ENGLISH_STOPWORDS
+
+WORD_RE = re.compile(r"\b\w+\b")
+
+
+class Tokenizer:
+    def __init__(self, stopwords=ENGLISH_STOPWORDS):
+        self.stopwords = frozenset(stopwords)
+        self.signature = hashlib.sha1(" ".join(sorted(self.stopwords)).encode("utf-8")).hexdigest()[:16]
+
+    def tokenize(self, text):
+        stopwords = self.stopwords
+        return [t for t in WORD_RE.findall(text.lower()) if t not in stopwords]
+
+    def tokenize_many(self, texts):
+        stopwords = self.stopwords
+        findall = WORD_RE.findall
+        return [[t for t in findall(text.lower()) if t not in stopwords] for text in texts]
+
+
+class IngredientMatcher:
+    def __init__(self, names, normalize):
+        self.normalize = normalize
+        self.root = {}
+        self.depth = 0  # words in the longest name
+        for name in names:
+            words = self.words(name)
+            if not words:
+                continue
+            node = self.root
+            for word in words:
+                node = node.setdefault(word, {})
+            # None marks the end of a name; several names can share one key
+            node.setdefault(None, []).append(name)
+            self.depth = max(self.depth, len(words))
+
+    def words(self, text):
+        return [self.normalize(w) for w in WORD_RE.findall(text.lower())]
+
+    def find(self, message):
+        """Pantry names mentioned in `message`, in order of first mention.
+
+        Matches are leftmost-longest and do not overlap, so with both
+        "peanut butter" and "butter" in the pantry, "peanut butter toast"
+        only mentions "peanut butter".
+        """
+        words = self.words(message)
+        found = []
+        i = 0
+        while i < len(words):
+            node = self.root
+            match, length = None, 0
+            for j in range(i, min(i + self.depth, len(words))):
+                node = node.get(words[j])
+                if node is None:
+                    break
+                if None in node:
+                    match, length = node[None], j - i + 1
+            if match:
+                for name in match:
+                    if name not in found:
+                        found.append(name)
+                i += length
+            else:
+                i += 1
+        return found
@@ -0,0 +1,131 @@
+# =========================
+# Vision result cache
+# =========================
+# Uploads are fingerprinted twice:
+#   - SHA-256 of the bytes: identical files (and the file on disk) are shared
+#   - 64-bit difference hash (dHash): near-identical photos of the same pantry
+#     match when their hashes differ in at most `max_distance` bits. Only a
+#     user's own uploads match this way, and flat or plain-gradient images
+#     get no dHash: theirs is (nearly) all 0 or all 1 bits, which any other
+#     flat image would match.
+# Both map to the detected_items of an earlier upload, so the vision API is
+# only called for pictures we have never seen.
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+
+from caching import LRUCache
+
+try:
+    from PIL import Image
+except ImportError:  # Perceptual matching is skipped without Pillow
+    Image = None
+
+MIN_PIXEL_SPREAD = 8.0  # std dev of the grey thumbnail; below it the image is flat
+MIN_MIXED_BITS = 6      # a usable dHash has at least this many 0 and 1 bits
+
+
+def sha256_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def perceptual_hash(data, size=8):
+    """dHash as a 16-char hex string; None if the image can't be decoded or
+    is too flat for its hash to tell it apart from others."""
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img.draft("L", (size * 4, size * 4))  # fast JPEG downscale on decode
+            small = img.convert("L").resize((size + 1, size), Image.BILINEAR)
+            pixels = list(small.getdata())
+    except Exception:
+        return None
+    mean = sum(pixels) / len(pixels)
+    if (sum((p - mean) ** 2 for p in pixels) / len(pixels)) ** 0.5 < MIN_PIXEL_SPREAD:
+        return None
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    phash = f"{bits:016x}"
+    return phash if usable_phash(phash) else None
+
+
+def usable_phash(phash):
+    """False for missing hashes and ones (nearly) all 0 or all 1 bits."""
+    if not phash:
+        return False
+    ones = int(phash, 16).bit_count()
+    return MIN_MIXED_BITS <= ones <= len(phash) * 4 - MIN_MIXED_BITS
+
+
+class VisionCache:
+    def __init__(self, maxsize=5000, max_distance=4):
+        self.max_distance = max_distance
+        self.exact = LRUCache(maxsize)
+        self.perceptual = OrderedDict()  # (owner, phash int) -> detected items
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.phash_hits = 0
+        self.phash_evictions = 0
+
+    def seed(self, image_records, owner=None):
+        """Load fingerprints of earlier uploads of `owner`."""
+        for record in image_records:
+            if record.get("sha256"):
+                self.put(record["sha256"], record.get("phash"), record["detected_items"], owner)
+
+    def lookup(self, sha256, phash, owner=None):
+        """Return (detected items or None, "exact" / "perceptual" / None).
+        Perceptual matches only come from uploads of the same owner."""
+        items = self.exact.get(sha256)
+        if items is not None:
+            return items, "exact"
+        if not usable_phash(phash):
+            return None, None
+        target = int(phash, 16)
+        with self.lock:
+            best, best_distance = None, self.max_distance + 1
+            for key in self.perceptual:
+                if key[0] != owner:
+                    continue
+                distance = (key[1] ^ target).bit_count()
+                if distance < best_distance:
+                    best, best_distance = key, distance
+            if best is None:
+                return None, None
+            self.perceptual.move_to_end(best)
+            self.phash_hits += 1
+            return self.perceptual[best], "perceptual"
+
+    def put(self, sha256, phash, items, owner=None):
+        self.exact.set(sha256, items)
+        # Hashes stored before flat images were filtered out are dropped here
+        if not usable_phash(phash):
+            return
+        key = (owner, int(phash, 16))
+        with self.lock:
+            self.perceptual[key] = items
+            self.perceptual.move_to_end(key)
+            while len(self.perceptual) > self.maxsize:
+                self.perceptual.popitem(last=False)
+                self.phash_evictions += 1
+
+    def stats(self):
+        exact = self.exact.stats()
+        # exact misses include lookups later answered by the perceptual hash
+        misses = exact["misses"] - self.phash_hits
+        lookups = exact["hits"] + self.phash_hits + misses
+        return {
+            "exact_hits": exact["hits"],
+            "perceptual_hits": self.phash_hits,
+            "misses": misses,
+            "hit_ratio": round((exact["hits"] + self.phash_hits) / lookups, 4) if lookups else 0.0,
+            "exact_size": exact["size"],
+            "perceptual_size": len(self.perceptual),
+            "evictions": exact["evictions"] + self.phash_evictions,
+        }
@@ -0,0 +1,162 @@
+# =========================
+# Weight history
+# =========================
+# A user's weigh-ins are stored column by column instead of one dict each:
+#
+#   {"ts":     array('d'),   # epoch seconds, ascending
+#    "weight": array('d'),   # kg
+#    "bmi":    array('d'),   # NaN when unknown
+#    "notes":  {"<index>": "text"}}   # only entries that have a note
+#
+# Entries are only ever appended in time order, so a time range is two
+# bisects and a column converts to a NumPy array with one memcpy.
+# Stores serialize the arrays as JSON lists (see json_default).
+import math
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+
+import numpy as np
+
+LEGACY_DATE_FORMAT = "%d/%m %H:%M %Y"  # older versions stored "DD/MM HH:MM"
+
+
+def empty_history():
+    return {"ts": array("d"), "weight": array("d"), "bmi": array("d"), "notes": {}}
+
+
+def as_history(value, now=None):
+    """Return `value` as a columnar history.
+
+    Accepts the in-memory form, its JSON form (lists) and the legacy list of
+    {"date", "weight", "notes", "bmi"} entries.
+    """
+    if isinstance(value, dict):
+        if isinstance(value["ts"], array):
+            return value
+        return {
+            "ts": array("d", value["ts"]),
+            "weight": array("d", value["weight"]),
+            "bmi": array("d", (math.nan if v is None else v for v in value["bmi"])),
+            "notes": dict(value.get("notes", {})),
+        }
+    entries = list(value or [])
+    history = empty_history()
+    for entry, ts in zip(entries, entry_timestamps(entries, now)):
+        history_add(history, ts, entry["weight"], entry.get("bmi"), entry.get("notes"))
+    return history
+
+
+def entry_timestamps(entries, now=None):
+    """Epoch seconds for legacy entries.
+
+    Entries with a "ts" keep it. For the rest the year is inferred from the
+    stored "DD/MM HH:MM": walking back from the newest entry, each one is
+    placed in the latest year that keeps the history in order.
+    """
+    later = now or datetime.now()
+    result = []
+    for entry in reversed(entries):
+        if entry.get("ts") is not None:
+            moment = datetime.fromtimestamp(entry["ts"])
+        else:
+            moment = later
+            try:
+                # Parse in a leap year so "29/02" is accepted, then pick the year
+                parsed = datetime.strptime(f"{entry.get('date')} 2000", LEGACY_DATE_FORMAT)
+                # Latest year at or before `later` (29/02 only in leap years)
+                for year in range(later.year, later.year - 8, -1):
+                    try:
+                        candidate = parsed.replace(year=year)
+                    except ValueError:
+                        continue
+                    if candidate <= later:
+                        moment = candidate
+                        break
+            except ValueError:
+                pass
+        result.append(moment.timestamp())
+        later = moment
+    result.reverse()
+    return result
+
+
+def history_add(history, ts, weight, bmi=None, notes=None):
+    # Clock changes must not break the ordering bisect relies on
+    if history["ts"] and ts < history["ts"][-1]:
+        ts = history["ts"][-1]
+    if notes:
+        history["notes"][str(len(history["ts"]))] = notes
+    history["ts"].append(ts)
+    history["weight"].append(weight)
+    history["bmi"].append(math.nan if bmi is None else bmi)
+
+
+def history_entries(history, start=0, stop=None):
+    """Entries start..stop as dicts, for templates and row-based stores."""
+    count = len(history["ts"])
+    start, stop, _ = slice(start, stop).indices(count)
+    entries = []
+    for i in range(start, stop):
+        bmi = history["bmi"][i]
+        entries.append({
+            "ts": history["ts"][i],
+            "weight": history["weight"][i],
+            "bmi": None if math.isnan(bmi) else bmi,
+            "notes": history["notes"].get(str(i), ""),
+        })
+    return entries
+
+
+def json_default(value):
+    # json.dump(..., default=json_default) writes the columns as lists
+    if isinstance(value, array):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+# =========================
+# Chart downsampling
+# =========================
+def time_range(history, start=None, end=None):
+    """Index slice of the entries with start <= ts <= end."""
+    ts = history["ts"]
+    lo = 0 if start is None else bisect_left(ts, start)
+    hi = len(ts) if end is None else bisect_right(ts, end)
+    return lo, hi
+
+
+def lttb_indices(x, y, threshold):
+    """Largest-Triangle-Three-Buckets: indices of `threshold` points that
+    keep the visual shape of the series (first and last are always kept)."""
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    bucket = (n - 2) / (threshold - 2)
+    picked = np.empty(threshold, dtype=np.int64)
+    picked[0], picked[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        lo = int(i * bucket) + 1
+        hi = int((i + 1) * bucket) + 1
+        next_hi = min(int((i + 2) * bucket) + 1, n)
+        avg_x = x[hi:next_hi].mean()
+        avg_y = y[hi:next_hi].mean()
+        # Twice the area of the triangle (a, candidate, next bucket average)
+        areas = np.abs(
+            (x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a])
+        )
+        a = lo + int(areas.argmax())
+        picked[i + 1] = a
+    return picked
+
+
+def chart_points(history, start=None, end=None, points=300):
+    """(timestamps, weights, entries in range) downsampled to `points`."""
+    lo, hi = time_range(history, start, end)
+    # Slicing copies the range first: a NumPy view on the live array would
+    # make a concurrent append fail with BufferError
+    x = np.frombuffer(history["ts"][lo:hi], dtype=np.float64)
+    y = np.frombuffer(history["weight"][lo:hi], dtype=np.float64)
+    picked = lttb_indices(x, y, points)
+    return x[picked], y[picked], hi - lo
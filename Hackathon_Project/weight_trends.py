@@ -0,0 +1,134 @@
+# =========================
+# Weight trend analytics
+# =========================
+# Aggregates kept with the user (user["trends"]) so a page view only reads
+# them:
+#   - exponential moving averages with a time constant in days; the decay
+#     uses the real gap between weigh-ins, so missed days count as time
+#   - sums for a least-squares line over the last WINDOW_DAYS; the slope is
+#     the weekly rate of change
+# log_weight() updates them in O(1) with update_trends(); compute_trends()
+# rebuilds them from the whole history with NumPy when they are missing.
+import math
+from datetime import date
+
+import numpy as np
+
+EMA_DAYS = {"ema_7d": 7, "ema_30d": 30}
+WINDOW_DAYS = 28
+DAY = 86400.0
+MIN_SPREAD_DAYS2 = 0.01   # x variance below this (a few hours) gives no rate
+MAX_PROJECTION_DAYS = 3 * 365
+
+
+def compute_trends(history):
+    """Aggregates for the whole history, vectorized."""
+    ts = np.frombuffer(history["ts"][:], dtype=np.float64)
+    weights = np.frombuffer(history["weight"][:], dtype=np.float64)
+    if not len(ts):
+        return None
+    state = {
+        "count": len(ts),
+        "origin": float(ts[0]),
+        "last_ts": float(ts[-1]),
+    }
+    # EMA at the last entry: each weight's share decays with its age;
+    # the first weight is the starting value
+    for name, days in EMA_DAYS.items():
+        tau = days * DAY
+        to_end = np.exp(-(ts[-1] - ts) / tau)
+        alpha = -np.expm1(-np.diff(ts) / tau)
+        state[name] = float(weights[0] * to_end[0] + np.sum(alpha * weights[1:] * to_end[1:]))
+    start = int(np.searchsorted(ts, ts[-1] - WINDOW_DAYS * DAY, side="left"))
+    x = (ts[start:] - state["origin"]) / DAY
+    y = weights[start:]
+    state["window_start"] = start
+    state["sums"] = [float(len(x)), float(x.sum()), float(y.sum()),
+                     float(x @ x), float(x @ y)]
+    return state
+
+
+def update_trends(state, history):
+    """Fold the newest entry of `history` into `state` (O(1) amortized)."""
+    count = len(history["ts"])
+    if not state or state.get("count") != count - 1:
+        return compute_trends(history)
+    # Work on a copy; the stored state may still be waiting to be flushed
+    state = dict(state, sums=list(state["sums"]))
+    ts, weight = history["ts"][-1], history["weight"][-1]
+    gap = ts - state["last_ts"]
+    for name, days in EMA_DAYS.items():
+        alpha = -math.expm1(-gap / (days * DAY))
+        state[name] += alpha * (weight - state[name])
+
+    sums = state["sums"]
+    x = (ts - state["origin"]) / DAY
+    _add_point(sums, x, weight, 1)
+    # Drop the entries that fell out of the regression window
+    cutoff = ts - WINDOW_DAYS * DAY
+    start = state["window_start"]
+    while history["ts"][start] < cutoff:
+        old_x = (history["ts"][start] - state["origin"]) / DAY
+        _add_point(sums, old_x, history["weight"][start], -1)
+        start += 1
+    state["window_start"] = start
+    state["count"] = count
+    state["last_ts"] = ts
+    return state
+
+
+def _add_point(sums, x, y, sign):
+    sums[0] += sign
+    sums[1] += sign * x
+    sums[2] += sign * y
+    sums[3] += sign * x * x
+    sums[4] += sign * x * y
+
+
+def weekly_rate(state):
+    """kg per week from the regression window, or None with too little data."""
+    n, sx, sy, sxx, sxy = state["sums"]
+    if n < 2:
+        return None
+    spread = sxx / n - (sx / n) ** 2
+    if spread < MIN_SPREAD_DAYS2:
+        return None
+    slope = (sxy / n - (sx / n) * (sy / n)) / spread  # kg per day
+    return slope * 7
+
+
+def trend_summary(state, target_weight=None):
+    """What the page and API show; cheap enough for every request."""
+    if not state:
+        return None
+    rate = weekly_rate(state)
+    trend_weight = state["ema_7d"]
+    summary = {
+        "entries": state["count"],
+        "trend_weight": round(trend_weight, 1),
+        "ema_7d": round(state["ema_7d"], 2),
+        "ema_30d": round(state["ema_30d"], 2),
+        "weekly_rate": round(rate, 2) if rate is not None else None,
+        "window_days": WINDOW_DAYS,
+        "goal_status": None,
+        "projected_date": None,
+        "days_to_goal": None,
+    }
+    if target_weight is None:
+        return summary
+    remaining = target_weight - trend_weight
+    if abs(remaining) < 0.5:
+        summary["goal_status"] = "reached"
+    elif rate is None:
+        summary["goal_status"] = "no_data"
+    elif not rate or remaining * rate < 0:
+        summary["goal_status"] = "off_track"
+    else:
+        days = remaining / (rate / 7)
+        if days > MAX_PROJECTION_DAYS:
+            summary["goal_status"] = "too_slow"
+        else:
+            summary["goal_status"] = "on_track"
+            summary["days_to_goal"] = math.ceil(days)
+            summary["projected_date"] = date.fromtimestamp(state["last_ts"] + days * DAY).isoformat()
+    return summary